@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark: asignación de casos a radios censales.
+
+Compara el conteo original de `get_cases_for_each_circuit` (doble `iterrows()` con
+`intersects` por cada par radio x punto) contra el conteo vectorizado de
+`spatial_utils.count_points_in_tracts` (STRtree + polígonos preparados).
+
+Usa radios sintéticos (grilla sobre Puerto Madryn, EPSG:22173) y puntos al azar.
+El loop original es lineal en la cantidad de puntos: por encima de `--max-loop-points`
+se mide sobre una muestra y se extrapola.
+
+Uso:
+    python scripts/benchmark_point_in_polygon.py --tracts 100 --points 10000 100000 1000000
+"""
+import argparse
+import time
+
+import geopandas
+import numpy
+from shapely.geometry import box
+
+from bronchiolitis_package import spatial_utils
+
+PM_ORIGIN = 3574000, 5258000
+PM_SIDE = 10_000
+
+
+def make_tracts(n_tracts):
+    side = int(numpy.ceil(numpy.sqrt(n_tracts)))
+    step = PM_SIDE / side
+    x0, y0 = PM_ORIGIN
+    cells = [
+        box(x0 + i * step, y0 + j * step, x0 + (i + 1) * step, y0 + (j + 1) * step)
+        for i in range(side)
+        for j in range(side)
+    ][:n_tracts]
+    return geopandas.GeoDataFrame(
+        {'toponimo_i': [str(300000 + i) for i in range(len(cells))]},
+        geometry=cells,
+        crs='EPSG:22173'
+    )
+
+
+def make_points(n_points, seed=0):
+    rng = numpy.random.default_rng(seed)
+    x0, y0 = PM_ORIGIN
+    xy = rng.uniform(0, PM_SIDE, size=(n_points, 2))
+    return geopandas.GeoDataFrame(
+        geometry=geopandas.points_from_xy(x0 + xy[:, 0], y0 + xy[:, 1]),
+        crs='EPSG:22173'
+    )
+
+
+def legacy_count(points_gdf, tracts_gdf):
+    """ Conteo tal como lo hacía get_cases_for_each_circuit. """
+    cases_per_census_unit = []
+    for _, census_unit in tracts_gdf.iterrows():
+        intersections = []
+        for _, point in points_gdf.iterrows():
+            intersections.append(census_unit.geometry.intersects(point.geometry))
+        cases_per_census_unit.append(len(list(filter(bool, intersections))))
+    return numpy.array(cases_per_census_unit)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--tracts', type=int, default=100)
+    parser.add_argument('--points', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--max-loop-points', type=int, default=10_000)
+    args = parser.parse_args()
+
+    tracts_gdf = make_tracts(args.tracts)
+    print(f"{'points':>10} {'loop (s)':>12} {'vectorized (s)':>16} {'speedup':>10}")
+
+    for n_points in args.points:
+        points_gdf = make_points(n_points)
+
+        counts, vectorized_time = timed(
+            spatial_utils.count_points_in_tracts, points_gdf, tracts_gdf)
+        assert counts.sum() == n_points
+
+        loop_points = min(n_points, args.max_loop_points)
+        sample_gdf = points_gdf.iloc[:loop_points]
+        legacy_counts, loop_time = timed(legacy_count, sample_gdf, tracts_gdf)
+        assert (legacy_counts == spatial_utils.count_points_in_tracts(sample_gdf, tracts_gdf)).all()
+
+        estimated = ''
+        if loop_points < n_points:
+            loop_time *= n_points / loop_points
+            estimated = ' (est.)'
+
+        print(
+            f"{n_points:>10} {loop_time:>12.2f}{estimated} {vectorized_time:>16.3f} "
+            f"{loop_time / vectorized_time:>9.0f}x"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -7,8 +7,7 @@
 """
 Report con los resultados obtenidos
 """
-import os
-import pdfkit
+from bronchiolitis_package.report import render_pdf
 
 # + tags=["parameters"]
 upstream = ['clustermap-figure', 'clustermap-figure-bivariate', 'get_moranplot', 'get_moranplot_bv']
@@ -87,14 +86,5 @@ report_template = f'''
 
 
 # + tags=[]
-# Save HTML string to file
-HTML_REPORT_DIR = "tmp_report.html"
-with open(HTML_REPORT_DIR, "w") as r:
-    r.write(report_template)
-#Use pdfkit to create the pdf report from the 
-pdfkit.from_file(
-    HTML_REPORT_DIR,
-     str(product['data'])
-)
-# remove the tmp data
-os.remove(HTML_REPORT_DIR)
+# html temporal con nombre único junto al pdf (ver `render_pdf`)
+render_pdf(report_template, str(product['data']))
@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+Datos de entrada sintéticos para probar el pipeline a escala.
+
+Escribe bajo un `root_path` (por defecto un directorio temporal nuevo), en las rutas de
+env.yaml, todos los archivos que el pipeline lee de `root_path`:
+
+    - capa de radios censales (shapefile, EPSG:22173) con `link`, `toponimo_i`,
+      `totalpobl` y `Unidades_7` (nbi), como la leen `get_shape` y `get_nbi`: teselado
+      de Voronoi (o grilla) sobre Puerto Madryn, de ~0.25 km² por radio;
+    - población por radio y edad al estilo INDEC (`area`, `edad`, `casos`, con tabs);
+    - domicilios con latitud y longitud (`Domicilio definitivo`, `Latitud`, `Longitud`);
+    - historias clínicas con las columnas del export, internaciones concentradas en el
+      invierno de cada temporada, reinternaciones (misma HC y domicilio) y una fracción
+      de domicilios que no están en el dataset de domicilios;
+    - capas base GeoTIFF de Puerto Madryn y de América del Sur (EPSG:3857).
+
+El riesgo de internación de cada radio crece con su nbi, de modo que los análisis de
+Moran encuentran estructura espacial.
+
+Uso:
+    python scripts/generate_synthetic_inputs.py --tracts 10000 --cases 20000
+    ploomber build --env--root_path <root_path que se imprime>
+"""
+import argparse
+import os
+import tempfile
+
+import geopandas
+import numpy
+import pandas
+import rasterio
+import shapely
+import yaml
+from rasterio.transform import from_bounds
+
+ENV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'env.yaml')
+
+TRACTS_CRS = 'EPSG:22173'
+BASEMAP_CRS = 'EPSG:3857'
+
+# centro de Puerto Madryn en TRACTS_CRS
+PM_CENTER = 3578570, 5264350
+
+# superficie media de un radio (m²): la capa real tiene ~225 radios en ~50 km²
+TRACT_AREA = 250_000
+
+# extensión de la capa base de América del Sur (lon/lat)
+SOUTH_AMERICA_BOUNDS = -82, -56, -34, 13
+
+MEAN_POPULATION = 900
+MAX_AGE = 99
+
+# temporada de bronquiolitis: día del año del pico de internaciones (fines de junio) y
+# desvío en días
+SEASON_PEAK_DAY = 178
+SEASON_SPREAD_DAYS = 30
+
+MEDICAL_RECORDS_COLUMNS = [
+    'HC', 'FN', 'MESES', 'Edad', 'Vaginal', 'Cesarea', 'Sexo', 'SE',
+    'INGRESO', 'EGRESO', 'Días I', 'Lugar E', 'DE CIE-10', 'Virus',
+    'Domicilio', 'ALTERNATIVA', 'Domicilio definitivo', 'Unnamed: 17',
+    'Barrio', 'Circunscripción', 'Sector', 'Unnamed: 21',
+    'Nombre del Barrio',
+]
+
+# sílabas de los nombres de calles (sin letras que el plegado fonético de
+# `geocode_index` confunde entre sí)
+SYLLABLES = ['ma', 'ri', 'to', 'lu', 'ne', 'pa', 'de', 'go', 'fi', 'la', 'mo', 'nu', 'te', 'ra', 'di', 'po', 'ju', 'ta', 'ki', 'we']
+
+
+def get_input_paths(root_path, env_path=ENV_PATH):
+    """Rutas de los archivos de entrada bajo `root_path`, según env.yaml."""
+    with open(env_path) as infile:
+        env = yaml.safe_load(infile)
+    keys = {
+        'medical_records': 'bronchiolitis_cases_file_path',
+        'addresses': 'adresses_file_path',
+        'shapefile': 'puerto_madryn_shapefile',
+        'indec_ages': 'indec_ages_file',
+        'puerto_madryn_basemap': 'puerto_madryn_basemap_file',
+        'south_america_basemap': 'south_america_basemap_file',
+    }
+    return {name: f"{root_path}{env[key]}" for name, key in keys.items()}
+
+
+def make_tracts(n_tracts, tessellation='voronoi', seed=0):
+    """Radios censales sintéticos con población y nbi.
+
+    Args:
+        - tessellation (str): 'voronoi' (semillas al azar) o 'grid'.
+
+    Returns:
+        geopandas.GeoDataFrame: `link`, `toponimo_i`, `totalpobl`, `Unidades_7` y
+            `geometry`, en TRACTS_CRS.
+    """
+    rng = numpy.random.default_rng(seed)
+    side = numpy.sqrt(n_tracts * TRACT_AREA)
+    x0, y0 = PM_CENTER[0] - side / 2, PM_CENTER[1] - side / 2
+    extent = shapely.box(x0, y0, x0 + side, y0 + side)
+
+    if tessellation == 'grid':
+        columns = int(numpy.ceil(numpy.sqrt(n_tracts)))
+        step = side / columns
+        i = numpy.arange(n_tracts)
+        xmin, ymin = x0 + (i % columns) * step, y0 + (i // columns) * step
+        cells = shapely.box(xmin, ymin, xmin + step, ymin + step)
+    elif tessellation == 'voronoi':
+        seeds = shapely.multipoints(rng.uniform(0, side, size=(n_tracts, 2)) + (x0, y0))
+        regions = shapely.get_parts(shapely.voronoi_polygons(seeds, extend_to=extent))
+        cells = shapely.intersection(regions, extent)
+    else:
+        raise ValueError(f"Teselado desconocido: {tessellation}. Valores posibles: ['voronoi', 'grid']")
+
+    # nbi: campo suave (algunos focos) más ruido
+    centroids = shapely.get_coordinates(shapely.centroid(cells))
+    n_foci = max(3, int(numpy.sqrt(n_tracts) / 4))
+    foci = rng.uniform(0, side, size=(n_foci, 2)) + (x0, y0)
+    radius = side / numpy.sqrt(n_foci) / 2
+    distances = numpy.linalg.norm(centroids[:, None, :] - foci[None, :, :], axis=2)
+    field = numpy.exp(-(distances / radius) ** 2).max(axis=1)
+    nbi = numpy.clip(4 + 30 * field + rng.normal(0, 3, len(cells)), 0, 70).round(2)
+
+    i = numpy.arange(len(cells))
+    return geopandas.GeoDataFrame({
+        'link': 260070000 + i,
+        'toponimo_i': 300000 + i,
+        'totalpobl': numpy.maximum(rng.poisson(MEAN_POPULATION, len(cells)), 50).astype(float),
+        'Unidades_7': nbi,
+    }, geometry=cells, crs=TRACTS_CRS)
+
+
+def make_indec_ages(tracts, seed=0):
+    """Población de cada radio por edad simple (0 a MAX_AGE), que suma `totalpobl`.
+
+    Returns:
+        pandas.DataFrame: `area` (link del radio), `edad`, `casos`.
+    """
+    rng = numpy.random.default_rng(seed)
+    ages = numpy.arange(MAX_AGE + 1)
+    pyramid = numpy.exp(-ages / 35)
+    counts = rng.multinomial(tracts['totalpobl'].to_numpy(dtype=int), pyramid / pyramid.sum())
+    return pandas.DataFrame({
+        'area': numpy.repeat(tracts['link'].to_numpy(), len(ages)),
+        'edad': numpy.tile(ages, len(tracts)),
+        'casos': counts.ravel(),
+    })
+
+
+def make_street_names(n_streets, rng, exclude=()):
+    """Nombres de calles distintos (2 a 4 sílabas)."""
+    names = []
+    seen = set(exclude)
+    while len(names) < n_streets:
+        n_syllables = rng.integers(2, 5)
+        name = ''.join(rng.choice(SYLLABLES, n_syllables)).capitalize()
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names
+
+
+def sample_points_in_tracts(tracts, tract_positions, rng):
+    """Un punto al azar dentro de cada radio de `tract_positions` (por rechazo)."""
+    geometries = tracts.geometry.values
+    bounds = shapely.bounds(geometries)
+    xy = numpy.empty((len(tract_positions), 2))
+    pending = numpy.arange(len(tract_positions))
+    while len(pending):
+        tract_bounds = bounds[tract_positions[pending]]
+        x = rng.uniform(tract_bounds[:, 0], tract_bounds[:, 2])
+        y = rng.uniform(tract_bounds[:, 1], tract_bounds[:, 3])
+        inside = shapely.contains_xy(geometries[tract_positions[pending]], x, y)
+        xy[pending[inside]] = numpy.column_stack([x[inside], y[inside]])
+        pending = pending[~inside]
+    return xy
+
+
+def make_addresses(tracts, n_addresses, seed=0):
+    """Domicilios (calle y altura) en radios al azar según su población.
+
+    Returns:
+        - addresses (pandas.DataFrame): `Domicilio definitivo`, `Latitud`, `Longitud`.
+        - tract_positions (numpy.ndarray): posición en `tracts` del radio de cada domicilio.
+    """
+    rng = numpy.random.default_rng(seed)
+    population = tracts['totalpobl'].to_numpy()
+    tract_positions = rng.choice(len(tracts), size=n_addresses, p=population / population.sum())
+    xy = sample_points_in_tracts(tracts, tract_positions, rng)
+    lnglat = geopandas.GeoSeries(
+        geopandas.points_from_xy(xy[:, 0], xy[:, 1]), crs=tracts.crs).to_crs('EPSG:4326')
+
+    streets = make_street_names(max(20, n_addresses // 50), rng)
+    addresses = pandas.Series(
+        [f"{street} {number}" for street, number in zip(
+            rng.choice(streets, n_addresses), rng.integers(1, 4000, n_addresses))])
+    unique = ~addresses.duplicated().to_numpy()
+    addresses_df = pandas.DataFrame({
+        'Domicilio definitivo': addresses[unique].to_numpy(),
+        'Latitud': lnglat.y.to_numpy()[unique].round(6),
+        'Longitud': lnglat.x.to_numpy()[unique].round(6),
+    })
+    return addresses_df, tract_positions[unique]
+
+
+def make_medical_records(
+        tracts, addresses, address_tracts, n_cases,
+        seasons=(2017, 2018, 2019, 2020),
+        readmission_rate=.08,
+        unmatched_rate=.02,
+        seed=0
+    ):
+    """Historias clínicas con las columnas del export (`MEDICAL_RECORDS_COLUMNS`).
+
+    Cada primera internación elige un domicilio con probabilidad proporcional a la
+    población de su radio y a exp(nbi estandarizado). Las reinternaciones repiten la HC y
+    el domicilio de una internación anterior, entre 3 y 60 días después.
+    """
+    rng = numpy.random.default_rng(seed)
+    n_readmissions = int(round(n_cases * readmission_rate))
+    n_children = n_cases - n_readmissions
+
+    nbi = tracts['Unidades_7'].to_numpy()
+    risk = tracts['totalpobl'].to_numpy() * numpy.exp((nbi - nbi.mean()) / (nbi.std() or 1))
+    address_risk = risk[address_tracts] / numpy.bincount(address_tracts, minlength=len(tracts))[address_tracts]
+    address_positions = rng.choice(len(addresses), size=n_children, p=address_risk / address_risk.sum())
+    domicilio = addresses['Domicilio definitivo'].to_numpy()[address_positions].astype(object)
+
+    # domicilios que no están en el dataset de domicilios
+    unmatched = rng.random(n_children) < unmatched_rate
+    unknown_streets = make_street_names(
+        max(1, int(unmatched.sum() // 5)), rng,
+        exclude=set(addresses['Domicilio definitivo'].str.rsplit(' ', n=1).str[0]))
+    domicilio[unmatched] = [
+        f"{street} {number}" for street, number
+        in zip(rng.choice(unknown_streets, unmatched.sum()), rng.integers(1, 4000, unmatched.sum()))
+    ]
+
+    days = numpy.clip(rng.normal(SEASON_PEAK_DAY, SEASON_SPREAD_DAYS, n_children), 0, 364).astype(int)
+    ingreso = pandas.to_datetime(
+        [f'{season}-01-01' for season in rng.choice(seasons, n_children)]) + pandas.to_timedelta(days, unit='D')
+    edad = numpy.clip(rng.gamma(1.5, .35, n_children), .02, 2).round(2)
+    hc = rng.permutation(numpy.arange(100_000, 100_000 + n_children))
+
+    # reinternaciones
+    previous = rng.choice(n_children, size=n_readmissions)
+    delay = rng.integers(3, 61, n_readmissions)
+    hc = numpy.concatenate([hc, hc[previous]])
+    domicilio = numpy.concatenate([domicilio, domicilio[previous]])
+    ingreso = ingreso.append(ingreso[previous] + pandas.to_timedelta(delay, unit='D'))
+    edad = numpy.concatenate([edad, (edad[previous] + delay / 365).round(2)])
+
+    n_records = len(hc)
+    egreso = ingreso + pandas.to_timedelta(rng.geometric(.3, n_records), unit='D')
+    fn = ingreso - pandas.to_timedelta((edad * 365).astype(int), unit='D')
+    records = pandas.DataFrame({column: '' for column in MEDICAL_RECORDS_COLUMNS}, index=range(n_records))
+    records['HC'] = hc
+    records['FN'] = fn.strftime('%Y-%m-%d')
+    records['MESES'] = (edad * 12).astype(int)
+    records['Edad'] = edad
+    records['Sexo'] = rng.choice(['F', 'M'], n_records)
+    records['SE'] = ingreso.isocalendar().week.to_numpy().astype(float)
+    records['INGRESO'] = ingreso.strftime('%Y-%m-%d')
+    records['EGRESO'] = egreso.strftime('%Y-%m-%d')
+    records['Días I'] = (egreso - ingreso).days
+    records['DE CIE-10'] = 'J21.9'
+    records['Virus'] = 'NE'
+    records['Domicilio'] = domicilio
+    records['Domicilio definitivo'] = domicilio
+    return records.sort_values('INGRESO', kind='stable').reset_index(drop=True)
+
+
+def write_basemap(path, bounds, size, seed=0):
+    """GeoTIFF RGB (BASEMAP_CRS) con un fondo suave, que cubre `bounds` (lon/lat)."""
+    rng = numpy.random.default_rng(seed)
+    left, bottom, right, top = geopandas.GeoSeries(
+        [shapely.box(*bounds)], crs='EPSG:4326').to_crs(BASEMAP_CRS).total_bounds
+    y, x = numpy.mgrid[0:1:size * 1j, 0:1:size * 1j]
+    base = .5 + .25 * numpy.sin(6 * x) * numpy.cos(4 * y)
+    image = numpy.stack([base * 220, base * 210 + 20, base * 180 + 40])
+    image = numpy.clip(image + rng.normal(0, 4, image.shape), 0, 255).astype('uint8')
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with rasterio.open(
+            path, 'w', driver='GTiff', height=size, width=size, count=3, dtype='uint8',
+            crs=BASEMAP_CRS, transform=from_bounds(left, bottom, right, top, size, size)) as raster:
+        raster.write(image)
+
+
+def write_synthetic_inputs(
+        root_path, n_tracts, n_cases,
+        n_addresses=None,
+        tessellation='voronoi',
+        seasons=(2017, 2018, 2019, 2020),
+        readmission_rate=.08,
+        unmatched_rate=.02,
+        seed=0,
+        env_path=ENV_PATH
+    ):
+    """Escribe todos los archivos de entrada bajo `root_path` (ver docstring del módulo).
+
+    Returns:
+        dict: rutas escritas (ver `get_input_paths`).
+    """
+    paths = get_input_paths(root_path, env_path)
+    for path in paths.values():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tracts = make_tracts(n_tracts, tessellation=tessellation, seed=seed)
+    tracts.to_file(paths['shapefile'])
+    make_indec_ages(tracts, seed=seed).to_csv(paths['indec_ages'], sep='\t', index=False)
+
+    addresses, address_tracts = make_addresses(
+        tracts, n_addresses or max(2 * n_cases, n_tracts), seed=seed)
+    addresses.to_csv(paths['addresses'], index=False)
+
+    records = make_medical_records(
+        tracts, addresses, address_tracts, n_cases,
+        seasons=seasons,
+        readmission_rate=readmission_rate,
+        unmatched_rate=unmatched_rate,
+        seed=seed
+    )
+    records.to_csv(paths['medical_records'], index=False)
+
+    xmin, ymin, xmax, ymax = tracts.to_crs('EPSG:4326').total_bounds
+    margin = max(xmax - xmin, ymax - ymin) * .25
+    write_basemap(
+        paths['puerto_madryn_basemap'],
+        (xmin - margin, ymin - margin, xmax + margin, ymax + margin), 2048, seed=seed)
+    write_basemap(paths['south_america_basemap'], SOUTH_AMERICA_BOUNDS, 1024, seed=seed)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('root_path', nargs='?', default=None)
+    parser.add_argument('--tracts', type=int, default=225)
+    parser.add_argument('--cases', type=int, default=1000)
+    parser.add_argument('--addresses', type=int, default=None)
+    parser.add_argument('--tessellation', choices=['voronoi', 'grid'], default='voronoi')
+    parser.add_argument('--seasons', type=int, nargs='+', default=[2017, 2018, 2019, 2020])
+    parser.add_argument('--readmission-rate', type=float, default=.08)
+    parser.add_argument('--unmatched-rate', type=float, default=.02)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    root_path = args.root_path or tempfile.mkdtemp(prefix='bronchiolitis-synthetic-')
+    paths = write_synthetic_inputs(
+        root_path, args.tracts, args.cases,
+        n_addresses=args.addresses,
+        tessellation=args.tessellation,
+        seasons=args.seasons,
+        readmission_rate=args.readmission_rate,
+        unmatched_rate=args.unmatched_rate,
+        seed=args.seed
+    )
+    for name, path in paths.items():
+        print(f"{name:>22}: {path}")
+    print(f"\nploomber build --env--root_path {root_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Correcciones de domicilios a partir de una tabla externa.
+
+La tabla (csv) tiene una regla por fila:
+
+    original,corregido,coincidencia,motivo
+    Tecka 2050,Simón de Alcazabar 440,exacta,mudanza
+    M.A. Zar 1431,Marcos A. Zar 1431,normalizada,no encontrado
+
+`coincidencia` es `exacta` (el domicilio es igual a `original`) o `normalizada` (son
+iguales después de `normalize_address`: minúsculas, sin tildes, sin puntuación y con
+los espacios colapsados). Si un domicilio coincide con una regla exacta y con una
+normalizada, se aplica la exacta.
+
+Las reglas se resuelven sobre los domicilios distintos (`pandas.factorize`) y se aplican
+a todas las filas con un único `take`, de modo que el costo no depende de la cantidad
+de reglas.
+"""
+import numpy
+import pandas
+
+CORRECTIONS_COLUMNS = ['original', 'corregido', 'coincidencia', 'motivo']
+
+MATCH_EXACT = 'exacta'
+MATCH_NORMALIZED = 'normalizada'
+
+
+def normalize_address(addresses):
+    """Clave normalizada de los domicilios (pandas.Series de strings)."""
+    return (
+        addresses.astype('str')
+        .str.normalize('NFKD')
+        .str.encode('ascii', errors='ignore')
+        .str.decode('ascii')
+        .str.lower()
+        .str.replace(r'[^\w\s]', ' ', regex=True)
+        .str.split()
+        .str.join(' ')
+    )
+
+
+def read_corrections(path):
+    """Lee y valida la tabla de correcciones.
+
+    Raises:
+        ValueError: si faltan columnas, hay tipos de coincidencia desconocidos o
+            claves repetidas (una misma clave con dos correcciones).
+    """
+    corrections = pandas.read_csv(path, dtype='str', keep_default_na=False)
+    missing = set(CORRECTIONS_COLUMNS) - set(corrections.columns)
+    if missing:
+        raise ValueError(f"Faltan columnas en la tabla de correcciones {path}: {sorted(missing)}")
+    corrections = corrections[CORRECTIONS_COLUMNS]
+
+    unknown = set(corrections['coincidencia']) - {MATCH_EXACT, MATCH_NORMALIZED}
+    if unknown:
+        raise ValueError(
+            f"Tipo de coincidencia desconocido en {path}: {sorted(unknown)}. "
+            f"Valores posibles: {[MATCH_EXACT, MATCH_NORMALIZED]}")
+
+    keys = corrections['original'].where(
+        corrections['coincidencia'] == MATCH_EXACT,
+        normalize_address(corrections['original']))
+    duplicated = keys.duplicated(keep=False) & (
+        corrections.groupby([corrections['coincidencia'], keys])['corregido'].transform('nunique') > 1)
+    if duplicated.any():
+        raise ValueError(
+            f"Reglas contradictorias en {path}: {corrections.loc[duplicated, 'original'].tolist()}")
+    return corrections.reset_index(drop=True)
+
+
+def _rule_lookup(keys, rule_keys):
+    """Posición de la primera regla con cada clave de `keys` (-1 si no hay)."""
+    first_rule = pandas.Series(
+        numpy.arange(len(rule_keys)), index=rule_keys.to_numpy())
+    first_rule = first_rule[~first_rule.index.duplicated()]
+    return first_rule.reindex(keys.to_numpy()).fillna(-1).to_numpy(dtype=int)
+
+
+def apply_corrections(addresses, corrections):
+    """Aplica la tabla de correcciones a una columna de domicilios.
+
+    Args:
+        - addresses (pandas.Series): Domicilios.
+        - corrections (pandas.DataFrame): Tabla leída con `read_corrections`.
+
+    Returns:
+        - corrected (pandas.Series): Domicilios corregidos (mismo índice, tipo str).
+        - report (pandas.DataFrame): La tabla de correcciones con `filas_coincidentes`
+            (filas en las que se aplicó la regla) y `filas_corregidas` (filas cuyo
+            valor cambió).
+    """
+    codes, uniques = pandas.factorize(addresses)
+    uniques = pandas.Series(uniques, dtype='str')
+
+    is_exact = (corrections['coincidencia'] == MATCH_EXACT).to_numpy()
+    exact_rules = numpy.flatnonzero(is_exact)
+    normalized_rules = numpy.flatnonzero(~is_exact)
+
+    # regla aplicada a cada domicilio distinto: primero las exactas
+    rule_by_unique = numpy.full(len(uniques), -1)
+    if len(exact_rules):
+        found = _rule_lookup(uniques, corrections['original'].iloc[exact_rules])
+        rule_by_unique = numpy.where(found >= 0, exact_rules[found], -1)
+    if len(normalized_rules):
+        found = _rule_lookup(
+            normalize_address(uniques),
+            normalize_address(corrections['original'].iloc[normalized_rules]))
+        rule_by_unique = numpy.where(
+            (rule_by_unique < 0) & (found >= 0), normalized_rules[found], rule_by_unique)
+
+    corrected_uniques = uniques.to_numpy(dtype=object).copy()
+    has_rule = rule_by_unique >= 0
+    corrected_uniques[has_rule] = corrections['corregido'].to_numpy(dtype=object)[rule_by_unique[has_rule]]
+    changed_unique = has_rule & (corrected_uniques != uniques.to_numpy(dtype=object))
+
+    # filas: un solo take sobre los códigos (los faltantes, código -1, quedan igual)
+    valid = codes >= 0
+    corrected = pandas.Series(
+        numpy.where(valid, corrected_uniques[numpy.where(valid, codes, 0)], None),
+        index=addresses.index, dtype='str', name=addresses.name)
+
+    row_rules = rule_by_unique[codes[valid]]
+    row_changed = changed_unique[codes[valid]]
+    report = corrections.copy()
+    report['filas_coincidentes'] = numpy.bincount(
+        row_rules[row_rules >= 0], minlength=len(corrections))
+    report['filas_corregidas'] = numpy.bincount(
+        row_rules[row_changed], minlength=len(corrections))
+    return corrected, report
+
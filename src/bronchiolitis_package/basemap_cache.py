@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+Cache de capas base (GeoTIFF) ya reproyectadas al crs de los mapas.
+
+`contextily.add_basemap` con un archivo local recorta el raster a la extensión del eje
+y lo reproyecta al crs del mapa en cada llamada. Acá ese resultado se guarda una vez
+como un array `.npy` (alto, ancho, bandas) con un `.json` al lado con la extensión, y
+las figuras siguientes lo cargan con `numpy.load(mmap_mode='r')` y lo dibujan con
+`imshow`, sin volver a abrir el GeoTIFF.
+
+Además del raster a resolución completa se guardan versiones reducidas (`BASEMAP_TIERS`,
+lado mayor en píxeles). Cada figura usa la menor que cubre los píxeles del eje al dpi
+con que se guarda, de modo que los insets y las figuras chicas no cargan el raster
+completo. Las versiones reducidas se obtienen del raster completo ya reproyectado.
+
+La clave es el hash del GeoTIFF (con el mismo registro de tamaño y fecha de
+modificación que `tracts_cache`), el crs, la extensión y la resolución.
+"""
+import json
+import os
+
+import contextily
+import numpy
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.mask import mask as rasterio_mask
+from rasterio.transform import from_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import reproject, transform_bounds
+
+from bronchiolitis_package import cache_utils
+
+BASEMAP_CACHE_VERSION = 1
+
+# lado mayor (en píxeles) de las versiones reducidas; None es la resolución completa
+BASEMAP_TIERS = (1024, 2048, 4096)
+
+# los mapas del pipeline se guardan a 300 dpi
+DEFAULT_DPI = 300
+
+# mismos parámetros que `contextily.add_basemap`
+INTERPOLATION = 'bilinear'
+WARP_RESAMPLING = Resampling.bilinear
+
+# decimales de la extensión en la clave (las extensiones vienen de `ax.axis()`)
+EXTENT_DECIMALS = 6
+
+
+def warp_basemap(source, crs, extent):
+    """Recorta el raster a `extent` y lo reproyecta a `crs`, como `contextily.add_basemap`.
+
+    Args:
+        - source (str): GeoTIFF.
+        - crs (str): crs del mapa.
+        - extent (tuple): xmin, xmax, ymin, ymax del eje, en `crs`.
+
+    Returns:
+        - image (numpy.ndarray): (alto, ancho, bandas).
+        - image_extent (tuple): izquierda, derecha, abajo, arriba de la imagen, en `crs`.
+    """
+    xmin, xmax, ymin, ymax = extent
+    with rasterio.open(source) as raster:
+        left, bottom, right, top = transform_bounds(crs, raster.crs, xmin, ymin, xmax, ymax)
+        window = [{
+            'type': 'Polygon',
+            'coordinates': ((
+                (left, bottom), (right, bottom), (right, top), (left, top), (left, bottom),
+            ),),
+        }]
+        image, transform = rasterio_mask(raster, window, crop=True)
+        image_extent = left, right, bottom, top
+        if raster.crs != crs:
+            bands, height, width = image.shape
+            with MemoryFile() as memfile:
+                with memfile.open(
+                        driver='GTiff', height=height, width=width, count=bands,
+                        dtype=str(image.dtype.name), crs=raster.crs,
+                        transform=transform) as memraster:
+                    memraster.write(image)
+                with memfile.open() as memraster:
+                    with WarpedVRT(memraster, crs=crs, resampling=WARP_RESAMPLING) as vrt:
+                        image = vrt.read()
+                        bounds = vrt.bounds
+            image_extent = bounds.left, bounds.right, bounds.bottom, bounds.top
+    return image.transpose(1, 2, 0), image_extent
+
+
+def downsample(image, image_extent, crs, max_side):
+    """Reduce la imagen a `max_side` píxeles de lado mayor (promedio), misma extensión."""
+    height, width, bands = image.shape
+    factor = max_side / max(height, width)
+    if factor >= 1:
+        return image
+    new_height = max(1, int(round(height * factor)))
+    new_width = max(1, int(round(width * factor)))
+    left, right, bottom, top = image_extent
+    reduced = numpy.empty((bands, new_height, new_width), dtype=image.dtype)
+    reproject(
+        numpy.ascontiguousarray(image.transpose(2, 0, 1)),
+        reduced,
+        src_transform=from_bounds(left, bottom, right, top, width, height),
+        dst_transform=from_bounds(left, bottom, right, top, new_width, new_height),
+        src_crs=crs, dst_crs=crs,
+        resampling=Resampling.average
+    )
+    return reduced.transpose(1, 2, 0)
+
+
+def get_tier(ax, dpi=DEFAULT_DPI):
+    """Menor resolución de `BASEMAP_TIERS` que cubre el eje al guardarlo con `dpi`
+    (None si ninguna alcanza)."""
+    bbox = ax.get_window_extent()
+    pixels = max(bbox.width, bbox.height) * dpi / ax.figure.dpi
+    for tier in BASEMAP_TIERS:
+        if tier >= pixels:
+            return tier
+    return None
+
+
+def _cache_paths(cache_dir, key):
+    return os.path.join(cache_dir, f'{key}.npy'), os.path.join(cache_dir, f'{key}.json')
+
+
+def _read_cached(cache_dir, key):
+    image_path, meta_path = _cache_paths(cache_dir, key)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as infile:
+        meta = json.load(infile)
+    return numpy.load(image_path, mmap_mode='r'), tuple(meta['extent'])
+
+
+def _write_cached(cache_dir, key, image, image_extent):
+    image_path, meta_path = _cache_paths(cache_dir, key)
+    cache_utils.atomic_write(
+        image_path, lambda tmp_path: numpy.save(tmp_path, image), suffix='.npy')
+
+    def write_meta(tmp_path):
+        with open(tmp_path, 'w') as outfile:
+            json.dump({'extent': list(image_extent), 'shape': list(image.shape)}, outfile)
+    # el json se escribe último: si existe, el array está completo
+    cache_utils.atomic_write(meta_path, write_meta, suffix='.json')
+
+
+def get_basemap(source, crs, extent, cache_dir, tier=None):
+    """Raster reproyectado (memory-mapped) para `crs` y `extent`, del cache si existe.
+
+    Args:
+        - tier (int or None): Lado mayor en píxeles (ver `BASEMAP_TIERS`). None: completo.
+
+    Returns:
+        - image (numpy.memmap): (alto, ancho, bandas).
+        - image_extent (tuple): izquierda, derecha, abajo, arriba.
+    """
+    source_hash, = cache_utils.get_file_hashes([source], cache_dir)
+    extent = [round(float(value), EXTENT_DECIMALS) for value in extent]
+    full_key = cache_utils.hash_key(BASEMAP_CACHE_VERSION, source_hash, crs, extent, None)
+    key = cache_utils.hash_key(BASEMAP_CACHE_VERSION, source_hash, crs, extent, tier)
+
+    cached = _read_cached(cache_dir, key)
+    if cached is not None:
+        return cached
+
+    full = _read_cached(cache_dir, full_key)
+    if full is None:
+        _write_cached(cache_dir, full_key, *warp_basemap(source, crs, extent))
+        full = _read_cached(cache_dir, full_key)
+    if tier is None:
+        return full
+
+    image, image_extent = full
+    _write_cached(cache_dir, key, downsample(image, image_extent, crs, tier), image_extent)
+    return _read_cached(cache_dir, key)
+
+
+def add_basemap(ax, source, crs, cache_dir=None, tier='auto', dpi=DEFAULT_DPI):
+    """Dibuja la capa base en `ax` (como `contextily.add_basemap` con un archivo local).
+
+    Args:
+        - source (str): GeoTIFF.
+        - crs (str): crs del mapa.
+        - cache_dir (str or None): Directorio del cache. None llama a contextily.
+        - tier (int, None or 'auto'): Resolución (ver `get_basemap`). 'auto' elige según
+            el tamaño del eje y `dpi` (ver `get_tier`).
+        - dpi (int): dpi con el que se guarda la figura.
+    """
+    if cache_dir is None:
+        contextily.add_basemap(ax, source=source, crs=crs)
+        return
+
+    xmin, xmax, ymin, ymax = ax.axis()
+    if tier == 'auto':
+        tier = get_tier(ax, dpi=dpi)
+    image, image_extent = get_basemap(source, crs, (xmin, xmax, ymin, ymax), cache_dir, tier=tier)
+    blit_basemap(ax, image, image_extent, (xmin, xmax, ymin, ymax))
+
+
+def blit_basemap(ax, image, image_extent, axis_extent):
+    """Dibuja una capa base ya reproyectada y deja el eje en `axis_extent`."""
+    if image.shape[2] == 1:
+        image = image[:, :, 0]
+    ax.imshow(
+        image,
+        extent=image_extent,
+        interpolation=INTERPOLATION,
+        aspect=ax.get_aspect()
+    )
+    ax.axis(axis_extent)
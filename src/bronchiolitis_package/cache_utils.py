@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Utilidades compartidas por los caches en disco del pipeline.
+
+Los caches se indexan por contenido (hash) y no por nombre de archivo, de modo que
+distintos builds del pipeline (o distintas tareas del mismo build) que trabajan
+sobre la misma capa reutilizan los resultados.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+import shapely
+
+SOURCES_FILENAME = 'sources.json'
+
+
+def geometry_hash(geometries):
+    """Hash sha256 de una columna de geometrías (y su crs).
+
+    Args:
+        geometries (geopandas.GeoSeries): Columna de geometrías.
+
+    Returns:
+        str: hexdigest. Cambia si cambia cualquier geometría, su orden o el crs.
+    """
+    hasher = hashlib.sha256()
+    crs = geometries.crs.to_string() if geometries.crs is not None else ''
+    hasher.update(crs.encode('utf-8'))
+    for wkb in shapely.to_wkb(geometries.values, hex=False):
+        hasher.update(b'\x00' if wkb is None else wkb)
+    return hasher.hexdigest()
+
+
+def hash_key(*parts):
+    """Combina partes serializables a json en una clave sha256."""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def atomic_write(path, write_func, suffix=''):
+    """Escribe `path` a través de un archivo temporal en el mismo directorio.
+
+    Evita dejar archivos de cache a medio escribir si el proceso se interrumpe o si
+    dos tareas escriben la misma clave a la vez.
+
+    Args:
+        path (str): Destino final.
+        write_func (callable): Recibe la ruta temporal y escribe en ella.
+        suffix (str): Extensión del archivo temporal (algunos writers la requieren).
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=suffix)
+    os.close(fd)
+    try:
+        write_func(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def file_hash(path, size=None):
+    """sha256 de los primeros `size` bytes de `path` (todo el archivo si es None)."""
+    hasher = hashlib.sha256()
+    remaining = os.path.getsize(path) if size is None else size
+    with open(path, 'rb') as infile:
+        while remaining > 0:
+            block = infile.read(min(remaining, 1 << 20))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher.hexdigest()
+
+
+def _load_sources(cache_dir):
+    path = os.path.join(cache_dir, SOURCES_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as infile:
+        return json.load(infile)
+
+
+def _save_sources(cache_dir, sources):
+    def write(tmp_path):
+        with open(tmp_path, 'w') as outfile:
+            json.dump(sources, outfile, indent=2, sort_keys=True)
+    atomic_write(os.path.join(cache_dir, SOURCES_FILENAME), write, suffix='.json')
+
+
+def get_file_hashes(paths, cache_dir):
+    """sha256 de cada archivo de `paths`, reutilizando el guardado en
+    `<cache_dir>/sources.json` si no cambiaron el tamaño ni la fecha de modificación."""
+    sources = _load_sources(cache_dir)
+    changed = False
+    hashes = []
+    for path in paths:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = sources.get(path)
+        if known is None or known['size'] != stat.st_size or known['mtime_ns'] != stat.st_mtime_ns:
+            known = {
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'sha256': file_hash(path),
+            }
+            sources[path] = known
+            changed = True
+        hashes.append(known['sha256'])
+    if changed:
+        _save_sources(cache_dir, sources)
+    return hashes
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Cubo espacio-temporal de casos: radio x temporada x semana epidemiológica.
+
+La temporada es el año de ingreso y la semana la SE del registro (igual que las
+particiones de `ingest`); la semana 0 agrupa los registros sin SE. El cubo es denso,
+con un eje más que separa primeras internaciones de reinternaciones:
+
+    counts[radio, temporada, semana, tipo]      tipo 0: internación, 1: reinternación
+
+Se construye con un único `numpy.bincount` sobre el índice aplanado de cada par
+(punto, radio). Los pares salen de `spatial_utils.get_point_tract_pairs`, con la misma
+semántica `intersects` que el conteo total de `get_cases_for_each_circuit`: sumado
+sobre el tiempo, el cubo da la columna `casos`.
+
+Se guarda en un `.npz` sin pickle. Las consultas por ventana usan sumas acumuladas
+sobre el eje temporal (temporada, semana), así que cualquier ventana cuesta una resta
+por radio.
+"""
+import numpy
+import pandas
+
+from bronchiolitis_package import cache_utils
+from bronchiolitis_package import spatial_utils
+
+CASE_CUBE_VERSION = 1
+
+# semanas epidemiológicas 1..53, más la 0 para registros sin SE
+N_WEEKS = 54
+
+ADMISSION = 0
+READMISSION = 1
+
+
+def get_seasons_and_weeks(points):
+    """Temporada (año de ingreso, -1 si falta) y SE (0 si falta) de cada punto."""
+    season = pandas.to_datetime(points['ingreso'], errors='coerce').dt.year.fillna(-1).astype(int)
+    week = pandas.to_numeric(points['se'], errors='coerce').fillna(0).astype(int)
+    week = week.where((week >= 0) & (week < N_WEEKS), 0)
+    return season.to_numpy(), week.to_numpy()
+
+
+class CaseCube:
+    """Cubo de casos (ver docstring del módulo)."""
+
+    def __init__(self, counts, ids, seasons, id_column='toponimo_i'):
+        self.counts = counts
+        self.ids = numpy.asarray(ids).astype(str)
+        self.seasons = numpy.asarray(seasons, dtype=numpy.int64)
+        self.id_column = id_column
+        self._cumulative = None
+
+    @classmethod
+    def build(cls, points_gdf, tracts_gdf, id_column='toponimo_i', topology=None):
+        """Construye el cubo de `points_gdf` sobre `tracts_gdf` (mismo crs).
+
+        Los puntos sin fecha de ingreso no tienen temporada y quedan fuera del cubo.
+
+        Args:
+            - points_gdf (geopandas.GeoDataFrame): Casos con `ingreso`, `se` y
+                `es_reinternacion`.
+            - tracts_gdf (geopandas.GeoDataFrame): Radios censales.
+            - topology (tract_topology.TractTopology or None): Ver
+                `spatial_utils.get_point_tract_pairs`.
+        """
+        point_positions, tract_positions = spatial_utils.get_point_tract_pairs(
+            points_gdf, tracts_gdf, topology=topology)
+
+        season, week = get_seasons_and_weeks(points_gdf)
+        kind = points_gdf['es_reinternacion'].fillna(False).to_numpy(dtype=bool).astype(int)
+        seasons = numpy.unique(season[season >= 0])
+
+        dated = season[point_positions] >= 0
+        point_positions, tract_positions = point_positions[dated], tract_positions[dated]
+        season_positions = numpy.searchsorted(seasons, season[point_positions])
+
+        shape = (len(tracts_gdf), len(seasons), N_WEEKS, 2)
+        flat = numpy.ravel_multi_index(
+            (tract_positions, season_positions, week[point_positions], kind[point_positions]),
+            shape)
+        counts = numpy.bincount(flat, minlength=numpy.prod(shape)).reshape(shape)
+        counts = counts.astype(numpy.min_scalar_type(counts.max(initial=0)))
+        return cls(counts, tracts_gdf[id_column], seasons, id_column=id_column)
+
+    def save(self, path):
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as outfile:
+                numpy.savez_compressed(
+                    outfile,
+                    version=CASE_CUBE_VERSION,
+                    counts=self.counts,
+                    ids=self.ids,
+                    seasons=self.seasons,
+                    id_column=numpy.array(self.id_column)
+                )
+        cache_utils.atomic_write(str(path), write, suffix='.npz')
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(str(path), allow_pickle=False) as stored:
+            if int(stored['version']) != CASE_CUBE_VERSION:
+                raise ValueError(
+                    f"Versión de cubo no soportada en {path}: {int(stored['version'])} "
+                    f"(se esperaba {CASE_CUBE_VERSION})")
+            return cls(
+                stored['counts'], stored['ids'], stored['seasons'],
+                id_column=str(stored['id_column']))
+
+    #
+    # consultas
+    #
+
+    def _kinds(self, readmissions):
+        """Tipos a sumar: None todos, True sólo reinternaciones, False sólo internaciones."""
+        if readmissions is None:
+            return [ADMISSION, READMISSION]
+        return [READMISSION] if readmissions else [ADMISSION]
+
+    def _season_position(self, season):
+        position = numpy.searchsorted(self.seasons, season)
+        if position >= len(self.seasons) or self.seasons[position] != season:
+            raise ValueError(
+                f"Temporada sin datos: {season}. Temporadas: {self.seasons.tolist()}")
+        return position
+
+    def _time_position(self, season, week):
+        if not 0 <= week < N_WEEKS:
+            raise ValueError(f"SE fuera de rango: {week}")
+        return self._season_position(season) * N_WEEKS + week
+
+    def _get_cumulative(self):
+        """Sumas acumuladas (radio, tiempo + 1, tipo), con el tiempo aplanado
+        (temporada, semana)."""
+        if self._cumulative is None:
+            n_tracts = self.counts.shape[0]
+            flat = self.counts.reshape(n_tracts, -1, 2).astype(numpy.int64)
+            cumulative = numpy.zeros((n_tracts, flat.shape[1] + 1, 2), dtype=numpy.int64)
+            numpy.cumsum(flat, axis=1, out=cumulative[:, 1:])
+            self._cumulative = cumulative
+        return self._cumulative
+
+    def get_window(self, start, end, readmissions=None):
+        """Casos por radio entre dos semanas (inclusive), aunque sean de temporadas distintas.
+
+        Args:
+            - start, end (tuple): (temporada, SE) de la primera y última semana.
+            - readmissions (bool or None): None cuenta todos los casos, True sólo
+                reinternaciones, False sólo internaciones.
+
+        Returns:
+            numpy.ndarray: casos por radio, en el orden de `ids`.
+        """
+        first = self._time_position(*start)
+        last = self._time_position(*end)
+        if last < first:
+            raise ValueError(f"Ventana vacía: {start} es posterior a {end}")
+        cumulative = self._get_cumulative()
+        kinds = self._kinds(readmissions)
+        return (cumulative[:, last + 1, kinds] - cumulative[:, first, kinds]).sum(axis=1)
+
+    def get_weekly_counts(self, season, weeks=None, readmissions=None):
+        """Matriz radio x semana de una temporada.
+
+        Args:
+            - weeks (slice, list or None): Semanas a devolver (por SE). None: 1..53.
+        """
+        if weeks is None:
+            weeks = slice(1, N_WEEKS)
+        counts = self.counts[:, self._season_position(season), weeks]
+        return counts[..., self._kinds(readmissions)].sum(axis=-1)
+
+    def get_season_counts(self, readmissions=None):
+        """Matriz radio x temporada (incluye los registros sin SE)."""
+        return self.counts[..., self._kinds(readmissions)].sum(axis=(2, 3))
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Pool de procesos para renderizar figuras (PNG a 300 dpi) en paralelo.
+
+Un trabajo es una función importable que dibuja y guarda una figura (por ejemplo una
+tarea de `tasks.spatial_vis`) con sus argumentos por nombre; los argumentos se envían
+a otro proceso, así que deben ser serializables (rutas como str, no productos).
+
+Los procesos del pool:
+    - se crean con 'spawn' y usan el backend Agg (se fuerza antes de importar pyplot),
+      sin heredar el estado de matplotlib del proceso que los lanza;
+    - importan matplotlib, geopandas y contextily una sola vez, al iniciar: los
+      trabajos no pagan esas importaciones;
+    - tienen un presupuesto de memoria (`RLIMIT_AS`): una figura que lo excede falla
+      con MemoryError en ese proceso en vez de llevar la máquina a swap. La cantidad
+      de procesos se limita además a la memoria disponible dividida por el presupuesto;
+    - cierran todas las figuras después de cada trabajo.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# es un límite de espacio de direcciones (memoria virtual), bastante mayor que la
+# residente: un mapa de 12x12 pulgadas a 300 dpi con capa base llega a ~3.6 GB virtuales
+# (~1.9 GB residentes)
+DEFAULT_MEMORY_BUDGET_MB = 6144
+
+MB = 1024 ** 2
+
+
+def get_available_memory():
+    """Memoria disponible en bytes (None si el sistema no la informa).
+
+    Es `MemAvailable` de /proc/meminfo (incluye el cache de páginas que el kernel puede
+    liberar, a diferencia de la memoria libre). Si no está, se usa la memoria física total.
+    """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_n_workers(n_workers, n_jobs, memory_budget_mb=None):
+    """Procesos a usar: `n_workers` (-1 todos los núcleos), sin superar la cantidad de
+    trabajos ni los presupuestos de memoria que entran en la memoria disponible."""
+    if n_workers == -1:
+        n_workers = os.cpu_count()
+    n_workers = min(n_workers, n_jobs)
+    available = get_available_memory()
+    if memory_budget_mb is not None and available is not None:
+        n_workers = min(n_workers, available // (memory_budget_mb * MB))
+    return max(1, n_workers)
+
+
+def _init_worker(memory_budget_mb):
+    os.environ['MPLBACKEND'] = 'Agg'
+    # las figuras no usan BLAS: un hilo por proceso
+    for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ.setdefault(variable, '1')
+
+    if memory_budget_mb is not None:
+        import resource
+        limit = memory_budget_mb * MB
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot  # noqa: F401
+    import geopandas  # noqa: F401
+    import contextily  # noqa: F401
+
+
+def _render(job):
+    import matplotlib.pyplot as plt
+    function, kwargs = job
+    try:
+        return function(**kwargs)
+    finally:
+        plt.close('all')
+
+
+def render_figures(jobs, n_workers=1, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """Ejecuta los trabajos de figuras, en paralelo si `n_workers` > 1.
+
+    Args:
+        - jobs (list): Tuplas (función, kwargs). La función debe poder importarse
+            desde su módulo (no lambdas ni funciones anidadas).
+        - n_workers (int, default=1): Procesos a usar. -1 usa todos los núcleos. Con
+            1 los trabajos se ejecutan en este proceso.
+        - memory_budget_mb (int or None): Memoria máxima de cada proceso (MB). None:
+            sin límite.
+
+    Returns:
+        list: Lo que devuelve cada función, en el orden de `jobs`. Si un trabajo falla,
+            se propaga su excepción.
+    """
+    jobs = list(jobs)
+    n_workers = get_n_workers(n_workers, len(jobs), memory_budget_mb)
+    if n_workers == 1:
+        return [_render(job) for job in jobs]
+
+    with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(memory_budget_mb,)) as executor:
+        try:
+            return list(executor.map(_render, jobs))
+        except BrokenProcessPool as error:
+            raise RuntimeError(
+                "Un proceso del pool de figuras terminó abruptamente (¿presupuesto de "
+                f"memoria insuficiente? {memory_budget_mb} MB por proceso)") from error
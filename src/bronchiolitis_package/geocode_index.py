@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Índice de geocodificación de domicilios (domicilio -> latitud, longitud).
+
+Cada domicilio del dataset de domicilios se indexa por una forma normalizada: sin
+tildes, en minúsculas, sin puntuación, con las abreviaturas de calle expandidas
+(`STREET_ABBREVIATIONS`) y con la altura separada de la calle. La búsqueda es en
+cascada, y cada etapa es un lookup O(1) en un diccionario:
+
+    1. exacta       el domicilio es igual al del dataset
+    2. normalizada  coincide la forma normalizada (calle + altura)
+    3. fonetica     coincide la calle con plegado fonético (z/s, v/b, ll/y, h muda) y la altura
+    4. aproximada   entre los domicilios con la misma altura, el de calle más parecida:
+                    iniciales compatibles ("M.A. Zar" ~ "Marcos A. Zar") o similitud
+                    >= `FUZZY_THRESHOLD`. Si hay dos candidatos igual de parecidos no se asigna.
+
+La tabla del índice se guarda en un parquet en `cache_dir`, indexada por el hash del
+csv de domicilios, de modo que los builds siguientes no vuelven a leer ni normalizar
+el csv.
+"""
+import difflib
+import os
+import re
+
+import numpy
+import pandas
+
+from bronchiolitis_package import address_corrections
+from bronchiolitis_package import cache_utils
+
+GEOCODE_INDEX_VERSION = 1
+
+FUZZY_THRESHOLD = .85
+
+MATCH_EXACT = 'exacta'
+MATCH_NORMALIZED = 'normalizada'
+MATCH_PHONETIC = 'fonetica'
+MATCH_FUZZY = 'aproximada'
+
+STREET_ABBREVIATIONS = {
+    'av': 'avenida',
+    'avda': 'avenida',
+    'bv': 'bulevar',
+    'bvd': 'bulevar',
+    'bvard': 'bulevar',
+    'cap': 'capitan',
+    'cnel': 'coronel',
+    'cmte': 'comandante',
+    'cte': 'comandante',
+    'dr': 'doctor',
+    'gdor': 'gobernador',
+    'gob': 'gobernador',
+    'gral': 'general',
+    'hno': 'hermano',
+    'hnos': 'hermanos',
+    'ing': 'ingeniero',
+    'int': 'intendente',
+    'pje': 'pasaje',
+    'psje': 'pasaje',
+    'pres': 'presidente',
+    'pte': 'presidente',
+    'sgto': 'sargento',
+    'sta': 'santa',
+    'sto': 'santo',
+    'tte': 'teniente',
+}
+
+# plegado fonético (español rioplatense), aplicado en orden
+PHONETIC_FOLDS = [
+    (re.compile(r'(?<!c)h'), ''),
+    (re.compile(r'll'), 'y'),
+    (re.compile(r'c([ei])'), r's\1'),
+    (re.compile(r'z'), 's'),
+    (re.compile(r'v'), 'b'),
+    (re.compile(r'(\w)\1'), r'\1'),
+]
+
+NUMBER_PATTERN = re.compile(r'^(?P<street>.*?)\s*(?P<number>\d+)$')
+
+INDEX_COLUMNS = ['domicilio', 'calle', 'altura', 'calle_fonetica', 'latitud', 'longitud']
+
+LAT_COLUMN = 'latitud'
+LNG_COLUMN = 'longitud'
+
+
+def read_addresses_latlong(csv_path):
+    """Domicilios con latitud y longitud, ordenados de norte a sur y de este a oeste."""
+    domicilio_latlong = pandas.read_csv(csv_path)
+
+    ## rename columns (lowercase):
+    domicilio_latlong = domicilio_latlong.rename(
+        columns={
+            column: column.lower().replace(' ', '_')
+            for column
+            in domicilio_latlong.columns
+        }
+    )
+
+    ## sort from north to south, east to west:
+    sorted_index_values = (domicilio_latlong[LAT_COLUMN] ** 2 + domicilio_latlong[LNG_COLUMN] **2).sort_values().index
+    domicilio_latlong = domicilio_latlong.iloc[sorted_index_values]
+
+    ## delete duplicates:
+    domicilio_latlong = domicilio_latlong.drop_duplicates()
+    return domicilio_latlong.reset_index(drop=True)
+
+
+def split_address(normalized):
+    """Separa calle y altura de un domicilio normalizado ('' si no tiene altura)."""
+    match = NUMBER_PATTERN.match(normalized)
+    if match is None:
+        return normalized, ''
+    return match.group('street'), str(int(match.group('number')))
+
+
+def normalize_street(street):
+    return ' '.join(STREET_ABBREVIATIONS.get(token, token) for token in street.split())
+
+
+def phonetic_street(street):
+    for pattern, replacement in PHONETIC_FOLDS:
+        street = pattern.sub(replacement, street)
+    return street
+
+
+def get_address_keys(addresses):
+    """Calle normalizada, altura y calle fonética de cada domicilio.
+
+    Args:
+        addresses (pandas.Series): Domicilios.
+
+    Returns:
+        pandas.DataFrame: columnas `calle`, `altura` y `calle_fonetica`.
+    """
+    normalized = address_corrections.normalize_address(addresses)
+    streets, numbers = zip(*map(split_address, normalized)) if len(normalized) else ((), ())
+    streets = [normalize_street(street) for street in streets]
+    return pandas.DataFrame({
+        'calle': streets,
+        'altura': list(numbers),
+        'calle_fonetica': [phonetic_street(street) for street in streets],
+    }, index=addresses.index, dtype='str')
+
+
+def build_index_table(domicilio_latlong):
+    """Tabla del índice a partir del dataset de domicilios (ver `read_addresses_latlong`).
+
+    Si un mismo domicilio aparece con distintas coordenadas se conserva el primero.
+    """
+    table = domicilio_latlong[['domicilio_definitivo', 'latitud', 'longitud']]
+    table = table.dropna(subset=['domicilio_definitivo'])
+    table = table.drop_duplicates(subset='domicilio_definitivo').reset_index(drop=True)
+    table = table.rename(columns={'domicilio_definitivo': 'domicilio'})
+    table = pandas.concat([table, get_address_keys(table['domicilio'])], axis=1)
+    return table[INDEX_COLUMNS]
+
+
+def get_geocode_index(addresses_csv_path, cache_dir=None):
+    """Índice para el csv de domicilios, leído del cache si ya fue construido.
+
+    Args:
+        - addresses_csv_path (str): Dataset de domicilios con latitud y longitud.
+        - cache_dir (str or None): Directorio del cache. None desactiva el cache.
+
+    Returns:
+        GeocodeIndex
+    """
+    if cache_dir is None:
+        return GeocodeIndex(build_index_table(read_addresses_latlong(addresses_csv_path)))
+
+    key = cache_utils.hash_key(
+        GEOCODE_INDEX_VERSION, cache_utils.file_hash(addresses_csv_path), STREET_ABBREVIATIONS)
+    cache_path = os.path.join(cache_dir, f'{key}.parquet')
+    if os.path.exists(cache_path):
+        return GeocodeIndex(pandas.read_parquet(cache_path))
+
+    table = build_index_table(read_addresses_latlong(addresses_csv_path))
+    cache_utils.atomic_write(
+        cache_path,
+        lambda tmp_path: table.to_parquet(tmp_path, index=False),
+        suffix='.parquet'
+    )
+    return GeocodeIndex(table)
+
+
+def _initials_match(query_tokens, candidate_tokens):
+    """Mismas palabras, salvo iniciales que coinciden con la palabra completa."""
+    if len(query_tokens) != len(candidate_tokens):
+        return False
+    for query, candidate in zip(query_tokens, candidate_tokens):
+        if query == candidate:
+            continue
+        if len(query) == 1 and candidate.startswith(query):
+            continue
+        if len(candidate) == 1 and query.startswith(candidate):
+            continue
+        return False
+    return True
+
+
+class GeocodeIndex:
+    """Índice en memoria: diccionarios por domicilio, clave normalizada, clave fonética
+    y altura (ver docstring del módulo)."""
+
+    def __init__(self, table):
+        self.table = table.reset_index(drop=True)
+        positions = range(len(self.table))
+        self.by_address = self._first_position(self.table['domicilio'], positions)
+        self.by_key = self._first_position(
+            self.table['calle'] + '|' + self.table['altura'], positions)
+        self.by_phonetic_key = self._first_position(
+            self.table['calle_fonetica'] + '|' + self.table['altura'], positions)
+        self.by_number = {}
+        for position, number in zip(positions, self.table['altura']):
+            self.by_number.setdefault(number, []).append(position)
+
+    @staticmethod
+    def _first_position(keys, positions):
+        index = {}
+        for key, position in zip(keys, positions):
+            index.setdefault(key, position)
+        return index
+
+    def _fuzzy_lookup(self, street, phonetic, number):
+        """Mejor candidato con la misma altura: (posición o -1, similitud)."""
+        tokens = street.split()
+        best, best_score, tied = -1, 0., False
+        for position in self.by_number.get(number, ()):
+            candidate = self.table.at[position, 'calle']
+            if _initials_match(tokens, candidate.split()):
+                score = 1.
+            else:
+                score = difflib.SequenceMatcher(
+                    None, phonetic, self.table.at[position, 'calle_fonetica']).ratio()
+            if score > best_score:
+                best, best_score, tied = position, score, False
+            elif score == best_score and score > 0:
+                tied = True
+        if best_score < FUZZY_THRESHOLD or tied:
+            return -1, best_score
+        return best, best_score
+
+    def lookup(self, addresses):
+        """Geocodifica una columna de domicilios.
+
+        Las búsquedas se hacen una vez por domicilio distinto.
+
+        Returns:
+            pandas.DataFrame: con el índice de `addresses` y las columnas
+            `domicilio_geocodificado`, `latitud`, `longitud`, `geocodificacion`
+            (tipo de coincidencia, vacío si no se encontró) y `similitud`.
+        """
+        codes, uniques = pandas.factorize(addresses)
+        uniques = pandas.Series(uniques, dtype='str')
+        keys = get_address_keys(uniques)
+
+        positions = numpy.full(len(uniques), -1)
+        match_types = numpy.full(len(uniques), None, dtype=object)
+        scores = numpy.zeros(len(uniques))
+        for i, (address, street, number, phonetic) in enumerate(zip(
+                uniques, keys['calle'], keys['altura'], keys['calle_fonetica'])):
+            for match_type, index, key in (
+                    (MATCH_EXACT, self.by_address, address),
+                    (MATCH_NORMALIZED, self.by_key, f'{street}|{number}'),
+                    (MATCH_PHONETIC, self.by_phonetic_key, f'{phonetic}|{number}')):
+                if key in index:
+                    positions[i], match_types[i], scores[i] = index[key], match_type, 1.
+                    break
+            else:
+                positions[i], scores[i] = self._fuzzy_lookup(street, phonetic, number)
+                if positions[i] >= 0:
+                    match_types[i] = MATCH_FUZZY
+
+        found = positions >= 0
+        matched = self.table.iloc[positions[found]]
+        unique_results = pandas.DataFrame({
+            'domicilio_geocodificado': pandas.Series(index=range(len(uniques)), dtype='str'),
+            'latitud': numpy.nan,
+            'longitud': numpy.nan,
+            'geocodificacion': pandas.Series(match_types, dtype='str'),
+            'similitud': scores,
+        })
+        unique_results.loc[found, 'domicilio_geocodificado'] = matched['domicilio'].to_numpy()
+        unique_results.loc[found, 'latitud'] = matched['latitud'].to_numpy()
+        unique_results.loc[found, 'longitud'] = matched['longitud'].to_numpy()
+
+        # domicilios faltantes (código -1): sin geocodificar
+        unique_results.loc[len(uniques)] = [None, numpy.nan, numpy.nan, None, 0.]
+        results = unique_results.iloc[numpy.where(codes >= 0, codes, len(uniques))]
+        results.index = addresses.index
+        return results
+
+
+def get_unmatched_report(addresses, results):
+    """Domicilios sin geocodificar y la cantidad de filas de cada uno."""
+    unmatched = addresses[results['geocodificacion'].isna()]
+    report = unmatched.value_counts(dropna=False).rename_axis('domicilio').reset_index(name='filas')
+    return report.sort_values(['filas', 'domicilio'], ascending=[False, True], ignore_index=True)
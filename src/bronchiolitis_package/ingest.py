@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+"""
+Ingesta de las historias clínicas de bronquiolitis.
+
+Los domicilios se corrigen con la tabla externa de `address_corrections` y se
+geocodifican con el índice de `geocode_index`.
+
+Además de la ingesta completa (`get_bronchiolitis_points`), mantiene un store
+particionado por año de ingreso y semana epidemiológica (SE) con los registros ya
+procesados, para que los builds diarios sólo procesen lo nuevo:
+
+    <store>/
+        manifest.json          versión, estado del CSV fuente, hash de domicilios y
+                               hash de contenido / de flags de cada partición
+        records/<año>-<se>.parquet   registros limpios (antes del merge con domicilios)
+        points/<año>-<se>.parquet    registros con latitud y longitud
+
+Si el CSV sólo creció al final (caso habitual: se agregan las internaciones de la
+semana) se parsean sólo los bytes nuevos. Si no, se lee completo y se reprocesan sólo
+las particiones cuyo contenido cambió. `es_reinternacion` se recalcula siempre sobre
+todas las particiones (sólo columnas `hc` e `ingreso`), y se reescriben las particiones
+en las que cambió algún flag.
+
+La ingesta emite también los puntos ya proyectados al crs de la capa de radios, con el
+radio asignado a cada caso (`project_points`), para que las tareas siguientes no
+reproyecten todos los puntos.
+"""
+import hashlib
+import io
+import json
+import os
+
+import geopandas
+import numpy
+import pandas
+from pandas.api.types import union_categoricals
+
+from bronchiolitis_package import address_corrections
+from bronchiolitis_package import cache_utils
+from bronchiolitis_package import geocode_index
+from bronchiolitis_package import spatial_utils
+
+INGEST_STORE_VERSION = 5
+
+MEDICAL_RECORDS_COLUMNS = ['HC', 'INGRESO', 'EGRESO', 'SE', 'Edad', 'Domicilio definitivo']
+
+# esquema de las columnas usadas (el resto del export no se parsea)
+MEDICAL_RECORDS_DTYPES = {
+    'HC': 'str',
+    'SE': 'float64',
+    'Edad': 'float64',
+    'Domicilio definitivo': 'category',
+}
+MEDICAL_RECORDS_DATE_COLUMNS = ['INGRESO', 'EGRESO']
+
+# las fechas se parsean al leer (orden de reinternaciones, particiones) y el producto
+# de puntos las guarda como texto, con el tipo de siempre
+POINTS_DATE_FORMAT = '%Y-%m-%d'
+
+# filas por chunk del lector: acota la memoria con exports de varios GB
+MEDICAL_RECORDS_CHUNK_SIZE = 100_000
+
+# columnas de los registros limpios, en el orden del producto
+RECORD_COLUMNS = ['hc', 'ingreso', 'egreso', 'se', 'edad', 'domicilio_definitivo']
+
+LAT_COLUMN = geocode_index.LAT_COLUMN
+LNG_COLUMN = geocode_index.LNG_COLUMN
+
+
+def iter_medical_records(csv_file, chunksize=MEDICAL_RECORDS_CHUNK_SIZE):
+    """Lee las historias clínicas en chunks de `chunksize` filas, con el esquema declarado.
+
+    Sólo se parsean las columnas `MEDICAL_RECORDS_COLUMNS`, con los tipos de
+    `MEDICAL_RECORDS_DTYPES` y las fechas de ingreso y egreso como datetime. La HC se
+    convierte a entero: las que no son numéricas se descartan, igual que las vacías.
+
+    Yields:
+        pandas.DataFrame: chunk limpio (columnas `RECORD_COLUMNS`, sin registros sin HC).
+    """
+    reader = pandas.read_csv(
+        csv_file,
+        usecols=MEDICAL_RECORDS_COLUMNS,
+        dtype=MEDICAL_RECORDS_DTYPES,
+        chunksize=chunksize
+    )
+    with reader:
+        for chunk in reader:
+            chunk = chunk[MEDICAL_RECORDS_COLUMNS]
+            chunk['HC'] = pandas.to_numeric(chunk['HC'], errors='coerce')
+            ## eliminar aquellos que no tienen numero de historia clinica:
+            chunk = chunk.dropna(subset=['HC'])
+            chunk['HC'] = chunk['HC'].astype('int64')
+            for column in MEDICAL_RECORDS_DATE_COLUMNS:
+                chunk[column] = pandas.to_datetime(chunk[column], format='ISO8601', errors='coerce')
+            chunk.columns = chunk.columns.str.lower().str.replace(' ', '_')
+            yield chunk
+
+
+def read_medical_records(csv_file, chunksize=MEDICAL_RECORDS_CHUNK_SIZE):
+    """Lee y limpia las historias clínicas en una sola pasada (ver `iter_medical_records`).
+
+    Returns:
+        pandas.DataFrame: columnas `RECORD_COLUMNS`, sin registros sin HC, con los
+        domicilios como categóricos.
+    """
+    chunks = list(iter_medical_records(csv_file, chunksize=chunksize))
+    if not chunks:
+        return pandas.DataFrame({
+            column: pandas.Series(dtype=dtype)
+            for column, dtype in zip(RECORD_COLUMNS, _record_dtypes())
+        })
+    # cada chunk tiene sus propias categorías de domicilio: se unifican
+    addresses = union_categoricals(
+        [chunk['domicilio_definitivo'] for chunk in chunks], sort_categories=True)
+    df = pandas.concat(
+        [chunk.drop(columns='domicilio_definitivo') for chunk in chunks], ignore_index=True)
+    df['domicilio_definitivo'] = addresses
+    return df[RECORD_COLUMNS]
+
+
+def _record_dtypes():
+    dtypes = {
+        column.lower().replace(' ', '_'): dtype
+        for column, dtype in MEDICAL_RECORDS_DTYPES.items()
+    }
+    dtypes['hc'] = 'int64'
+    dtypes.update({column.lower(): 'datetime64[ns]' for column in MEDICAL_RECORDS_DATE_COLUMNS})
+    return [dtypes[column] for column in RECORD_COLUMNS]
+
+
+def flag_readmissions(records):
+    """`es_reinternacion`: la HC ya tuvo un ingreso anterior.
+
+    Los registros se ordenan por fecha de ingreso, como en `get_bronchiolitis_points`
+    (orden estable, por lo que los empates se resuelven según el orden de `records`).
+    """
+    order = records['ingreso'].reset_index(drop=True).sort_values(kind='stable').index.to_numpy()
+    flags = numpy.empty(len(records), dtype=bool)
+    flags[order] = records['hc'].iloc[order].duplicated().to_numpy()
+    return pandas.Series(flags, index=records.index, name='es_reinternacion')
+
+
+def merge_addresses(records, index, corrections):
+    """Corrige los domicilios y agrega latitud y longitud.
+
+    Los registros cuyo domicilio no se encuentra en el índice se descartan (y se
+    informan en `unmatched`).
+
+    Args:
+        - index (geocode_index.GeocodeIndex): Índice de domicilios.
+        - corrections (pandas.DataFrame): Ver `address_corrections.read_corrections`.
+
+    Returns:
+        - points_df (pandas.DataFrame): registros con `latitud`, `longitud`, el domicilio
+            del dataset con el que se geocodificó y el tipo de coincidencia.
+        - report (pandas.DataFrame): Ver `address_corrections.apply_corrections`.
+        - unmatched (pandas.DataFrame): Ver `geocode_index.get_unmatched_report`.
+    """
+    records = records.copy()
+    records['domicilio_definitivo'], report = address_corrections.apply_corrections(
+        records['domicilio_definitivo'], corrections)
+    results = index.lookup(records['domicilio_definitivo'])
+    unmatched = geocode_index.get_unmatched_report(records['domicilio_definitivo'], results)
+    points_df = pandas.concat([records, results], axis=1)
+    points_df = points_df[points_df['geocodificacion'].notna()].reset_index(drop=True)
+    return points_df, report, unmatched
+
+
+def to_points_gdf(points_df):
+    """Puntos en EPSG:4326, con las fechas como texto (`POINTS_DATE_FORMAT`)."""
+    points_df = points_df.copy()
+    for column in MEDICAL_RECORDS_DATE_COLUMNS:
+        points_df[column.lower()] = points_df[column.lower()].dt.strftime(POINTS_DATE_FORMAT)
+    return geopandas.GeoDataFrame(
+        points_df,
+        geometry=geopandas.points_from_xy(points_df[LNG_COLUMN], points_df[LAT_COLUMN]),
+        crs="EPSG:4326"
+    )
+
+
+def project_points(points_gdf, tracts_gdf, tract_id_column='toponimo_i', topology=None):
+    """Puntos en el crs de `tracts_gdf` con el id del radio asignado (`tract_id_column`).
+
+    El radio asignado es el de `spatial_utils.assign_points_to_tracts` (el primero si el
+    punto cae sobre un límite, NA fuera de los radios). Los conteos por radio mantienen
+    la semántica `intersects` con `spatial_utils.count_points_in_tracts` sobre estos
+    mismos puntos, sin reproyectar.
+
+    Args:
+        - topology (tract_topology.TractTopology or None): Ver
+            `spatial_utils.get_point_tract_pairs`.
+    """
+    projected = points_gdf.to_crs(tracts_gdf.crs)
+    projected[tract_id_column] = spatial_utils.assign_points_to_tracts(
+        projected, tracts_gdf, tract_id_column=tract_id_column, topology=topology
+    ).astype('string')
+    return projected
+
+
+def get_bronchiolitis_points(
+        medical_records_csv_path, addresses_csv_path, corrections_csv_path,
+        geocode_cache_dir=None
+    ):
+    """Ingesta completa: registros con `es_reinternacion`, latitud, longitud y geometría.
+
+    Returns:
+        - points_gdf (geopandas.GeoDataFrame)
+        - report (pandas.DataFrame): reglas de corrección de domicilios y filas afectadas.
+        - unmatched (pandas.DataFrame): domicilios sin geocodificar.
+    """
+    df = read_medical_records(medical_records_csv_path)
+    ## primero ordenamos por fecha de ingreso
+    df = df.sort_values(by='ingreso', kind='stable')
+    ## después de ordenar, si se repite el nro de historia clinica, es reinternación:
+    df['es_reinternacion'] = df['hc'].duplicated()
+    df = df.reset_index(drop=True)
+
+    output_df, report, unmatched = merge_addresses(
+        df,
+        geocode_index.get_geocode_index(addresses_csv_path, cache_dir=geocode_cache_dir),
+        address_corrections.read_corrections(corrections_csv_path)
+    )
+    return to_points_gdf(output_df), report, unmatched
+
+
+#
+# Store incremental
+#
+
+def get_partition_keys(records):
+    """Clave de partición `<año de ingreso>-<SE>` (0 si falta el dato)."""
+    year = pandas.to_datetime(records['ingreso'], errors='coerce').dt.year.fillna(0).astype(int)
+    se = pandas.to_numeric(records['se'], errors='coerce').fillna(0).astype(int)
+    return year.astype(str).str.zfill(4) + '-' + se.astype(str).str.zfill(2)
+
+
+def canonical_order(records):
+    """Orden determinístico de los registros de una partición (independiente del CSV)."""
+    return records.sort_values(
+        by=RECORD_COLUMNS, kind='stable', na_position='last').reset_index(drop=True)
+
+
+def content_hash(records):
+    row_hashes = pandas.util.hash_pandas_object(records[RECORD_COLUMNS], index=False)
+    return hashlib.sha256(row_hashes.to_numpy().tobytes()).hexdigest()
+
+
+def _read_appended_records(csv_path, offset):
+    """Registros agregados al final del CSV después de `offset` bytes."""
+    with open(csv_path, 'rb') as infile:
+        header = infile.readline()
+        infile.seek(offset)
+        tail = infile.read()
+    return read_medical_records(io.BytesIO(header + tail))
+
+
+def _is_append_only(csv_path, source_state):
+    """El CSV actual es el anterior con filas agregadas al final."""
+    if not source_state:
+        return False
+    size = source_state['size']
+    if os.path.getsize(csv_path) < size:
+        return False
+    with open(csv_path, 'rb') as infile:
+        infile.seek(size - 1)
+        if infile.read(1) != b'\n':
+            return False
+    return cache_utils.file_hash(csv_path, size) == source_state['sha256']
+
+
+class IngestStore:
+    """Store particionado de registros ya procesados (ver docstring del módulo)."""
+
+    def __init__(self, store_dir):
+        self.store_dir = str(store_dir)
+        self.manifest_path = os.path.join(self.store_dir, 'manifest.json')
+
+    def _path(self, kind, key):
+        return os.path.join(self.store_dir, kind, f'{key}.parquet')
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path) as infile:
+            manifest = json.load(infile)
+        if manifest.get('version') != INGEST_STORE_VERSION:
+            return None
+        return manifest
+
+    def save_manifest(self, manifest):
+        def write(tmp_path):
+            with open(tmp_path, 'w') as outfile:
+                json.dump(manifest, outfile, indent=2, sort_keys=True)
+        cache_utils.atomic_write(self.manifest_path, write, suffix='.json')
+
+    def read(self, kind, key, columns=None):
+        return pandas.read_parquet(self._path(kind, key), columns=columns)
+
+    def write(self, kind, key, df):
+        cache_utils.atomic_write(
+            self._path(kind, key),
+            lambda tmp_path: df.to_parquet(tmp_path, index=False),
+            suffix='.parquet'
+        )
+
+    def remove(self, key):
+        for kind in ('records', 'points'):
+            if os.path.exists(self._path(kind, key)):
+                os.remove(self._path(kind, key))
+
+    def update(
+            self, medical_records_csv_path, addresses_csv_path, corrections_csv_path,
+            geocode_cache_dir=None
+        ):
+        """Incorpora al store los registros nuevos o modificados del CSV.
+
+        Si cambian los domicilios o la tabla de correcciones se reprocesa todo.
+
+        Returns:
+            dict: resumen del build (modo de lectura, filas leídas y particiones
+            agregadas, modificadas, eliminadas y con flags actualizados).
+        """
+        manifest = self.load_manifest()
+        addresses_hash = cache_utils.hash_key(
+            geocode_index.GEOCODE_INDEX_VERSION, cache_utils.file_hash(addresses_csv_path))
+        corrections_hash = cache_utils.file_hash(corrections_csv_path)
+        if manifest is None \
+                or manifest['addresses_sha256'] != addresses_hash \
+                or manifest.get('corrections_sha256') != corrections_hash:
+            # sin store, o cambiaron los domicilios o las correcciones: se reprocesa todo
+            manifest = {'partitions': {}, 'source': None}
+        stored = manifest['partitions']
+
+        # 1. particiones con contenido nuevo
+        if _is_append_only(medical_records_csv_path, manifest['source']):
+            mode = 'append'
+            new_records = _read_appended_records(
+                medical_records_csv_path, manifest['source']['size'])
+            new_records['partition'] = get_partition_keys(new_records)
+            partitions = {}
+            for key, group in new_records.groupby('partition', sort=True):
+                group = group[RECORD_COLUMNS]
+                if key in stored:
+                    group = pandas.concat([self.read('records', key, columns=RECORD_COLUMNS), group])
+                partitions[key] = canonical_order(group)
+            removed = []
+        else:
+            mode = 'full'
+            all_records = read_medical_records(medical_records_csv_path)
+            all_records['partition'] = get_partition_keys(all_records)
+            partitions = {}
+            for key, group in all_records.groupby('partition', sort=True):
+                group = canonical_order(group[RECORD_COLUMNS])
+                # las particiones sin cambios no se reescriben
+                if key not in stored or stored[key]['sha256'] != content_hash(group):
+                    partitions[key] = group
+            removed = sorted(set(stored) - set(all_records['partition']))
+        new_rows = len(new_records) if mode == 'append' else len(all_records)
+
+        for key in removed:
+            self.remove(key)
+            del stored[key]
+
+        # 2. reinternaciones sobre todas las particiones (sólo hc e ingreso)
+        keys = sorted(set(stored) | set(partitions))
+        admissions = pandas.concat([
+            partitions[key][['hc', 'ingreso']] if key in partitions
+            else self.read('records', key, columns=['hc', 'ingreso'])
+            for key in keys
+        ], keys=keys, names=['partition', 'record']) if keys else pandas.DataFrame(columns=['hc', 'ingreso'])
+        flags = flag_readmissions(admissions)
+
+        # 3. escribir las particiones nuevas, modificadas o con flags distintos
+        index = None
+        flag_updates = []
+        for key in keys:
+            partition_flags = flags.loc[key].to_numpy()
+            flags_hash = hashlib.sha256(partition_flags.tobytes()).hexdigest()
+            if key in partitions:
+                records = partitions[key]
+            elif stored[key]['flags_sha256'] != flags_hash:
+                records = self.read('records', key, columns=RECORD_COLUMNS)
+                flag_updates.append(key)
+            else:
+                continue
+
+            records = records.copy()
+            records['es_reinternacion'] = partition_flags
+            if index is None:
+                index = geocode_index.get_geocode_index(
+                    addresses_csv_path, cache_dir=geocode_cache_dir)
+                corrections = address_corrections.read_corrections(corrections_csv_path)
+            points_df, report, unmatched = merge_addresses(records, index, corrections)
+            self.write('records', key, records)
+            self.write('points', key, points_df)
+            fired = report[report['filas_coincidentes'] > 0]
+            stored[key] = {
+                'rows': len(records),
+                'sha256': content_hash(records),
+                'flags_sha256': flags_hash,
+                # reglas de corrección aplicadas: {posición de la regla: [coincidentes, corregidas]}
+                'corrections': {
+                    str(rule): [int(matched), int(changed)]
+                    for rule, matched, changed
+                    in zip(fired.index, fired['filas_coincidentes'], fired['filas_corregidas'])
+                },
+                'unmatched': dict(zip(unmatched['domicilio'].astype(str), unmatched['filas'].astype(int).tolist())),
+            }
+
+        self.save_manifest({
+            'version': INGEST_STORE_VERSION,
+            'addresses_sha256': addresses_hash,
+            'corrections_sha256': corrections_hash,
+            'source': {
+                'size': os.path.getsize(medical_records_csv_path),
+                'sha256': cache_utils.file_hash(medical_records_csv_path),
+            },
+            'partitions': stored,
+        })
+        return {
+            'mode': mode,
+            'rows_read': new_rows,
+            'partitions_written': sorted(partitions),
+            'partitions_removed': removed,
+            'partitions_reflagged': flag_updates,
+        }
+
+    def get_points(self):
+        """Todos los registros con coordenadas, ordenados por fecha de ingreso."""
+        manifest = self.load_manifest()
+        keys = sorted(manifest['partitions'])
+        points_df = pandas.concat(
+            [self.read('points', key) for key in keys], ignore_index=True)
+        points_df = points_df.sort_values(by='ingreso', kind='stable').reset_index(drop=True)
+        return to_points_gdf(points_df)
+
+    def get_corrections_report(self, corrections_csv_path):
+        """Reglas de corrección de domicilios y filas afectadas, sumadas sobre todas las particiones."""
+        manifest = self.load_manifest()
+        report = address_corrections.read_corrections(corrections_csv_path)
+        counts = numpy.zeros((len(report), 2), dtype=int)
+        for partition in manifest['partitions'].values():
+            for rule, partition_counts in partition['corrections'].items():
+                counts[int(rule)] += partition_counts
+        report['filas_coincidentes'] = counts[:, 0]
+        report['filas_corregidas'] = counts[:, 1]
+        return report
+
+    def get_unmatched_report(self):
+        """Domicilios sin geocodificar, sumados sobre todas las particiones."""
+        manifest = self.load_manifest()
+        counts = {}
+        for partition in manifest['partitions'].values():
+            for address, rows in partition['unmatched'].items():
+                counts[address] = counts.get(address, 0) + rows
+        report = pandas.DataFrame(
+            {'domicilio': list(counts), 'filas': list(counts.values())},
+            columns=['domicilio', 'filas'])
+        return report.sort_values(['filas', 'domicilio'], ascending=[False, True], ignore_index=True)
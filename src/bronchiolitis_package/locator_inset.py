@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Capa del mapa de ubicación (inset de `maps_utils.annotate_map`): contorno de América
+del Sur y punto de Puerto Madryn.
+
+Se calcula una vez (lectura de Natural Earth, filtro del continente, `unary_union` y
+simplificación) y se guarda como GeoParquet. Opcionalmente se guarda también el fondo
+raster del inset ya recortado y reproyectado (`.npz` con la imagen y sus extensiones),
+de modo que las figuras no abren el GeoTIFF de América del Sur.
+
+La extensión del inset depende sólo de las geometrías: se obtiene dibujándolas con
+`plot_locator_layers`, la misma función que usan las figuras.
+"""
+import geopandas
+import matplotlib.pyplot as plt
+import numpy
+from shapely.geometry import Point
+
+from bronchiolitis_package import basemap_cache
+from bronchiolitis_package import cache_utils
+
+LAT_LNG_PM = -65.030949, -42.769679
+
+LOCATOR_CRS = 'epsg:4326'
+
+# tolerancia de simplificación del contorno (grados): muy por debajo de un píxel del
+# inset a 300 dpi (~0.06°)
+SIMPLIFY_TOLERANCE = .01
+
+# tamaño del inset (35% de un mapa de 12 pulgadas) para elegir la resolución del fondo
+INSET_SIZE_INCHES = 12 * .35
+
+LAYER_CONTINENT = 'south_america'
+LAYER_LOCATION = 'puerto_madryn'
+
+
+def build_locator_layers(world_path=None, tolerance=SIMPLIFY_TOLERANCE):
+    """Contorno simplificado de América del Sur y punto de Puerto Madryn.
+
+    Args:
+        - world_path (str or None): Países de Natural Earth (columna `continent`).
+            None usa `naturalearth_lowres` de geopandas.
+
+    Returns:
+        geopandas.GeoDataFrame: columnas `layer` y `geometry`, en `LOCATOR_CRS`.
+    """
+    if world_path is None:
+        world_path = geopandas.datasets.get_path('naturalearth_lowres')
+    world = geopandas.read_file(world_path)
+    south_america = world[world.continent == 'South America'].unary_union
+    return geopandas.GeoDataFrame(
+        {'layer': [LAYER_CONTINENT, LAYER_LOCATION]},
+        geometry=[south_america.simplify(tolerance), Point(*LAT_LNG_PM)],
+        crs=LOCATOR_CRS
+    )
+
+
+def plot_locator_layers(ref_ax, layers):
+    """Dibuja el contorno y el punto en el eje del inset.
+
+    Returns:
+        shapely.geometry.Point: Puerto Madryn (para ubicar la etiqueta).
+    """
+    continent = layers[layers['layer'] == LAYER_CONTINENT].geometry
+    location = layers[layers['layer'] == LAYER_LOCATION].geometry
+    # sudamerica
+    continent.plot(color='none', figsize=(20,20), ax=ref_ax)
+    # puntito de madryn en sudamerica
+    location.plot(color='r', markersize=100, ax=ref_ax)
+    return location.iloc[0]
+
+
+def build_background(layers, source, cache_dir=None, dpi=basemap_cache.DEFAULT_DPI):
+    """Fondo raster del inset para la extensión que resulta de dibujar `layers`.
+
+    Returns:
+        - image (numpy.ndarray): (alto, ancho, bandas).
+        - image_extent (tuple): extensión de la imagen.
+        - axis_extent (tuple): extensión del eje del inset (xmin, xmax, ymin, ymax).
+    """
+    figure, ref_ax = plt.subplots(figsize=(INSET_SIZE_INCHES, INSET_SIZE_INCHES))
+    try:
+        plot_locator_layers(ref_ax, layers)
+        axis_extent = ref_ax.axis()
+    finally:
+        plt.close(figure)
+
+    crs = layers.crs.to_string()
+    tier = next(
+        (tier for tier in basemap_cache.BASEMAP_TIERS if tier >= INSET_SIZE_INCHES * dpi), None)
+    if cache_dir is not None:
+        image, image_extent = basemap_cache.get_basemap(
+            source, crs, axis_extent, cache_dir, tier=tier)
+    else:
+        image, image_extent = basemap_cache.warp_basemap(source, crs, axis_extent)
+        if tier is not None:
+            image = basemap_cache.downsample(image, image_extent, crs, tier)
+    return numpy.asarray(image), image_extent, axis_extent
+
+
+def save_background(path, image, image_extent, axis_extent):
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as outfile:
+            numpy.savez(
+                outfile,
+                image=image,
+                image_extent=numpy.array(image_extent),
+                axis_extent=numpy.array(axis_extent)
+            )
+    cache_utils.atomic_write(str(path), write, suffix='.npz')
+
+
+def load_background(path):
+    with numpy.load(str(path), allow_pickle=False) as stored:
+        if stored['image'].size == 0:
+            return None
+        return stored['image'], tuple(stored['image_extent']), tuple(stored['axis_extent'])
+
+
+def save_locator_inset(product, world_path=None, source=None, cache_dir=None):
+    """Guarda la capa (`product['layers']`) y, si se indica `source`, el fondo
+    (`product['background']`; sin `source` se guarda un fondo vacío)."""
+    layers = build_locator_layers(world_path)
+    layers.to_parquet(str(product['layers']), index=False)
+    if source is None:
+        save_background(product['background'], numpy.zeros((0, 0, 3), dtype='uint8'), (), ())
+    else:
+        save_background(product['background'], *build_background(layers, source, cache_dir=cache_dir))
@@ -1,43 +1,51 @@
 import geopandas
-from shapely.geometry import Point
-import contextily
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 import matplotlib.patheffects as PathEffects
 from matplotlib.lines import Line2D
 import matplotlib.pyplot as plt
 from matplotlib.patches import Patch
 
+from bronchiolitis_package import basemap_cache
+from bronchiolitis_package import locator_inset
+from bronchiolitis_package import tract_rendering
+
 
 
 def annotate_map(
         ax, shape_crs_string,
         PUERTO_MADRYN_BASEMAP_TIF_PATH=None,
-        SOUTH_AMERICA_BASEMAP_TIF_PATH=None
+        SOUTH_AMERICA_BASEMAP_TIF_PATH=None,
+        BASEMAP_CACHE_DIR=None,
+        dpi=basemap_cache.DEFAULT_DPI,
+        LOCATOR_INSET=None
     ):
     """ Agrega anotaciones al mapa:
         - Referencia de Puerto Madryn en América Latina
         - Flecha apuntando al norte
-        - Capas base
+        - Capas base (ya reproyectadas, del cache de `BASEMAP_CACHE_DIR` si se indica;
+          ver `basemap_cache`). `dpi` es el de la figura guardada, para elegir la
+          resolución de las capas base.
+
+    `LOCATOR_INSET` es el producto de `locator_inset.save_locator_inset` ({'layers',
+    'background'}): si se indica, el inset usa la capa ya calculada y, si el producto
+    tiene fondo, no se lee `SOUTH_AMERICA_BASEMAP_TIF_PATH`.
     """
-    world = geopandas.read_file(geopandas.datasets.get_path('naturalearth_lowres'))
-    south_america = geopandas.GeoSeries(
-        [world[world.continent == 'South America'].unary_union],
-        crs='epsg:4326'
-    )
-    LAT_LNG_PM = -65.030949, -42.769679
-    working_area = Point(*LAT_LNG_PM)
-    geopoint_madryn = geopandas.GeoSeries(
-        [working_area],
-        crs='epsg:4326'
-    )
+    background = None
+    if LOCATOR_INSET is not None:
+        locator_layers = geopandas.read_parquet(str(LOCATOR_INSET['layers']))
+        background = locator_inset.load_background(LOCATOR_INSET['background'])
+    else:
+        locator_layers = locator_inset.build_locator_layers(tolerance=0)
 
     # basemap:
     # crs=shape.crs.to_string()
     if PUERTO_MADRYN_BASEMAP_TIF_PATH:
-        contextily.add_basemap(
+        basemap_cache.add_basemap(
             ax,
             source=PUERTO_MADRYN_BASEMAP_TIF_PATH,
-            crs=shape_crs_string
+            crs=shape_crs_string,
+            cache_dir=BASEMAP_CACHE_DIR,
+            dpi=dpi
         )
 
     # reference map_
@@ -49,17 +57,18 @@ def annotate_map(
         bbox_transform=ax.transAxes
     )
 
-    # sudamerica
-    south_america.plot(color='none', figsize=(20,20), ax=ref_ax)
-
-    # puntito de madryn en sudamerica
-    geopoint_madryn.plot(color='r', markersize=100, ax=ref_ax)
+    # sudamerica y puntito de madryn
+    geopoint_madryn = locator_inset.plot_locator_layers(ref_ax, locator_layers)
 
-    if SOUTH_AMERICA_BASEMAP_TIF_PATH:
-        contextily.add_basemap(
+    if background is not None:
+        basemap_cache.blit_basemap(ref_ax, *background)
+    elif SOUTH_AMERICA_BASEMAP_TIF_PATH:
+        basemap_cache.add_basemap(
             ref_ax,
             source=SOUTH_AMERICA_BASEMAP_TIF_PATH,
-            crs=south_america.crs.to_string()
+            crs=locator_layers.crs.to_string(),
+            cache_dir=BASEMAP_CACHE_DIR,
+            dpi=dpi
         )
 
     txt1 = ref_ax.text(
@@ -121,6 +130,30 @@ def add_points_to_ax(point_gdf, ax, point_plot_args={}, label_title="Admissions"
 
     return ax, pmarks
 
+def plot_tract_clusters(ax, shape, paint_by_column, tracts_palette, edge_palette):
+    """ Dibuja en `ax` los radios pintados según la etiqueta de cluster (una sola colección,
+    ver `tract_rendering.plot_categories`)
+
+    Returns:
+        - collection: Los radios.
+        - handles (list): Marcas de cada etiqueta (las de `ax.get_legend_handles_labels()`).
+        - pmarks (list): Marcas de la leyenda con la cantidad de radios.
+    """
+    collection, handles = tract_rendering.plot_categories(
+        ax, shape.geometry, shape[paint_by_column],
+        tracts_palette,
+        edge_palette=edge_palette
+    )
+
+    pmarks = []
+    for ctype, n_tracts in shape[paint_by_column].value_counts().sort_index().items():
+        pmarks.append(Patch(
+            facecolor=tracts_palette[ctype],
+            label="{} ({})".format(ctype, n_tracts)))
+
+    return collection, handles, pmarks
+
+
 def plot_puerto_madryn_tract_map(
         shape,
         paint_by_column,
@@ -132,24 +165,8 @@ def plot_puerto_madryn_tract_map(
     # Set up figure and axes
     f, ax = plt.subplots(figsize=(12, 12))
 
-    pmarks = []
-    for ctype, tracts in shape.groupby(paint_by_column):
-        # Define the color for each group using the dictionary
-        color = tracts_palette[ctype]
-        
-        edge_color = edge_palette[ctype]
-        
-        # Plot each group using the color defined above
-        tracts.plot(
-            color=color,
-            ax=ax,
-            label=ctype,
-            edgecolor=edge_color
-        )
-
-        pmarks.append(Patch(
-            facecolor=color,
-            label="{} ({})".format(ctype, len(tracts))))
+    _, _, pmarks = plot_tract_clusters(
+        ax, shape, paint_by_column, tracts_palette, edge_palette)
 
     ax.set(title=figure_title)
     return ax, pmarks
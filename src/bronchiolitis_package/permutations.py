@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Motor de permutaciones (aleatorización condicional) para los I de Moran locales.
+
+Las permutaciones se dividen en chunks de tamaño fijo. Cada chunk recibe su propia
+semilla (derivada de la semilla global con `numpy.random.SeedSequence.spawn`), por lo
+que el resultado es reproducible y no depende de la cantidad de procesos usados.
+Cada chunk devuelve conteos y momentos parciales que luego se combinan en los mismos
+atributos que calcula esda (`p_sim`, `EI_sim`, `seI_sim`, `z_sim`, `p_z_sim`).
+
+Las variables pueden ser una columna (n,) o una matriz (n, a) con `a` atributos: todos
+los atributos se simulan con los mismos bloques de ids sorteados, de forma vectorizada
+(sin un loop de Python por observación ni por atributo).
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+from scipy import stats
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# tolerancia relativa sugerida para `tie_tolerance` (opcional, ver `local_moran_inference`)
+TIE_TOLERANCE = 1e-10
+
+# cantidad máxima de elementos de los bloques temporales
+# (observaciones x permutaciones x vecinos x atributos)
+MAX_BLOCK_ELEMENTS = 4_000_000
+
+
+def get_neighbor_weights(w):
+    """Pesos de los vecinos de cada observación en una matriz densa (n, max_card).
+
+    Returns:
+        - neighbor_weights (numpy.ndarray): pesos de los vecinos (sin la propia
+            observación), completado con ceros a la derecha.
+        - self_weights (numpy.ndarray): peso de cada observación consigo misma.
+    """
+    matrix = w.sparse.tocsr(copy=True)
+    self_weights = matrix.diagonal()
+    matrix.setdiag(0)
+    matrix.eliminate_zeros()
+
+    cardinalities = numpy.diff(matrix.indptr)
+    max_card = max(int(cardinalities.max()), 1) if len(cardinalities) else 1
+    neighbor_weights = numpy.zeros((matrix.shape[0], max_card))
+    rows = numpy.repeat(numpy.arange(matrix.shape[0]), cardinalities)
+    cols = numpy.arange(len(matrix.data)) - numpy.repeat(matrix.indptr[:-1], cardinalities)
+    neighbor_weights[rows, cols] = matrix.data
+    return neighbor_weights, self_weights
+
+
+def draw_permuted_ids(rng, n_permutations, n_others, max_card):
+    """Sortea, para cada permutación, `max_card` ids distintos en [0, n_others).
+
+    Los ids quedan en orden aleatorio, de modo que los primeros k de cada fila son
+    también una muestra sin reposición (sirve para observaciones con menos vecinos).
+    """
+    max_card = min(max_card, n_others)
+    keys = rng.random((n_permutations, n_others))
+    if max_card < n_others:
+        ids = numpy.argpartition(keys, max_card - 1, axis=1)[:, :max_card]
+    else:
+        ids = numpy.broadcast_to(numpy.arange(n_others), keys.shape)
+    order = numpy.argsort(numpy.take_along_axis(keys, ids, axis=1), axis=1)
+    return numpy.take_along_axis(ids, order, axis=1)
+
+
+def simulate_local_moran(focal_z, lagged_z, neighbor_weights, self_weights, scaling, permuted_ids, observations=None):
+    """I de Moran locales simulados para un bloque de permutaciones.
+
+    El id sorteado `r` para la observación `i` se corresponde con la observación
+    `r + (r >= i)`: se sortea entre las n-1 restantes, igual que esda.
+
+    Args:
+        - focal_z (numpy.ndarray): (n, a) z de la variable de cada observación (zx en el bivariado).
+        - lagged_z (numpy.ndarray): (n, a) z de la variable que se permuta y rezaga (zy en el bivariado).
+        - scaling (numpy.ndarray): (a,) (n - 1) / suma de focal_z al cuadrado.
+        - permuted_ids (numpy.ndarray): (permutaciones, max_card) ids sorteados.
+        - observations (numpy.ndarray or None): posiciones a simular (todas si es None).
+
+    Returns:
+        numpy.ndarray: (observaciones, permutaciones, a) I locales simulados.
+    """
+    if observations is None:
+        observations = numpy.arange(len(focal_z))
+    n_permutations = permuted_ids.shape[0]
+    n_attributes = focal_z.shape[1]
+    lag = numpy.empty((len(observations), n_permutations, n_attributes))
+
+    # las mismas operaciones que esda (producto con los pesos de los `cardinality`
+    # vecinos, luego el peso propio y por último `z_i * scaling`): con datos discretos
+    # hay simulados que empatan con Is y el redondeo decide de qué lado caen
+    cardinalities = (neighbor_weights[observations] != 0).sum(axis=1)
+    for cardinality in numpy.unique(cardinalities):
+        rows = numpy.flatnonzero(cardinalities == cardinality)
+        group = observations[rows]
+        ids = permuted_ids[numpy.newaxis, :, :cardinality]
+        ids = ids + (ids >= group[:, numpy.newaxis, numpy.newaxis])
+        # (observaciones x a, permutaciones, vecinos) @ (observaciones x a, vecinos, 1)
+        # contiguo: con strides arbitrarios numpy no usa BLAS y el redondeo cambia
+        values = numpy.ascontiguousarray(
+            numpy.moveaxis(lagged_z[ids], 3, 1).reshape(-1, n_permutations, cardinality))
+        weights = numpy.repeat(neighbor_weights[group, :cardinality], n_attributes, axis=0)
+        lagged = (values @ weights[:, :, numpy.newaxis]).reshape(len(group), n_attributes, n_permutations)
+        lag[rows] = numpy.moveaxis(lagged, 1, 2)
+    lag += (self_weights[observations, numpy.newaxis] * lagged_z[observations])[:, numpy.newaxis, :]
+    return (focal_z[observations] * scaling)[:, numpy.newaxis, :] * lag
+
+
+def _local_moran_chunk(
+        focal_z, lagged_z, Is, neighbor_weights, self_weights, scaling, n_permutations, seed_sequence,
+        tie_tolerance=None
+    ):
+    """Procesa un chunk de permutaciones.
+
+    Returns:
+        - above (numpy.ndarray): cantidad de simulados >= Is por observación (con
+            `tie_tolerance`, >= Is - tolerancia).
+        - below (numpy.ndarray or None): con `tie_tolerance`, cantidad de simulados
+            <= Is + tolerancia por observación; None sin `tie_tolerance`.
+        - mean (numpy.ndarray): media de los simulados del chunk.
+        - m2 (numpy.ndarray): suma de cuadrados de desvíos respecto a `mean`.
+    """
+    rng = numpy.random.default_rng(seed_sequence)
+    n, max_card = neighbor_weights.shape
+    n_attributes = focal_z.shape[1]
+    above = numpy.zeros(Is.shape, dtype=numpy.int64)
+    below = None if tie_tolerance is None else numpy.zeros(Is.shape, dtype=numpy.int64)
+    mean = numpy.empty(Is.shape)
+    m2 = numpy.empty(Is.shape)
+
+    # todas las permutaciones del chunk a la vez y los bloques sólo por observación: el
+    # redondeo de cada simulado (y de qué lado de Is caen los empates) depende de la
+    # cantidad de permutaciones de cada producto con los pesos, no de los bloques
+    permuted_ids = draw_permuted_ids(rng, n_permutations, n - 1, max_card)
+    observations_per_block = max(1, MAX_BLOCK_ELEMENTS // (n_permutations * max_card * n_attributes))
+
+    for start in range(0, n, observations_per_block):
+        observations = numpy.arange(start, min(n, start + observations_per_block))
+        block = simulate_local_moran(
+            focal_z, lagged_z,
+            neighbor_weights, self_weights,
+            scaling, permuted_ids,
+            observations=observations
+        )
+        observed = Is[observations, numpy.newaxis, :]
+        if tie_tolerance is None:
+            above[observations] = (block >= observed).sum(axis=1)
+        else:
+            tolerance = tie_tolerance * numpy.maximum(1, numpy.abs(observed))
+            above[observations] = (block >= observed - tolerance).sum(axis=1)
+            below[observations] = (block <= observed + tolerance).sum(axis=1)
+        mean[observations] = block.mean(axis=1)
+        m2[observations] = ((block - mean[observations, numpy.newaxis, :]) ** 2).sum(axis=1)
+
+    return above, below, mean, m2
+
+
+def merge_moments(a, b):
+    """Combina (cantidad, media, m2) de dos grupos de simulaciones (Chan et al.)."""
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / count
+    return count, mean, m2
+
+
+def get_p_sim(above, permutations, below=None):
+    """Pseudo p-valor de la cola más extrema.
+
+    Args:
+        - above (numpy.ndarray): cantidad de simulados >= Is.
+        - permutations (int): cantidad de permutaciones.
+        - below (numpy.ndarray or None): cantidad de simulados <= Is. Si es None se usa
+            la regla de esda: min(above, permutations - above). Si no, min(above, below)
+            (los empates cuentan en las dos colas).
+    """
+    if below is None:
+        larger = numpy.where(permutations - above < above, permutations - above, above)
+    else:
+        larger = numpy.minimum(above, below)
+    return (larger + 1.0) / (permutations + 1.0)
+
+
+def _local_moran_chunk_star(args):
+    return _local_moran_chunk(*args)
+
+
+def get_chunk_sizes(permutations, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Divide `permutations` en chunks de a lo sumo `chunk_size`."""
+    n_chunks = -(-permutations // chunk_size)
+    return [min(chunk_size, permutations - i * chunk_size) for i in range(n_chunks)]
+
+
+def local_moran_inference(
+        focal_z, lagged_z, Is, w,
+        permutations=999,
+        n_jobs=1,
+        seed=None,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        tie_tolerance=None
+    ):
+    """Inferencia por aleatorización condicional para I de Moran locales.
+
+    Args:
+        - focal_z, lagged_z (numpy.ndarray): (n,) o (n, a). Ver `simulate_local_moran`.
+            En el caso univariado ambos son el z de la variable.
+        - Is (numpy.ndarray): I de Moran locales observados, con la misma forma.
+        - w (pysal.lib.weights.W): Pesos (ya estandarizados).
+        - permutations (int, default=999): Cantidad de permutaciones.
+        - n_jobs (int, default=1): Procesos a usar. -1 usa todos los núcleos.
+        - seed (int or None): Semilla global.
+        - chunk_size (int): Permutaciones por chunk (cada chunk tiene su semilla).
+        - tie_tolerance (float or None): None (por defecto) usa la regla de esda:
+            p_sim sale de la cantidad de simulados >= Is y de su complemento. Con una
+            tolerancia relativa (por ejemplo `TIE_TOLERANCE`) los simulados empatados con
+            Is se cuentan en las dos colas; con datos discretos (conteos) da p-valores
+            mayores que esda.
+
+    Returns:
+        dict: p_sim, EI_sim, seI_sim, VI_sim, z_sim y p_z_sim (como en esda), con la
+            misma forma que `Is`.
+    """
+    single_attribute = numpy.ndim(Is) == 1
+    focal_z = _as_columns(focal_z)
+    lagged_z = _as_columns(lagged_z)
+    Is = _as_columns(Is)
+    n = len(focal_z)
+    scaling = (n - 1) / (focal_z * focal_z).sum(axis=0)
+    neighbor_weights, self_weights = get_neighbor_weights(w)
+
+    chunk_sizes = get_chunk_sizes(permutations, chunk_size)
+    seed_sequences = numpy.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    chunks_args = [
+        (focal_z, lagged_z, Is, neighbor_weights, self_weights, scaling, size, seed_sequence, tie_tolerance)
+        for size, seed_sequence in zip(chunk_sizes, seed_sequences)
+    ]
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    n_jobs = max(1, min(n_jobs, len(chunks_args)))
+    if n_jobs == 1:
+        results = [_local_moran_chunk_star(args) for args in chunks_args]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(_local_moran_chunk_star, chunks_args))
+
+    # combinar los chunks
+    above = numpy.zeros(Is.shape, dtype=numpy.int64)
+    below = numpy.zeros(Is.shape, dtype=numpy.int64)
+    moments = 0, numpy.zeros(Is.shape), numpy.zeros(Is.shape)
+    for size, (chunk_above, chunk_below, chunk_mean, chunk_m2) in zip(chunk_sizes, results):
+        above += chunk_above
+        if chunk_below is not None:
+            below += chunk_below
+        moments = merge_moments(moments, (size, chunk_mean, chunk_m2))
+    _, mean, m2 = moments
+
+    p_sim = get_p_sim(above, permutations, below=None if tie_tolerance is None else below)
+
+    EI_sim = mean
+    VI_sim = m2 / permutations
+    seI_sim = numpy.sqrt(VI_sim)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        z_sim = (Is - EI_sim) / seI_sim
+    p_z_sim = stats.norm.sf(numpy.abs(z_sim))
+
+    inference = {
+        'p_sim': p_sim,
+        'EI_sim': EI_sim,
+        'seI_sim': seI_sim,
+        'VI_sim': VI_sim,
+        'z_sim': z_sim,
+        'p_z_sim': p_z_sim,
+    }
+    if single_attribute:
+        inference = {name: values[:, 0] for name, values in inference.items()}
+    return inference
+
+
+def _as_columns(values):
+    values = numpy.asarray(values, dtype=float)
+    return values[:, numpy.newaxis] if values.ndim == 1 else values
@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
+import base64
+import io
 import pdfkit
 import PIL
+import PIL.Image
 import datetime
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from bronchiolitis_package import cache_utils
 
 
 # CONSTANTS:
@@ -24,6 +31,118 @@ BR = '<div style="display:block; clear:both; page-break-after:always;"></div>'
 
 IMGS_BASEWITH = 1000
 
+REPORT_IMAGE_CACHE_VERSION = 1
+
+# el filtro que PIL llamaba ANTIALIAS
+IMAGE_RESAMPLING = PIL.Image.LANCZOS
+
+# `resize` reduce primero por bloques (`Image.reduce`) hasta REDUCING_GAP veces el
+# tamaño final y recién ahí aplica el filtro: a este factor no se distingue del
+# filtro sobre la imagen completa
+IMAGE_REDUCING_GAP = 3.0
+
+
+def resize_image(image_path, basewidth=IMGS_BASEWITH):
+    """Escala la imagen a `basewidth` píxeles de ancho (mismo aspecto).
+
+    La decodificación es reducida cuando el formato lo permite (`draft`, JPEG); en
+    PNG se decodifica completa y se reduce por bloques antes del filtro.
+
+    Returns:
+        - png (bytes): Imagen escalada, codificada en PNG.
+        - width, height (int): Tamaño de la imagen escalada.
+    """
+    with PIL.Image.open(image_path) as input_image:
+        img_width, img_height = input_image.size
+
+        wpercent = (basewidth / float(img_width))
+        hsize = int((float(img_height) * float(wpercent)))
+        input_image.draft(input_image.mode, (basewidth, hsize))
+        img = input_image.resize(
+            (basewidth, hsize), IMAGE_RESAMPLING, reducing_gap=IMAGE_REDUCING_GAP)
+
+    output = io.BytesIO()
+    img.save(output, format='PNG')
+    return output.getvalue(), basewidth, hsize
+
+
+def get_report_image(image_path, basewidth=IMGS_BASEWITH, cache_dir=None, source_hash=None):
+    """`resize_image`, del cache de `cache_dir` si la misma imagen ya se escaló.
+
+    La clave es el hash del contenido de la imagen (`source_hash`, o el de
+    `cache_utils.get_file_hashes`) y el ancho.
+    """
+    if cache_dir is None:
+        return resize_image(image_path, basewidth)
+
+    if source_hash is None:
+        source_hash, = cache_utils.get_file_hashes([image_path], cache_dir)
+    key = cache_utils.hash_key(
+        REPORT_IMAGE_CACHE_VERSION, source_hash, basewidth, IMAGE_REDUCING_GAP)
+    cached_path = os.path.join(cache_dir, f'{key}.png')
+
+    if not os.path.exists(cached_path):
+        png, _, _ = resize_image(image_path, basewidth)
+
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as outfile:
+                outfile.write(png)
+        cache_utils.atomic_write(cached_path, write, suffix='.png')
+
+    with open(cached_path, 'rb') as infile:
+        png = infile.read()
+    with PIL.Image.open(io.BytesIO(png)) as img:
+        width, height = img.size
+    return png, width, height
+
+
+def get_data_uri(png):
+    """`src` de una imagen PNG embebida en el HTML."""
+    return 'data:image/png;base64,' + base64.b64encode(png).decode('ascii')
+
+
+def render_pdf(html, destination, options=None):
+    """Genera el PDF `destination` a partir del texto `html` con wkhtmltopdf (pdfkit).
+
+    El html se escribe en un archivo temporal con nombre único junto a `destination`
+    (no en el directorio de trabajo), de modo que varios reportes pueden generarse a
+    la vez sin pisarse.
+    """
+    fd, html_path = tempfile.mkstemp(
+        prefix='tmp_report_', suffix='.html', dir=os.path.dirname(os.path.abspath(destination)))
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as r:
+            r.write(html)
+        pdfkit.from_file(html_path, destination, options=options)
+    finally:
+        os.remove(html_path)
+
+
+def build_reports(reports, n_workers=1):
+    """Genera varios reportes, hasta `n_workers` a la vez.
+
+    Cada PDF es un proceso de wkhtmltopdf (un proceso genera un solo documento): acá
+    se lanzan en paralelo desde hilos, con el escalado de figuras de cada reporte en
+    el mismo pool, en vez de uno detrás de otro.
+
+    Args:
+        - reports (list): Tuplas (Report, ruta del PDF).
+        - n_workers (int, default=1): Reportes simultáneos. -1 usa todos los núcleos.
+    """
+    reports = list(reports)
+    if n_workers == -1:
+        n_workers = os.cpu_count()
+    n_workers = max(1, min(n_workers, len(reports)))
+    if n_workers == 1:
+        for report, destination in reports:
+            report.build(destination)
+        return
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(report.build, destination) for report, destination in reports]
+        for future in futures:
+            future.result()
+
 
 class Report:
     ''' Usage:
@@ -54,7 +173,9 @@ class Report:
     report.build(path/to/pdf/destination.pdf)  # str(product)
     '''
     
-    def __init__(self, title: str, subtitle: str, experiment_params: list):
+    def __init__(
+            self, title: str, subtitle: str, experiment_params: list,
+            image_cache_dir: str = None, n_jobs: int = 1):
         ''' 
         experiment_params = [
             {
@@ -63,13 +184,19 @@ class Report:
                 param_value: '1000',
             },
         ]
+
+        Las figuras se escalan al armar el reporte, en `n_jobs` hilos (-1: todos los
+        núcleos), y se embeben en el HTML (sin archivos temporales). Con
+        `image_cache_dir` las figuras escaladas se guardan por hash de contenido: al
+        reconstruir el reporte no se vuelven a procesar las que no cambiaron.
         '''
         self.title = title
         self.subtitle = subtitle
         self.experiment_params = experiment_params
+        self.image_cache_dir = image_cache_dir
+        self.n_jobs = n_jobs
         
-        self.tmp_files = []
-        self.content = ''
+        self.sections = []
         self.params = self.get_html_params()
 
     def get_html_params(self):
@@ -99,28 +226,59 @@ class Report:
             None
         '''
 
-        # add section (title, fig, caption):
-        
-        # > title
-        report_content = f"{text}"
-        
-        # > figure
-        if figure:
-            RESIZED_IMAGE_DIR, w, h = self.__resize_image(
-                figure,
-                basewidth=IMGS_BASEWITH
-            )
-            report_content += self.__get_fig_template(RESIZED_IMAGE_DIR, w, h)
-            #report_content += BR
-            self.tmp_files.append(f"{os.getcwd()}/{RESIZED_IMAGE_DIR}")
-        
-        # > caption
-        report_content += caption
-        
-        if finish_with_page_break:
-            report_content += BR
-        
-        self.content += report_content
+        self.sections.append({
+            'text': text,
+            'figure': figure,
+            'caption': caption,
+            'finish_with_page_break': finish_with_page_break,
+        })
+
+    def get_images(self):
+        '''Figuras escaladas de las secciones (png, ancho, alto), en paralelo.'''
+        figures = [section['figure'] for section in self.sections if section['figure']]
+        n_jobs = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+        n_jobs = max(1, min(n_jobs, len(figures)))
+
+        # los hashes se calculan antes (un solo registro de fuentes en el cache)
+        hashes = [None] * len(figures)
+        if self.image_cache_dir is not None:
+            hashes = cache_utils.get_file_hashes(figures, self.image_cache_dir)
+
+        def get_image(figure, source_hash):
+            return get_report_image(
+                figure, basewidth=IMGS_BASEWITH,
+                cache_dir=self.image_cache_dir, source_hash=source_hash)
+
+        if n_jobs == 1:
+            images = [get_image(figure, source_hash) for figure, source_hash in zip(figures, hashes)]
+        else:
+            # PIL libera el GIL al decodificar, escalar y codificar
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                images = list(executor.map(get_image, figures, hashes))
+        return dict(zip(figures, images))
+
+    def get_html_content(self):
+        '''Secciones del reporte (título, figura, caption) en html.'''
+        images = self.get_images()
+        content = ''
+        for section in self.sections:
+            # > title
+            report_content = f"{section['text']}"
+
+            # > figure
+            if section['figure']:
+                png, w, h = images[section['figure']]
+                report_content += self.__get_fig_template(get_data_uri(png), w, h)
+                #report_content += BR
+
+            # > caption
+            report_content += section['caption']
+
+            if section['finish_with_page_break']:
+                report_content += BR
+
+            content += report_content
+        return content
 
     def get_report_text(self):
         return f'''
@@ -153,49 +311,22 @@ class Report:
                             {self.params}
                         </div>
                         <div style="display:block; clear:both; page-break-after:always;"></div>
-                        {self.content}
+                        {self.get_html_content()}
                     </body>
                 </html>
             '''
     
+    def get_pdf_options(self):
+        '''Opciones de wkhtmltopdf del reporte (con la fecha de generación)'''
+        return {
+            **PDF_EXPORT_OPTIONS,
+            'footer-left': f"Reporte generado: {str(datetime.datetime.now())}",
+        }
+
     def build(self, destination):
         '''Genera el PDF con el contenido del reporte'''
         # destination = str(product)
-        
-        # set current time
-        PDF_EXPORT_OPTIONS['footer-left'] = f"Reporte generado: {str(datetime.datetime.now())}"
-        # Save HTML string to file
-        HTML_REPORT_DIR = "tmp_report_years.html"
-
-        with open(HTML_REPORT_DIR, "w") as r:
-            r.write(self.get_report_text())
-
-        #Use pdfkit to create the pdf report from the 
-        pdfkit.from_file(
-            HTML_REPORT_DIR,
-            destination,
-            options=PDF_EXPORT_OPTIONS
-        ) 
-
-        # remove the tmp data
-        os.remove(HTML_REPORT_DIR)
-        
-        for tmp_file in self.tmp_files:
-            print(f"removing {tmp_file}...")
-            os.remove(tmp_file)
-
-    def __resize_image(self, image_path, basewidth):
-        input_image = PIL.Image.open(image_path)
-        img_width, img_height = input_image.size
-
-        wpercent = (basewidth / float(img_width))
-        hsize = int((float(img_height) * float(wpercent)))
-        img = input_image.resize((basewidth, hsize), PIL.Image.ANTIALIAS)
-        base_name = image_path.split('/')[-1].rstrip('.png')
-        output_image_path = f'{base_name}_{datetime.datetime.now().isoformat()}.png'
-        img.save(output_image_path)
-        
-        return output_image_path, basewidth, hsize
+        render_pdf(self.get_report_text(), destination, options=self.get_pdf_options())
 
     def __get_fig_template(self, fig_src: str, width: int, height: int) -> str:
         return f'''
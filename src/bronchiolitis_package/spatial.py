@@ -3,13 +3,26 @@ from splot.esda import plot_moran
 from splot.esda import moran_scatterplot
 from splot.esda import lisa_cluster
 from matplotlib import colors
+import numpy
 from matplotlib.patches import Patch
 import esda
-from pysal.lib import weights
 from splot.esda import moran_scatterplot, lisa_cluster
 import contextily as ctx
 import matplotlib.pyplot as plt
 from collections import Counter
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas
+from bronchiolitis_package import cache_utils
+from bronchiolitis_package import weights_cache
+from bronchiolitis_package import permutations as lisa_permutations
+from bronchiolitis_package import spatial_products
+from bronchiolitis_package import tract_rendering
+
+# etiqueta de cada cuadrante significativo de un Moran local (0: no significativo)
+CLUSTER_LABEL_BY_QUADFILTER = {'0': 'NS', '1': 'HH', '2': 'LH', '3': 'LL', '4': 'HL'}
+
 
 def get_spatials(
         shape, attribute,
@@ -18,7 +31,12 @@ def get_spatials(
         use_moran_rate=False,
         moran_rate_column=None,
         use_moran_bv=False,
-        moran_bv_column=None
+        moran_bv_column=None,
+        weights_cache_dir=None,
+        permutations=999,
+        n_jobs=1,
+        seed=None,
+        topology=None
     ):
     """
     Retona weights, moran global y moran local.
@@ -32,19 +50,23 @@ def get_spatials(
         - use_moran_rate (bool, default=False): Indica si se debe considerar otra columa de la capa como columna de población
         - moran_rate_column (None or str, default=None): 
             Columna de población para calcular los I de Moran.
+        - weights_cache_dir (None or str, default=None): Directorio del cache de pesos
+            (ver `weights_cache`). Si se indica, los pesos se cargan de disco cuando ya
+            fueron calculados para las mismas geometrías, estrategia y argumentos.
+        - permutations (int, default=999): Permutaciones de la aleatorización condicional
+            de los I de Moran locales (ver `permutations.local_moran_inference`).
+        - n_jobs (int, default=1): Procesos entre los que se reparten las permutaciones.
+        - seed (None or int, default=None): Semilla para que los p-valores sean reproducibles.
+        - topology (None or tract_topology.TractTopology, default=None): Topología guardada
+            de la capa; si se indica, las adyacencias y centroides de los pesos salen de ahí.
 
         Returns:
     - w (pysal.lib.weights): Pesos según la capa recibida.
     - moran (esda.moran.Moran): Global Moran object.
     - lisa (esda.moran.Moran_Local): Local Moran object.
     """
-    weights_selection = {
-        'queen': lambda shape, attr: weights.contiguity.Queen.from_dataframe(shape),
-        'rook': lambda shape, attr: weights.contiguity.Rook.from_dataframe(shape),
-        'knn': lambda shape, attr: weights.KNN.from_dataframe(shape, k=attr),
-        'distance_band': lambda shape, attr: weights.DistanceBand.from_dataframe(shape, attr, silence_warnings=True)
-    }    
-    w = weights_selection[strategy](shape, strategy_args)
+    w = weights_cache.get_weights(
+        shape, strategy, strategy_args, cache_dir=weights_cache_dir, topology=topology)
     # Row standardize the matrix
     w.transform = 'R'
 
@@ -58,16 +80,552 @@ def get_spatials(
         moran = esda.moran.Moran(shape[attribute], w)
     lisa = None
     if not w.islands:
+        inference_args = {'permutations': permutations, 'n_jobs': n_jobs, 'seed': seed}
         if use_moran_rate:
-            lisa = esda.Moran_Local_Rate(shape[attribute], shape[moran_rate_column], w)
+            # las permutaciones se calculan aparte, con el motor paralelo
+            lisa = esda.Moran_Local_Rate(shape[attribute], shape[moran_rate_column], w, permutations=0)
+            add_permutation_inference(lisa, **inference_args)
         elif use_moran_bv:
-            lisa = esda.Moran_Local_BV(shape[attribute], shape[moran_bv_column], w)
+            lisa, = local_moran_batch(
+                shape[[attribute]], w, y=shape[[moran_bv_column]], **inference_args)
         else:
-            lisa = esda.Moran_Local(shape[attribute], w)
+            lisa, = local_moran_batch(shape[[attribute]], w, **inference_args)
 
     return w, moran, lisa
 
 
+def get_spatials_batch(
+        shape, analyses,
+        strategy='knn',
+        strategy_args=8,
+        weights_cache_dir=None,
+        permutations=999,
+        n_jobs=1,
+        seed=None,
+        topology=None
+    ):
+    """
+    Moran global y local para varios análisis sobre la misma capa.
+
+    Los pesos se construyen una sola vez y los Moran locales se calculan con una
+    llamada a `local_moran_batch` para todos los univariados y otra para todos los
+    bivariados.
+
+    Args:
+        - analyses (list): Especificación de cada análisis:
+            [
+                {'name': 'univariate', 'attribute': 'casos'},
+                {'name': 'bivariate', 'attribute': 'casos', 'bivariate_attribute': 'nbi'},
+            ]
+        - strategy, strategy_args, weights_cache_dir, permutations, n_jobs, seed, topology:
+            Ver `get_spatials`.
+
+    Returns:
+    - w (pysal.lib.weights): Pesos según la capa recibida.
+    - results (dict): {nombre del análisis: (moran, lisa)}. `lisa` es None si la capa tiene islas.
+    """
+    w = weights_cache.get_weights(
+        shape, strategy, strategy_args, cache_dir=weights_cache_dir, topology=topology)
+    results = get_morans_for_weights(
+        shape, analyses, w,
+        permutations=permutations,
+        n_jobs=n_jobs,
+        seed=seed
+    )
+    return w, results
+
+
+def get_morans_for_weights(data, analyses, w, permutations=999, n_jobs=1, seed=None):
+    """
+    Moran global y local de cada análisis de `analyses` con los pesos `w`.
+    Ver `get_spatials_batch`.
+
+    Returns:
+    - results (dict): {nombre del análisis: (moran, lisa)}.
+    """
+    # Row standardize the matrix
+    w.transform = 'R'
+
+    univariate = [a for a in analyses if not a.get('bivariate_attribute')]
+    bivariate = [a for a in analyses if a.get('bivariate_attribute')]
+
+    lisas = {}
+    if not w.islands:
+        inference_args = {'permutations': permutations, 'n_jobs': n_jobs, 'seed': seed}
+        if univariate:
+            batch = local_moran_batch(
+                data[[a['attribute'] for a in univariate]], w, **inference_args)
+            lisas.update(zip([a['name'] for a in univariate], batch))
+        if bivariate:
+            batch = local_moran_batch(
+                data[[a['attribute'] for a in bivariate]], w,
+                y=data[[a['bivariate_attribute'] for a in bivariate]],
+                **inference_args)
+            lisas.update(zip([a['name'] for a in bivariate], batch))
+
+    results = {}
+    for analysis in analyses:
+        moran = get_global_moran(data, analysis, w, permutations=permutations, seed=seed)
+        results[analysis['name']] = (moran, lisas.get(analysis['name']))
+
+    return results
+
+
+def get_global_moran(data, analysis, w, permutations=999, seed=None):
+    """
+    Moran global (o bivariado) de `analysis`.
+
+    esda permuta con el generador global de numpy: con `seed` se siembra antes de cada
+    análisis (el resultado no depende del orden de `analyses`) y después se restaura su
+    estado.
+    """
+    state = numpy.random.get_state()
+    if seed is not None:
+        numpy.random.seed(seed)
+    try:
+        if analysis.get('bivariate_attribute'):
+            return esda.moran.Moran_BV(
+                data[analysis['attribute']], data[analysis['bivariate_attribute']], w,
+                permutations=permutations)
+        return esda.moran.Moran(data[analysis['attribute']], w, permutations=permutations)
+    finally:
+        numpy.random.set_state(state)
+
+
+def sweep_weight_strategies(
+        shape, analyses, weight_grid,
+        weights_cache_dir=None,
+        permutations=999,
+        n_jobs=1,
+        seed=None,
+        label_by_quadfilter=CLUSTER_LABEL_BY_QUADFILTER,
+        significance=.05,
+        topology=None
+    ):
+    """
+    Análisis de sensibilidad a los pesos: evalúa todos los análisis para cada
+    combinación estrategia x parámetro de `weight_grid`.
+
+    Los pesos de la grilla se construyen compartiendo centroides y KD-tree (ver
+    `weights_cache.get_weights_grid`) y cada configuración se evalúa en un proceso
+    distinto. Todas las configuraciones usan la misma semilla.
+
+    Args:
+        - weight_grid (dict): {estrategia: [parámetros]}, por ejemplo
+            {'rook': [None], 'knn': [4, 6, 8], 'distance_band': [500, 1000]}
+        - n_jobs (int, default=1): Configuraciones evaluadas en paralelo.
+        - label_by_quadfilter (dict): Etiqueta de cada cuadrante significativo (0: no significativo).
+        - significance (float, default=.05): Nivel para contar los clusters.
+        Ver `get_spatials_batch` para el resto.
+
+    Returns:
+        pandas.DataFrame: una fila por configuración y análisis, con el I global, sus
+        p-valores y la cantidad de radios en cada cluster.
+    """
+    grid_weights = weights_cache.get_weights_grid(
+        shape, weight_grid, cache_dir=weights_cache_dir, topology=topology)
+
+    columns = set()
+    for analysis in analyses:
+        columns.add(analysis['attribute'])
+        if analysis.get('bivariate_attribute'):
+            columns.add(analysis['bivariate_attribute'])
+    data = pandas.DataFrame(shape[sorted(columns)])
+
+    jobs = [
+        (strategy, strategy_args, w, data, analyses, permutations, seed, label_by_quadfilter, significance)
+        for (strategy, strategy_args), w in grid_weights.items()
+    ]
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    n_jobs = max(1, min(n_jobs, len(jobs)))
+    if n_jobs == 1:
+        rows = [_evaluate_weights_config(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            rows = list(executor.map(_evaluate_weights_config, *zip(*jobs)))
+
+    sweep_df = pandas.DataFrame([row for config_rows in rows for row in config_rows])
+    # los parámetros tal como en la grilla (enteros, distancias o None), no float con NaN
+    sweep_df['weight_param'] = pandas.array(
+        [row['weight_param'] for config_rows in rows for row in config_rows])
+    return sweep_df
+
+
+def _evaluate_weights_config(strategy, strategy_args, w, data, analyses, permutations, seed, label_by_quadfilter, significance):
+    results = get_morans_for_weights(
+        data, analyses, w, permutations=permutations, seed=seed)
+
+    rows = []
+    for analysis in analyses:
+        moran, lisa = results[analysis['name']]
+        row = {
+            'weight_strategy': strategy,
+            'weight_param': strategy_args,
+            'analysis': analysis['name'],
+            'attribute': analysis['attribute'],
+            'bivariate_attribute': analysis.get('bivariate_attribute'),
+            'mean_neighbors': w.mean_neighbors,
+            'n_islands': len(w.islands),
+            'moran_I': moran.I,
+            'moran_EI': moran.EI_sim,
+            'moran_p_sim': moran.p_sim,
+            'moran_z_sim': moran.z_sim,
+            'moran_p_z_sim': moran.p_z_sim,
+        }
+        quadfilter = None
+        if lisa is not None:
+            quadfilter = (lisa.p_sim <= significance) * lisa.q
+        for key, label in label_by_quadfilter.items():
+            row[label] = numpy.nan if quadfilter is None else int((quadfilter == int(key)).sum())
+        rows.append(row)
+    return rows
+
+
+def _standardize(values):
+    '''z de cada columna (desvío poblacional, como esda).'''
+    values = numpy.asarray(values, dtype=float)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return (values - values.mean(axis=0)) / values.std(axis=0)
+
+
+def local_moran_batch(x, w, y=None, permutations=999, n_jobs=1, seed=None):
+    '''
+    Kernel de I de Moran locales para una matriz de atributos.
+
+    Calcula todas las columnas a la vez: el lag espacial es un único producto
+    matriz dispersa x matriz densa y la inferencia usa los mismos bloques de
+    permutaciones para todas las columnas (ver `permutations.local_moran_inference`).
+    Los resultados son instancias de `esda.Moran_Local` / `esda.Moran_Local_BV`
+    (con `sim=None`), así que se pueden usar donde se usan los objetos de esda.
+
+    Args:
+        - x (pandas.DataFrame or numpy.ndarray): (n, a) variables de cada observación.
+        - w (pysal.lib.weights.W): Pesos. Se estandarizan por fila (igual que esda).
+        - y (None, pandas.DataFrame or numpy.ndarray, default=None): (n, a) variables
+            rezagadas para el Moran local bivariado. La columna j de `y` se analiza
+            contra la columna j de `x`, como `esda.Moran_Local_BV(x_j, y_j, w)`.
+            Si es None se calcula el Moran local univariado de cada columna de `x`.
+        - permutations, n_jobs, seed: Ver `permutations.local_moran_inference`.
+
+    Returns:
+        list: un objeto de esda por columna de `x`.
+    '''
+    bivariate = y is not None
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float) if bivariate else x
+    if x.ndim == 1:
+        x, y = x[:, numpy.newaxis], y[:, numpy.newaxis]
+    assert x.shape == y.shape, "x and y must have the same shape!"
+
+    w.transform = 'R'
+    W = w.sparse.tocsr()
+    n = x.shape[0]
+    zx = _standardize(x)
+    zy = _standardize(y) if bivariate else zx
+
+    # lag espacial de todas las columnas en un solo producto
+    zl = W @ zy
+    den = (zx * zx).sum(axis=0)
+    Is = (n - 1) * zx * zl / den
+
+    zp = zx > 0
+    lp = zl > 0
+    q = 1 * (zp & lp) + 2 * (~zp & lp) + 3 * (~zp & ~lp) + 4 * (zp & ~lp)
+
+    inference = {}
+    if permutations:
+        inference = lisa_permutations.local_moran_inference(
+            zx, zy, Is, w,
+            permutations=permutations,
+            n_jobs=n_jobs,
+            seed=seed
+        )
+
+    if not bivariate:
+        # momentos analíticos (Sokal 1998), igual que esda.Moran_Local
+        wi = numpy.asarray(W.sum(axis=1)).flatten()[:, numpy.newaxis]
+        wi2 = numpy.asarray(W.multiply(W).sum(axis=1)).flatten()[:, numpy.newaxis]
+        m2 = (zx * zx).sum(axis=0) / n
+        m4 = (zx ** 4).sum(axis=0) / n
+        b2 = m4 / m2 ** 2
+        n1 = n - 1
+        EIc = -(zx ** 2 * wi) / (n1 * m2)
+        VIc = (zx / m2) ** 2 * (n / (n - 2)) * (wi2 - wi ** 2 / n1) * (m2 - zx ** 2 / n1)
+        EI = -wi / n1
+        VI = wi2 * (n - b2) / n1 + (wi ** 2 - wi2) * (2 * b2 - n) / (n1 * (n - 2)) - (-wi / n1) ** 2
+
+    lisas = []
+    for j in range(x.shape[1]):
+        attributes = {
+            'n': n,
+            'n_1': n - 1,
+            'w': w,
+            'permutations': permutations,
+            'den': den[j],
+            'Is': Is[:, j],
+            'geoda_quads': False,
+            'quads': [1, 2, 3, 4],
+            'q': q[:, j],
+            'sim': None,
+            'rlisas': None,
+        }
+        attributes.update({name: values[:, j] for name, values in inference.items()})
+        if bivariate:
+            attributes.update({'x': x[:, j], 'y': y[:, j], 'zx': zx[:, j], 'zy': zy[:, j]})
+            lisas.append(spatial_products.new_esda_object(esda.Moran_Local_BV, attributes))
+        else:
+            attributes.update({
+                'y': x[:, j], 'z': zx[:, j],
+                'EIc': EIc[:, j], 'VIc': VIc[:, j],
+                'EI': EI[:, 0], 'VI': VI[:, j],
+            })
+            lisas.append(spatial_products.new_esda_object(esda.Moran_Local, attributes))
+
+    return lisas
+
+
+def add_permutation_inference(lisa, permutations, n_jobs=1, seed=None):
+    '''
+    Agrega a un Moran local de esda calculado con `permutations=0` los atributos
+    de inferencia (`p_sim`, `EI_sim`, `seI_sim`, `VI_sim`, `z_sim`, `p_z_sim`),
+    calculados con `permutations.local_moran_inference`.
+    '''
+    if isinstance(lisa, esda.Moran_Local_BV):
+        focal_z, lagged_z = lisa.zx, lisa.zy
+    else:
+        focal_z, lagged_z = lisa.z, lisa.z
+
+    inference = lisa_permutations.local_moran_inference(
+        focal_z, lagged_z, lisa.Is, lisa.w,
+        permutations=permutations,
+        n_jobs=n_jobs,
+        seed=seed
+    )
+    for attr_name, value in inference.items():
+        setattr(lisa, attr_name, value)
+    lisa.permutations = permutations
+    lisa.sim = lisa.rlisas = None
+    return lisa
+
+
+#
+# LISA en ventanas deslizantes de semanas epidemiológicas
+#
+
+# atributos que se recalculan en cada ventana a partir de los casos de la ventana
+# (mismas fórmulas que `get_cases_for_each_circuit`); el resto se toma de la capa
+WINDOW_CASES_COLUMN = 'casos'
+WINDOW_RATE_POPULATION_COLUMNS = {
+    'tasa_casos': 'totalpobl',
+    'tasa_casos_menores': 'menores_de_un_año',
+}
+
+SLIDING_WINDOW_LISA_VERSION = 1
+
+SLIDING_WINDOW_COLUMNS = [
+    'analysis', 'season', 'start_week', 'end_week', 'toponimo_i', 'Is', 'q', 'p_sim']
+
+
+def get_window_counts(cube, window, seasons=None):
+    """Casos por radio en ventanas deslizantes de `window` semanas dentro de cada temporada.
+
+    Cada paso resta la semana que sale y suma la que entra. Las ventanas van desde la SE
+    1 hasta la última SE con casos de la temporada.
+
+    Args:
+        - cube (case_cube.CaseCube): Cubo de casos.
+        - window (int): Semanas de cada ventana.
+        - seasons (list or None): Temporadas. None usa todas las del cubo.
+
+    Returns:
+        - windows (pandas.DataFrame): `season`, `start_week`, `end_week` de cada ventana.
+        - counts (numpy.ndarray): (radios, ventanas) casos de cada ventana.
+    """
+    if seasons is None:
+        seasons = cube.seasons.tolist()
+    windows = []
+    counts = []
+    for season in seasons:
+        # columna j: SE j + 1
+        weekly = cube.get_weekly_counts(season).astype(numpy.int64)
+        weeks_with_cases = numpy.flatnonzero(weekly.sum(axis=0))
+        if not len(weeks_with_cases):
+            continue
+        last_week = max(int(weeks_with_cases[-1]) + 1, window)
+        current = weekly[:, :window].sum(axis=1)
+        for start_week in range(1, last_week - window + 2):
+            if start_week > 1:
+                current = current - weekly[:, start_week - 2] + weekly[:, start_week + window - 2]
+            windows.append((season, start_week, start_week + window - 1))
+            counts.append(current)
+    windows = pandas.DataFrame(windows, columns=['season', 'start_week', 'end_week'])
+    counts = numpy.column_stack(counts) if counts else numpy.zeros((len(cube.ids), 0), dtype=int)
+    return windows, counts
+
+
+def get_window_attribute(column, counts, data):
+    """Valores de `column` en cada ventana: (radios, ventanas)."""
+    if column == WINDOW_CASES_COLUMN:
+        return counts.astype(float)
+    if column in WINDOW_RATE_POPULATION_COLUMNS:
+        population = data[WINDOW_RATE_POPULATION_COLUMNS[column]].to_numpy(dtype=float)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return counts / population[:, numpy.newaxis] * 10_000
+    values = data[column].to_numpy(dtype=float)
+    return numpy.repeat(values[:, numpy.newaxis], counts.shape[1], axis=1)
+
+
+def _column_hashes(analysis, x, y):
+    """Hash del contenido de cada columna (ventana) de un análisis."""
+    hashes = []
+    for j in range(x.shape[1]):
+        hasher = hashlib.sha256(analysis['name'].encode('utf-8'))
+        hasher.update(numpy.ascontiguousarray(x[:, j]).tobytes())
+        if y is not None:
+            hasher.update(numpy.ascontiguousarray(y[:, j]).tobytes())
+        hashes.append(hasher.hexdigest())
+    return hashes
+
+
+def _is_valid_column(values):
+    with numpy.errstate(invalid='ignore'):
+        return numpy.isfinite(values).all(axis=0) & (numpy.ptp(values, axis=0) > 0)
+
+
+def sliding_window_lisa(
+        cube, data, analyses, w, window,
+        seasons=None,
+        permutations=999,
+        n_jobs=1,
+        seed=None,
+        cache_dir=None
+    ):
+    """
+    Moran local de cada análisis en ventanas deslizantes de `window` SE.
+
+    Las ventanas se obtienen restando la semana que sale y sumando la que entra (ver
+    `get_window_counts`). Cada ventana de cada análisis es una columna de una misma
+    llamada a `local_moran_batch` (una para los univariados y otra para los bivariados):
+    los pesos y los bloques de ids sorteados se comparten entre todas las ventanas.
+
+    Los resultados de una columna sólo dependen de sus valores, de los pesos, de las
+    permutaciones y de la semilla. Si se indica `cache_dir`, se guardan indexados por el
+    contenido de cada columna, y en los builds siguientes sólo se calculan las ventanas
+    nuevas o con casos modificados (p. ej. la ventana de la última semana de la temporada).
+
+    Las ventanas en las que el atributo es constante (sin casos) o no finito (tasas con
+    población 0) no tienen Moran local: quedan con `Is` y `p_sim` nulos y `q` 0.
+
+    Args:
+        - cube (case_cube.CaseCube): Cubo de casos.
+        - data (pandas.DataFrame): Atributos de cada radio, en el orden de `cube.ids`
+            (población para las tasas y atributos fijos como `nbi`).
+        - analyses (list): Como en `get_spatials_batch`. `casos`, `tasa_casos` y
+            `tasa_casos_menores` se calculan con los casos de cada ventana.
+        - w (pysal.lib.weights.W): Pesos en el orden de `cube.ids`.
+        - window (int): Semanas de cada ventana.
+        - seasons, permutations, n_jobs, seed: Ver `get_window_counts` y `get_spatials`.
+        - cache_dir (str or None): Directorio de los resultados por columna.
+
+    Returns:
+        pandas.DataFrame: una fila por análisis, ventana y radio con `Is`, `q` y `p_sim`.
+    """
+    windows, counts = get_window_counts(cube, window, seasons=seasons)
+    w.transform = 'R'
+
+    columns = []
+    for analysis in analyses:
+        x = get_window_attribute(analysis['attribute'], counts, data)
+        y = None
+        if analysis.get('bivariate_attribute'):
+            y = get_window_attribute(analysis['bivariate_attribute'], counts, data)
+        valid = _is_valid_column(x) & (_is_valid_column(y) if y is not None else True)
+        for j, column_hash in enumerate(_column_hashes(analysis, x, y)):
+            columns.append({
+                'analysis': analysis,
+                'window': j,
+                'x': x[:, j],
+                'y': None if y is None else y[:, j],
+                'valid': valid[j],
+                'hash': column_hash,
+            })
+
+    cache_path = None
+    cached = {}
+    if cache_dir is not None:
+        weights_matrix = w.sparse.tocsr()
+        cache_path = os.path.join(cache_dir, cache_utils.hash_key(
+            SLIDING_WINDOW_LISA_VERSION,
+            hashlib.sha256(
+                weights_matrix.indptr.tobytes() + weights_matrix.indices.tobytes()
+                + weights_matrix.data.tobytes()).hexdigest(),
+            permutations,
+            seed
+        ) + '.npz')
+        if os.path.exists(cache_path):
+            with numpy.load(cache_path, allow_pickle=False) as stored:
+                cached = {
+                    column_hash: (Is, q, p_sim)
+                    for column_hash, Is, q, p_sim in zip(
+                        stored['hashes'], stored['Is'], stored['q'], stored['p_sim'])
+                }
+
+    n = len(cube.ids)
+    results = {}
+    for bivariate in (False, True):
+        pending = [
+            column for column in columns
+            if column['valid'] and column['hash'] not in cached
+            and column['hash'] not in results
+            and bool(column['analysis'].get('bivariate_attribute')) == bivariate
+        ]
+        if not pending:
+            continue
+        lisas = local_moran_batch(
+            numpy.column_stack([column['x'] for column in pending]), w,
+            y=numpy.column_stack([column['y'] for column in pending]) if bivariate else None,
+            permutations=permutations,
+            n_jobs=n_jobs,
+            seed=seed
+        )
+        for column, lisa in zip(pending, lisas):
+            results[column['hash']] = (lisa.Is, lisa.q, lisa.p_sim)
+    results.update({key: value for key, value in cached.items() if key not in results})
+
+    empty = (numpy.full(n, numpy.nan), numpy.zeros(n, dtype=int), numpy.full(n, numpy.nan))
+    column_results = [
+        results[column['hash']] if column['valid'] else empty for column in columns]
+
+    if cache_path is not None:
+        valid_hashes = sorted({column['hash'] for column in columns if column['valid']})
+
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as outfile:
+                numpy.savez(
+                    outfile,
+                    hashes=numpy.array(valid_hashes, dtype=str),
+                    Is=numpy.array([results[key][0] for key in valid_hashes]).reshape(-1, n),
+                    q=numpy.array([results[key][1] for key in valid_hashes]).reshape(-1, n),
+                    p_sim=numpy.array([results[key][2] for key in valid_hashes]).reshape(-1, n),
+                )
+        cache_utils.atomic_write(cache_path, write, suffix='.npz')
+
+    window_rows = windows.iloc[[column['window'] for column in columns]]
+    table = pandas.DataFrame({
+        'analysis': numpy.repeat([column['analysis']['name'] for column in columns], n),
+        'season': numpy.repeat(window_rows['season'].to_numpy(), n),
+        'start_week': numpy.repeat(window_rows['start_week'].to_numpy(), n),
+        'end_week': numpy.repeat(window_rows['end_week'].to_numpy(), n),
+        'toponimo_i': numpy.tile(cube.ids, len(columns)),
+        'Is': numpy.concatenate([Is for Is, _, _ in column_results]) if columns else [],
+        'q': numpy.concatenate([q for _, q, _ in column_results]) if columns else [],
+        'p_sim': numpy.concatenate([p for _, _, p in column_results]) if columns else [],
+    })
+    table['toponimo_i'] = table['toponimo_i'].astype('string')
+    return table[SLIDING_WINDOW_COLUMNS]
+
+
 def plot_lisa_map(
         data_map,
         moran_local,
@@ -136,25 +694,19 @@ def plot_lisa_map(
         # Set up figure and axes
         f, ax = plt.subplots(figsize=(12, 12))
 
-    pmarks = []
-    for ctype, data in data_map.assign(cl=labels).groupby('cl'):
-        # Define the color for each group using the dictionary
-        color = tracts_palette[ctype]
-        
-        edge_color = edge_palette[ctype]
-        
-        # Plot each group using the color defined above
-        data.plot(
-            color=color,
-            ax=ax,
-            label=ctype,
-            edgecolor=edge_color
-        )
+    # todas las etiquetas en una sola colección (ver tract_rendering)
+    tract_rendering.plot_categories(
+        ax, data_map.geometry, labels,
+        tracts_palette,
+        edge_palette=edge_palette
+    )
 
+    pmarks = []
+    for ctype, n_tracts in sorted(labels_counter.items()):
         pmarks.append(
             Patch(
-                facecolor=color,
-                label="{} ({})".format(ctype, len(data))
+                facecolor=tracts_palette[ctype],
+                label="{} ({})".format(ctype, n_tracts)
             )
         )
 
@@ -207,19 +759,15 @@ def plot_hot_cold_and_outliers(
     roadPalette = {label: color for label, color in zip(spot_labels, colors_labels)}
     lineWidths = {label: width for label, width in zip(spot_labels, line_labels)}
 
-    shape_vis = shape_vis.assign(cl=labels)
+    # todas las etiquetas en una sola colección (ver tract_rendering)
+    tract_rendering.plot_categories(
+        ax, shape_vis.geometry, labels,
+        roadPalette,
+        linewidth_by_category=lineWidths
+    )
     pmarks = []
-    for ctype, data in shape_vis.groupby('cl'):
-        color = roadPalette[ctype]
-        label = ctype
-
-        data.plot(
-            color=color,
-            ax=ax,
-            linewidth=lineWidths[ctype],
-            label=label
-        )
-        pmarks.append(Patch(facecolor=color, label=label))
+    for ctype in sorted(set(labels)):
+        pmarks.append(Patch(facecolor=roadPalette[ctype], label=ctype))
         
     handles, _ = ax.get_legend_handles_labels()
     ax.legend(
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Formato columnar (versionado) de los productos de Moran global y local.
+
+Cada análisis se guarda en un directorio:
+
+    <análisis>/
+        tracts.parquet   una fila por radio: arrays del Moran local (Is, q, p_sim, z...)
+                         y, con prefijo `moran_`, los del Moran global (y, z o x, y, zx, zy)
+        global.json      versión, clases esda y estadísticos escalares de ambos objetos
+        moran_sim.npy    distribución de referencia del I global (una fila por permutación)
+
+Los pesos se guardan como CSR con `weights_cache.save_weights`. No se guardan las
+simulaciones de los Moran locales (n x permutaciones). Las tareas que sólo necesitan
+algunas columnas (p. ej. `p_sim` y `q` para los mapas de clusters) las leen con
+`load_tract_results(..., columns=[...])` sin reconstruir los objetos de esda.
+"""
+import json
+import os
+
+import esda
+import numpy
+import pandas
+
+from bronchiolitis_package import cache_utils
+from bronchiolitis_package import weights_cache
+
+SPATIAL_PRODUCTS_VERSION = 1
+
+TRACTS_FILENAME = 'tracts.parquet'
+GLOBAL_FILENAME = 'global.json'
+MORAN_SIM_FILENAME = 'moran_sim.npy'
+
+# prefijo de las columnas del Moran global en la tabla por radio
+MORAN_COLUMN_PREFIX = 'moran_'
+
+# atributos que no se serializan (los pesos se guardan aparte)
+EXCLUDED_ATTRIBUTES = ('w', 'sim', 'rlisas')
+
+
+def save_weights(w, path):
+    """Guarda los pesos como CSR (ver `weights_cache.save_weights`)."""
+    weights_cache.save_weights(w, path)
+
+
+def load_weights(path, transform='R'):
+    """Carga los pesos guardados con `save_weights` y les aplica `transform`."""
+    w = weights_cache.load_weights(path)
+    if transform is not None:
+        w.transform = transform
+    return w
+
+
+def _split_attributes(obj, n):
+    """Separa los atributos de un objeto de esda en arrays de largo n y escalares."""
+    columns = {}
+    scalars = {}
+    for name, value in vars(obj).items():
+        if name in EXCLUDED_ATTRIBUTES:
+            continue
+        if isinstance(value, numpy.ndarray) and value.shape == (n,):
+            columns[name] = value
+        elif isinstance(value, (bool, numpy.bool_)):
+            scalars[name] = bool(value)
+        elif isinstance(value, (int, numpy.integer)):
+            scalars[name] = int(value)
+        elif isinstance(value, (float, numpy.floating)) or (
+                isinstance(value, numpy.ndarray) and value.ndim == 0):
+            scalars[name] = float(value)
+        elif isinstance(value, (str, list)):
+            scalars[name] = value
+    return columns, scalars
+
+
+def save_analysis(analysis_dir, moran, lisa, ids=None):
+    """Guarda el Moran global y local de un análisis en formato columnar.
+
+    Args:
+        - analysis_dir (str): Directorio del análisis.
+        - moran (esda.moran.Moran or Moran_BV or Moran_Rate): Moran global.
+        - lisa (esda.moran.Moran_Local or Moran_Local_BV or None): Moran local
+            (None si la capa tiene islas).
+        - ids (array-like or None): Identificador de cada radio (p. ej. `toponimo_i`).
+    """
+    n = moran.w.n
+    moran_columns, moran_scalars = _split_attributes(moran, n)
+    tracts_df = pandas.DataFrame(
+        {f'{MORAN_COLUMN_PREFIX}{name}': values for name, values in moran_columns.items()})
+
+    lisa_type, lisa_scalars = None, {}
+    if lisa is not None:
+        lisa_columns, lisa_scalars = _split_attributes(lisa, n)
+        lisa_type = type(lisa).__name__
+        tracts_df = pandas.concat([pandas.DataFrame(lisa_columns), tracts_df], axis=1)
+    if ids is not None:
+        tracts_df.insert(0, 'id', numpy.asarray(ids))
+
+    global_stats = {
+        'version': SPATIAL_PRODUCTS_VERSION,
+        'moran_type': type(moran).__name__,
+        'lisa_type': lisa_type,
+        'weights_transform': moran.w.transform,
+        'moran': moran_scalars,
+        'lisa': lisa_scalars,
+    }
+
+    os.makedirs(analysis_dir, exist_ok=True)
+    cache_utils.atomic_write(
+        os.path.join(analysis_dir, TRACTS_FILENAME),
+        lambda tmp_path: tracts_df.to_parquet(tmp_path, index=False),
+        suffix='.parquet'
+    )
+    if isinstance(getattr(moran, 'sim', None), numpy.ndarray):
+        cache_utils.atomic_write(
+            os.path.join(analysis_dir, MORAN_SIM_FILENAME),
+            lambda tmp_path: numpy.save(tmp_path, moran.sim),
+            suffix='.npy'
+        )
+
+    def write_json(tmp_path):
+        with open(tmp_path, 'w') as outfile:
+            json.dump(global_stats, outfile, indent=2)
+
+    cache_utils.atomic_write(
+        os.path.join(analysis_dir, GLOBAL_FILENAME), write_json, suffix='.json')
+
+
+def load_global_stats(analysis_dir):
+    """Lee los estadísticos globales de un análisis (sin tocar la tabla por radio)."""
+    with open(os.path.join(analysis_dir, GLOBAL_FILENAME)) as infile:
+        global_stats = json.load(infile)
+    if global_stats.get('version') != SPATIAL_PRODUCTS_VERSION:
+        raise ValueError(
+            f"Versión de producto no soportada en {analysis_dir}: "
+            f"{global_stats.get('version')} (se esperaba {SPATIAL_PRODUCTS_VERSION})")
+    return global_stats
+
+
+def load_tract_results(analysis_dir, columns=None):
+    """Lee la tabla por radio de un análisis.
+
+    Args:
+        - columns (list or None): Columnas a leer (p. ej. ['p_sim', 'q']). None lee todas.
+
+    Returns:
+        pandas.DataFrame
+    """
+    return pandas.read_parquet(
+        os.path.join(analysis_dir, TRACTS_FILENAME), columns=columns)
+
+
+def load_analysis(analysis_dir, w):
+    """Reconstruye los objetos de esda (Moran global y local) de un análisis.
+
+    Los objetos tienen los mismos atributos que los originales salvo las simulaciones
+    de los Moran locales, y sirven para las funciones de graficación de splot.
+
+    Args:
+        - analysis_dir (str): Directorio del análisis.
+        - w (pysal.lib.weights.W): Pesos (ver `load_weights`).
+
+    Returns:
+        - moran, lisa (lisa es None si no se guardó).
+    """
+    global_stats = load_global_stats(analysis_dir)
+    tracts_df = load_tract_results(analysis_dir)
+    if w.transform != global_stats['weights_transform']:
+        w.transform = global_stats['weights_transform']
+
+    moran_attributes = {
+        column[len(MORAN_COLUMN_PREFIX):]: tracts_df[column].to_numpy()
+        for column in tracts_df.columns if column.startswith(MORAN_COLUMN_PREFIX)
+    }
+    moran_attributes.update(global_stats['moran'])
+    moran_attributes['w'] = w
+    moran_sim_path = os.path.join(analysis_dir, MORAN_SIM_FILENAME)
+    if os.path.exists(moran_sim_path):
+        moran_attributes['sim'] = numpy.load(moran_sim_path)
+    moran = new_esda_object(getattr(esda.moran, global_stats['moran_type']), moran_attributes)
+
+    lisa = None
+    if global_stats['lisa_type'] is not None:
+        lisa_attributes = {
+            column: tracts_df[column].to_numpy()
+            for column in tracts_df.columns
+            if column != 'id' and not column.startswith(MORAN_COLUMN_PREFIX)
+        }
+        lisa_attributes.update(global_stats['lisa'])
+        lisa_attributes.update({'w': w, 'sim': None, 'rlisas': None})
+        lisa = new_esda_object(getattr(esda.moran, global_stats['lisa_type']), lisa_attributes)
+
+    return moran, lisa
+
+
+def new_esda_object(cls, attributes):
+    """Instancia una clase de esda sin ejecutar su `__init__`."""
+    instance = cls.__new__(cls)
+    instance.__dict__.update(attributes)
+    return instance
@@ -1,5 +1,9 @@
 from collections import Counter
 
+import numpy
+import shapely
+
+
 def get_colors_for_labels(labels, color_by_labels):
     """Retorna un arreglo de colores para las etiquetas del análisis espacial.
     Existen casos en que no se presentan todas las categorías (por ejemplo no hay
@@ -16,3 +20,95 @@ def get_colors_for_labels(labels, color_by_labels):
             actual_labels.append(label)
     
     return [color_by_labels[label_key] for label_key in actual_labels]
+
+
+def get_point_tract_pairs(points_gdf, tracts_gdf, topology=None):
+    """Retorna todos los pares (punto, radio censal) que se intersectan.
+
+    Reemplaza el doble loop punto x polígono por una consulta masiva al
+    STRtree de los radios. Si todas las geometrías son puntos se usa el camino
+    rápido: candidatos por bounding box y verificación exacta con
+    `shapely.intersects_xy` sobre los polígonos preparados. En otro caso se usa
+    la consulta con predicado del índice espacial (igual que `sjoin`).
+
+    Ambas capas deben estar en el mismo crs.
+
+    Si se pasa `topology` (`tract_topology.TractTopology` de `tracts_gdf`), los
+    candidatos de los puntos salen de su índice guardado en lugar de construir el
+    STRtree.
+
+    Raises:
+        ValueError: si `topology` no corresponde a los radios de `tracts_gdf`.
+
+    Returns:
+        - point_positions (numpy.ndarray): Posición (iloc) de cada punto del par.
+        - tract_positions (numpy.ndarray): Posición (iloc) de cada radio del par.
+        Los pares se devuelven ordenados por punto y, dentro de cada punto, por radio.
+    """
+    point_geoms = numpy.asarray(points_gdf.geometry.values)
+    tract_geoms = numpy.asarray(tracts_gdf.geometry.values)
+
+    if len(point_geoms) == 0 or len(tract_geoms) == 0:
+        empty = numpy.array([], dtype=numpy.intp)
+        return empty, empty.copy()
+
+    if topology is not None and not topology.matches(tracts_gdf):
+        raise ValueError("La topología no corresponde a la capa de radios: ¿cambió la capa?")
+
+    if (shapely.get_type_id(point_geoms) == shapely.GeometryType.POINT).all():
+        shapely.prepare(tract_geoms)
+        x, y = shapely.get_x(point_geoms), shapely.get_y(point_geoms)
+        if topology is not None:
+            point_positions, tract_positions = topology.query_points(x, y)
+        else:
+            tree = shapely.STRtree(tract_geoms)
+            point_positions, tract_positions = tree.query(point_geoms)
+        inside = shapely.intersects_xy(
+            tract_geoms[tract_positions],
+            x[point_positions],
+            y[point_positions]
+        )
+        point_positions = point_positions[inside]
+        tract_positions = tract_positions[inside]
+    else:
+        point_positions, tract_positions = tracts_gdf.sindex.query(
+            points_gdf.geometry, predicate='intersects')
+
+    order = numpy.lexsort((tract_positions, point_positions))
+    return point_positions[order], tract_positions[order]
+
+
+def count_points_in_tracts(points_gdf, tracts_gdf, topology=None):
+    """Cuenta cuántos puntos intersecta cada radio censal.
+
+    Mantiene la semántica de `intersects`: un punto sobre el límite compartido
+    por dos radios se cuenta en ambos.
+
+    Returns:
+        numpy.ndarray: cantidad de puntos por radio, alineado con `tracts_gdf`.
+    """
+    _, tract_positions = get_point_tract_pairs(points_gdf, tracts_gdf, topology=topology)
+    return numpy.bincount(tract_positions, minlength=len(tracts_gdf))
+
+
+def assign_points_to_tracts(points_gdf, tracts_gdf, tract_id_column='toponimo_i', topology=None):
+    """Obtiene el id del radio censal de cada punto.
+
+    Si un punto cae sobre el límite entre radios se asigna el primero según el
+    orden de `tracts_gdf`. Los puntos fuera de todos los radios quedan en NA.
+
+    Returns:
+        pandas.Series: id de radio (`tract_id_column`), alineada con el índice de `points_gdf`.
+    """
+    point_positions, tract_positions = get_point_tract_pairs(
+        points_gdf, tracts_gdf, topology=topology)
+    # los pares vienen ordenados por punto: el primero de cada punto es el radio de menor posición
+    first = numpy.unique(point_positions, return_index=True)[1]
+
+    tract_position = numpy.full(len(points_gdf), -1)
+    tract_position[point_positions[first]] = tract_positions[first]
+
+    # reindexar por posición: -1 no existe y queda como NA
+    assigned = tracts_gdf[tract_id_column].reset_index(drop=True).reindex(tract_position)
+    assigned.index = points_gdf.index
+    return assigned
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Dibujo de capas de radios censales con una sola colección de matplotlib.
+
+`GeoDataFrame.plot` convierte las geometrías a paths de matplotlib en cada llamada, y
+los mapas por categoría (clusters, NBI) lo llaman una vez por grupo de un `groupby`.
+Acá las geometrías se convierten una vez (en bloque, con shapely) y los paths se
+guardan en memoria por hash de geometrías (`cache_utils.geometry_hash`): los mapas
+siguientes de la misma capa, en el mismo proceso, los reutilizan. Todas las categorías
+van en una colección, con colores de relleno y borde por radio.
+
+El resultado es el mismo que con `GeoDataFrame.plot`: un path compuesto por geometría
+(partes y agujeros, anillos cerrados), los radios ordenados como en el `groupby` (por
+categoría y, dentro de ella, en el orden de la capa) y el mismo aspecto del eje. Para
+la leyenda se agrega al eje una colección vacía por categoría con su etiqueta, de modo
+que `ax.get_legend_handles_labels()` devuelve lo mismo que antes.
+"""
+from collections import OrderedDict
+
+import numpy
+import pandas
+import shapely
+from matplotlib.collections import PathCollection, PolyCollection
+from matplotlib.path import Path
+
+from bronchiolitis_package import cache_utils
+
+# capas (hashes de geometrías) cuyos paths se mantienen en memoria
+MAX_CACHED_LAYERS = 16
+
+_paths_by_hash = OrderedDict()
+
+
+def build_tract_paths(geometries):
+    """Un path compuesto por geometría (None si es vacía o nula), como `GeoDataFrame.plot`.
+
+    Args:
+        geometries (geopandas.GeoSeries): (Multi)polígonos.
+
+    Returns:
+        list: `matplotlib.path.Path` o None, en el orden de `geometries`.
+    """
+    parts, geometry_index = shapely.get_parts(geometries.values, return_index=True)
+    rings, part_index = shapely.get_rings(parts, return_index=True)
+    coords, ring_index = shapely.get_coordinates(rings, return_index=True)
+
+    # anillos cerrados: MOVETO, LINETO..., CLOSEPOLY
+    codes = numpy.full(len(coords), Path.LINETO, dtype=Path.code_type)
+    ring_sizes = numpy.bincount(ring_index, minlength=len(rings))
+    ring_ends = numpy.cumsum(ring_sizes)
+    ring_starts = ring_ends - ring_sizes
+    codes[ring_starts[ring_sizes > 0]] = Path.MOVETO
+    codes[ring_ends[ring_sizes > 0] - 1] = Path.CLOSEPOLY
+
+    # vértices de cada geometría (los anillos están ordenados por parte y geometría)
+    vertex_geometry = geometry_index[part_index[ring_index]]
+    bounds = numpy.searchsorted(vertex_geometry, numpy.arange(len(geometries) + 1))
+    return [
+        Path(coords[start:end], codes[start:end]) if end > start else None
+        for start, end in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+def get_tract_paths(geometries):
+    """Paths de `build_tract_paths`, del cache en memoria si la capa ya se convirtió."""
+    key = cache_utils.geometry_hash(geometries)
+    paths = _paths_by_hash.get(key)
+    if paths is None:
+        paths = build_tract_paths(geometries)
+        _paths_by_hash[key] = paths
+        while len(_paths_by_hash) > MAX_CACHED_LAYERS:
+            _paths_by_hash.popitem(last=False)
+    else:
+        _paths_by_hash.move_to_end(key)
+    return paths
+
+
+def set_map_aspect(ax, geometries):
+    """Aspecto del eje como `GeoDataFrame.plot` (corrección por latitud en crs geográficos)."""
+    if geometries.crs and geometries.crs.is_geographic:
+        bounds = geometries.total_bounds
+        y_coord = numpy.mean([bounds[1], bounds[3]])
+        ax.set_aspect(1 / numpy.cos(y_coord * numpy.pi / 180))
+    else:
+        ax.set_aspect('equal')
+
+
+def plot_tracts(
+        ax, geometries,
+        facecolors,
+        edgecolors=None,
+        linewidths=None,
+        alpha=None,
+        order=None
+    ):
+    """Dibuja los radios en una sola colección.
+
+    Args:
+        - geometries (geopandas.GeoSeries): (Multi)polígonos.
+        - facecolors, edgecolors, linewidths: Un valor (str o número) o una lista con
+            uno por radio. Sin `edgecolors` el borde es el de matplotlib (sin borde si
+            hay relleno).
+        - alpha (float or None): Transparencia de toda la colección.
+        - order (numpy.ndarray or None): Posiciones de los radios a dibujar, en orden de
+            dibujo (None: todos, en el orden de la capa). Los valores por radio se
+            indexan con estas posiciones.
+
+    Returns:
+        matplotlib.collections.PathCollection
+    """
+    paths = get_tract_paths(geometries)
+    if order is None:
+        order = numpy.arange(len(paths))
+    order = numpy.asarray([position for position in order if paths[position] is not None], dtype=int)
+
+    def per_tract(values):
+        if values is None or isinstance(values, str) or numpy.ndim(values) == 0:
+            return values
+        return [values[position] for position in order]
+
+    collection = PathCollection(
+        [paths[position] for position in order],
+        facecolors=per_tract(facecolors),
+        edgecolors=per_tract(edgecolors),
+        linewidths=per_tract(linewidths),
+        alpha=alpha
+    )
+    ax.add_collection(collection, autolim=True)
+    ax.autoscale_view()
+    set_map_aspect(ax, geometries)
+    return collection
+
+
+def plot_categories(
+        ax, geometries, categories,
+        tracts_palette,
+        edge_palette=None,
+        linewidth_by_category=None,
+        alpha=None
+    ):
+    """Dibuja los radios pintados por categoría, como un `GeoDataFrame.plot` por cada
+    grupo de `groupby(categories)`, pero en una sola colección.
+
+    Args:
+        - categories (array-like): Categoría de cada radio (los nulos no se dibujan).
+        - tracts_palette (dict): Color de relleno por categoría.
+        - edge_palette (dict or None): Color de borde por categoría.
+        - linewidth_by_category (dict or None): Ancho de borde por categoría.
+        - alpha (float or None): Transparencia de toda la colección.
+
+    Returns:
+        - collection (matplotlib.collections.PathCollection): Los radios.
+        - handles (list): Una colección vacía por categoría (en el orden del `groupby`),
+            con la etiqueta y el estilo de la categoría, agregadas al eje para la leyenda.
+    """
+    categories = pandas.Series(numpy.asarray(categories, dtype=object))
+    present = sorted(categories.dropna().unique())
+    codes = pandas.Categorical(categories, categories=present).codes
+    order = numpy.flatnonzero(codes >= 0)
+    order = order[numpy.argsort(codes[order], kind='stable')]
+
+    def per_tract(palette):
+        if palette is None:
+            return None
+        lookup = [palette[category] for category in present]
+        return [lookup[code] if code >= 0 else None for code in codes]
+
+    collection = plot_tracts(
+        ax, geometries,
+        facecolors=per_tract(tracts_palette),
+        edgecolors=per_tract(edge_palette),
+        linewidths=per_tract(linewidth_by_category),
+        alpha=alpha,
+        order=order
+    )
+
+    handles = []
+    for category in present:
+        handle = PolyCollection(
+            [],
+            facecolors=tracts_palette[category],
+            edgecolors=None if edge_palette is None else edge_palette[category],
+            linewidths=None if linewidth_by_category is None else linewidth_by_category[category],
+            alpha=alpha,
+            label=category
+        )
+        ax.add_collection(handle, autolim=False)
+        handles.append(handle)
+    return collection, handles
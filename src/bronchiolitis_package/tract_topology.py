@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Topología de la capa de radios censales, calculada una vez y guardada en disco.
+
+Contiene:
+    - ids de los radios (en el orden de la capa)
+    - centroides y bounding boxes
+    - una grilla regular de buckets sobre los bounding boxes (consultas por punto: un
+      lookup por punto)
+    - adyacencias rook (lado compartido) y queen (vértice compartido) como CSR
+
+Se guarda en un `.npz` (sólo arrays, sin pickle) y se indexa por el hash de las
+geometrías: si la capa no cambia, el producto se copia del cache en lugar de
+recalcularse. El conteo de casos por radio, los pesos de contigüidad y los de
+distancia (centroides) se obtienen de acá en lugar de recalcularse en cada tarea.
+"""
+import os
+
+import numpy
+import shapely
+from scipy import sparse
+from pysal.lib import weights
+
+from bronchiolitis_package import cache_utils
+
+TRACT_TOPOLOGY_VERSION = 1
+
+
+def build_grid(bounds, total_bounds):
+    """Grilla regular con ~1 celda por radio; cada celda lista los radios cuyo bounding
+    box la toca.
+
+    Returns:
+        - grid_shape (numpy.ndarray): (columnas, filas).
+        - cell_size (float)
+        - indptr, indices (numpy.ndarray): CSR celda -> radios.
+    """
+    width = max(total_bounds[2] - total_bounds[0], numpy.finfo(float).tiny)
+    height = max(total_bounds[3] - total_bounds[1], numpy.finfo(float).tiny)
+    cell_size = numpy.sqrt(width * height / len(bounds))
+    grid_shape = numpy.array([
+        int(width // cell_size) + 1,
+        int(height // cell_size) + 1,
+    ])
+
+    low = _cell_coordinates(bounds[:, :2], total_bounds, cell_size, grid_shape)
+    high = _cell_coordinates(bounds[:, 2:], total_bounds, cell_size, grid_shape)
+    spans = high - low + 1
+    counts = spans[:, 0] * spans[:, 1]
+    tracts = numpy.repeat(numpy.arange(len(bounds)), counts)
+    offsets = _ragged_arange(counts)
+    cx = low[tracts, 0] + offsets % spans[tracts, 0]
+    cy = low[tracts, 1] + offsets // spans[tracts, 0]
+    cells = cy * grid_shape[0] + cx
+
+    order = numpy.argsort(cells, kind='stable')
+    indptr = numpy.concatenate([
+        [0], numpy.cumsum(numpy.bincount(cells, minlength=grid_shape[0] * grid_shape[1]))])
+    return grid_shape, cell_size, indptr, tracts[order]
+
+
+def _cell_coordinates(xy, total_bounds, cell_size, grid_shape):
+    cells = numpy.floor((xy - total_bounds[:2]) / cell_size).astype(numpy.int64)
+    return numpy.clip(cells, 0, grid_shape - 1)
+
+
+def _contiguity_csr(tracts, strategy):
+    builder = weights.contiguity.Rook if strategy == 'rook' else weights.contiguity.Queen
+    w = builder.from_dataframe(
+        tracts.reset_index(drop=True), use_index=False, silence_warnings=True)
+    return w.sparse.tocsr()
+
+
+class TractTopology:
+    """Topología de la capa (ver docstring del módulo)."""
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.ids = arrays['ids']
+        self.centroids = arrays['centroids']
+        self.bounds = arrays['bounds']
+        self.geometry_hash = str(arrays['geometry_hash'])
+        self.id_column = str(arrays['id_column'])
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, tracts, id_column='toponimo_i'):
+        """Calcula la topología de `tracts` (geopandas.GeoDataFrame)."""
+        geometries = numpy.asarray(tracts.geometry.values)
+        bounds = shapely.bounds(geometries)
+        total_bounds = numpy.array([
+            bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max()])
+        grid_shape, cell_size, grid_indptr, grid_indices = build_grid(bounds, total_bounds)
+        rook = _contiguity_csr(tracts, 'rook')
+        queen = _contiguity_csr(tracts, 'queen')
+        return cls({
+            'version': numpy.array(TRACT_TOPOLOGY_VERSION),
+            'geometry_hash': numpy.array(cache_utils.geometry_hash(tracts.geometry)),
+            'crs': numpy.array(tracts.crs.to_string() if tracts.crs is not None else ''),
+            'id_column': numpy.array(id_column),
+            'ids': tracts[id_column].astype(str).to_numpy(dtype=str),
+            'centroids': shapely.get_coordinates(shapely.centroid(geometries)),
+            'bounds': bounds,
+            'total_bounds': total_bounds,
+            'grid_shape': grid_shape,
+            'grid_cell_size': numpy.array(cell_size),
+            'grid_indptr': grid_indptr,
+            'grid_indices': grid_indices,
+            'rook_indptr': rook.indptr,
+            'rook_indices': rook.indices,
+            'queen_indptr': queen.indptr,
+            'queen_indices': queen.indices,
+        })
+
+    def save(self, path):
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as outfile:
+                numpy.savez(outfile, **self.arrays)
+        cache_utils.atomic_write(path, write, suffix='.npz')
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(str(path), allow_pickle=False) as stored:
+            arrays = {name: stored[name] for name in stored.files}
+        if int(arrays['version']) != TRACT_TOPOLOGY_VERSION:
+            raise ValueError(
+                f"Versión de topología no soportada en {path}: {int(arrays['version'])} "
+                f"(se esperaba {TRACT_TOPOLOGY_VERSION})")
+        return cls(arrays)
+
+    #
+    # índice espacial
+    #
+
+    def query_points(self, x, y):
+        """Pares (punto, radio) con el punto dentro del bounding box del radio.
+
+        Usa la grilla: cada punto se ubica en su celda y se comparan sólo los radios
+        de esa celda.
+        """
+        xy = numpy.column_stack([x, y]).astype(float)
+        total_bounds = self.arrays['total_bounds']
+        inside = (
+            (xy[:, 0] >= total_bounds[0]) & (xy[:, 0] <= total_bounds[2])
+            & (xy[:, 1] >= total_bounds[1]) & (xy[:, 1] <= total_bounds[3])
+        )
+        points = numpy.flatnonzero(inside)
+        grid_shape = self.arrays['grid_shape']
+        cells = _cell_coordinates(
+            xy[points], total_bounds, float(self.arrays['grid_cell_size']), grid_shape)
+        cells = cells[:, 1] * grid_shape[0] + cells[:, 0]
+
+        indptr = self.arrays['grid_indptr']
+        counts = indptr[cells + 1] - indptr[cells]
+        queries = numpy.repeat(points, counts)
+        tracts = self.arrays['grid_indices'][
+            numpy.repeat(indptr[cells], counts) + _ragged_arange(counts)]
+        keep = _intersects(self.bounds[tracts], numpy.column_stack([xy[queries], xy[queries]]))
+        return queries[keep], tracts[keep]
+
+    #
+    # alineación con otras capas y pesos
+    #
+
+    def get_positions(self, ids):
+        """Posición en la topología de cada id de `ids`.
+
+        Raises:
+            ValueError: si algún id no está en la topología.
+        """
+        ids = numpy.asarray(ids).astype(str)
+        sorter = numpy.argsort(self.ids)
+        found = numpy.searchsorted(self.ids, ids, sorter=sorter)
+        found = sorter[numpy.minimum(found, len(sorter) - 1)]
+        if len(ids) and not (self.ids[found] == ids).all():
+            raise ValueError("Hay radios que no están en la topología: ¿cambió la capa?")
+        return found
+
+    def matches(self, tracts):
+        """La capa tiene los mismos radios y en el mismo orden que la topología."""
+        return len(tracts) == len(self) and (
+            tracts[self.id_column].astype(str).to_numpy(dtype=str) == self.ids).all()
+
+    def get_adjacency(self, strategy, ids=None):
+        """Adyacencia `rook` o `queen` (CSR binaria), opcionalmente en el orden de `ids`."""
+        adjacency = sparse.csr_matrix(
+            (
+                numpy.ones(len(self.arrays[f'{strategy}_indices'])),
+                self.arrays[f'{strategy}_indices'],
+                self.arrays[f'{strategy}_indptr'],
+            ),
+            shape=(len(self), len(self))
+        )
+        if ids is not None:
+            positions = self.get_positions(ids)
+            adjacency = adjacency[positions][:, positions]
+        return adjacency
+
+    def get_contiguity_weights(self, strategy, ids=None):
+        """Pesos de contigüidad (como `Rook/Queen.from_dataframe`) en el orden de `ids`."""
+        adjacency = self.get_adjacency(strategy, ids=ids)
+        return weights.WSP(adjacency, id_order=list(range(adjacency.shape[0]))).to_W(
+            silence_warnings=True)
+
+    def get_centroids(self, ids=None):
+        if ids is None:
+            return self.centroids
+        return self.centroids[self.get_positions(ids)]
+
+
+def _intersects(boxes, query_bounds):
+    return (
+        (boxes[:, 0] <= query_bounds[:, 2]) & (boxes[:, 2] >= query_bounds[:, 0])
+        & (boxes[:, 1] <= query_bounds[:, 3]) & (boxes[:, 3] >= query_bounds[:, 1])
+    )
+
+
+def _ragged_arange(counts):
+    """Concatenación de arange(c) para cada c de `counts`."""
+    ends = numpy.cumsum(counts)
+    return numpy.arange(ends[-1] if len(ends) else 0) - numpy.repeat(ends - counts, counts)
+
+
+def get_tract_topology(tracts, cache_dir=None, id_column='toponimo_i'):
+    """Topología de `tracts`, leída del cache (por hash de geometrías) si ya fue calculada."""
+    if cache_dir is None:
+        return TractTopology.build(tracts, id_column=id_column)
+
+    key = cache_utils.hash_key(
+        TRACT_TOPOLOGY_VERSION, cache_utils.geometry_hash(tracts.geometry),
+        tracts[id_column].astype(str).tolist())
+    cache_path = os.path.join(cache_dir, f'{key}.npz')
+    if os.path.exists(cache_path):
+        return TractTopology.load(cache_path)
+
+    topology = TractTopology.build(tracts, id_column=id_column)
+    topology.save(cache_path)
+    return topology
+
+
+def save_tract_topology(tracts, path, cache_dir=None, id_column='toponimo_i'):
+    """Guarda la topología en `path`, copiándola del cache si la capa no cambió."""
+    topology = get_tract_topology(tracts, cache_dir=cache_dir, id_column=id_column)
+    topology.save(str(path))
+    return topology
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Cache GeoParquet de la capa de radios censales.
+
+El shapefile se decodifica una sola vez a un GeoParquet con todas sus columnas; las
+tareas que necesitan la capa (o sólo algunos atributos) leen de ahí únicamente las
+columnas que usan.
+
+La clave del cache es el hash del contenido de los archivos del shapefile (.shp, .dbf,
+.shx, .prj, .cpg). Para no recalcular el hash en cada build, se guarda junto con el
+tamaño y la fecha de modificación de cada archivo (`sources.json`): si no cambiaron,
+se reutiliza el hash guardado.
+"""
+import os
+
+import geopandas
+import pandas
+
+from bronchiolitis_package import cache_utils
+
+TRACTS_CACHE_VERSION = 1
+
+SHAPEFILE_COMPONENTS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+
+def get_source_files(shapefile_path):
+    """Archivos existentes que componen el shapefile."""
+    base, _ = os.path.splitext(shapefile_path)
+    return [
+        base + extension for extension in SHAPEFILE_COMPONENTS
+        if os.path.exists(base + extension)
+    ]
+
+
+def get_source_hash(shapefile_path, cache_dir):
+    """Hash del contenido del shapefile, reutilizando el guardado si no cambiaron
+    el tamaño ni la fecha de modificación de ninguno de sus archivos."""
+    paths = get_source_files(shapefile_path)
+    file_hashes = cache_utils.get_file_hashes(paths, cache_dir)
+    return cache_utils.hash_key(
+        TRACTS_CACHE_VERSION,
+        [(os.path.splitext(path)[1], sha256) for path, sha256 in zip(paths, file_hashes)]
+    )
+
+
+def get_tracts_parquet(shapefile_path, cache_dir):
+    """Ruta del GeoParquet con la capa completa, decodificando el shapefile si hace falta."""
+    cache_path = os.path.join(
+        cache_dir, f'{get_source_hash(shapefile_path, cache_dir)}.parquet')
+    if not os.path.exists(cache_path):
+        tracts = geopandas.read_file(shapefile_path)
+        cache_utils.atomic_write(
+            cache_path,
+            lambda tmp_path: tracts.to_parquet(tmp_path, index=False),
+            suffix='.parquet'
+        )
+    return cache_path
+
+
+def read_tracts(shapefile_path, columns=None, cache_dir=None):
+    """Lee la capa (o algunas columnas) a través del cache.
+
+    Args:
+        - shapefile_path (str): Shapefile de radios censales.
+        - columns (list or None): Columnas a leer. Si no incluye `geometry` se
+            devuelve un pandas.DataFrame. None lee todas.
+        - cache_dir (str or None): Directorio del cache. None lee el shapefile directamente.
+
+    Returns:
+        geopandas.GeoDataFrame or pandas.DataFrame
+    """
+    if cache_dir is None:
+        tracts = geopandas.read_file(shapefile_path)
+        if columns is None:
+            return tracts
+        return tracts[columns] if 'geometry' in columns else pandas.DataFrame(tracts[columns])
+
+    cache_path = get_tracts_parquet(shapefile_path, cache_dir)
+    if columns is None or 'geometry' in columns:
+        return geopandas.read_parquet(cache_path, columns=columns)
+    return pandas.read_parquet(cache_path, columns=columns)
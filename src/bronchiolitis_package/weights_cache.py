@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Cache persistente de pesos espaciales.
+
+La clave es el hash de la columna de geometrías + estrategia + argumentos, por lo que
+las tareas que trabajan sobre los mismos radios censales (y los builds siguientes)
+cargan los pesos en lugar de recalcularlos. Se guardan los pesos originales (binarios)
+como matriz dispersa CSR en un `.npz`; la estandarización se aplica después de cargar.
+"""
+import os
+
+import numpy
+import shapely
+from scipy import sparse
+from scipy.spatial import cKDTree
+from pysal.lib import weights
+
+from bronchiolitis_package import cache_utils
+
+WEIGHTS_CACHE_VERSION = 1
+
+WEIGHTS_BUILDERS = {
+    'queen': lambda shape, attr: weights.contiguity.Queen.from_dataframe(shape),
+    'rook': lambda shape, attr: weights.contiguity.Rook.from_dataframe(shape),
+    'knn': lambda shape, attr: weights.KNN.from_dataframe(shape, k=attr),
+    'distance_band': lambda shape, attr: weights.DistanceBand.from_dataframe(shape, attr, silence_warnings=True)
+}
+
+# mismos pesos, a partir de la topología guardada de la capa (ver `tract_topology`)
+TOPOLOGY_WEIGHTS_BUILDERS = {
+    'queen': lambda topology, ids, attr: topology.get_contiguity_weights('queen', ids=ids),
+    'rook': lambda topology, ids, attr: topology.get_contiguity_weights('rook', ids=ids),
+    'knn': lambda topology, ids, attr: weights.KNN.from_array(topology.get_centroids(ids), k=attr),
+    'distance_band': lambda topology, ids, attr: weights.DistanceBand.from_array(
+        topology.get_centroids(ids), attr, silence_warnings=True)
+}
+
+# estrategias en las que `strategy_args` no interviene
+CONTIGUITY_STRATEGIES = ('queen', 'rook')
+
+
+def build_weights(shape, strategy, strategy_args, topology=None):
+    """Construye los pesos sin pasar por el cache.
+
+    Si se pasa `topology` (`tract_topology.TractTopology` de la capa), las adyacencias
+    y los centroides salen de ahí en lugar de calcularse sobre las geometrías.
+    """
+    if topology is not None:
+        return TOPOLOGY_WEIGHTS_BUILDERS[strategy](
+            topology, shape[topology.id_column], strategy_args)
+    return WEIGHTS_BUILDERS[strategy](shape, strategy_args)
+
+
+def get_weights_key(shape, strategy, strategy_args):
+    """Clave de cache para los pesos de `shape` según estrategia y argumentos."""
+    if strategy in CONTIGUITY_STRATEGIES:
+        strategy_args = None
+    return cache_utils.hash_key(
+        WEIGHTS_CACHE_VERSION,
+        cache_utils.geometry_hash(shape.geometry),
+        strategy,
+        strategy_args
+    )
+
+
+def get_weights(shape, strategy, strategy_args, cache_dir=None, topology=None):
+    """Retorna los pesos de `shape`, usando el cache en disco si se indica.
+
+    Args:
+        - shape (geopandas.GeoDataFrame): Capa.
+        - strategy (str): Valor en ['queen', 'rook', 'knn', 'distance_band']
+        - strategy_args: Ver `spatial.get_spatials`.
+        - cache_dir (str or None): Directorio del cache. None desactiva el cache.
+        - topology (tract_topology.TractTopology or None): Topología de la capa (ver
+            `build_weights`).
+
+    Returns:
+        - w (pysal.lib.weights.W): Pesos sin estandarizar.
+    """
+    if strategy not in WEIGHTS_BUILDERS:
+        raise ValueError(
+            f"Estrategia desconocida: {strategy}. Valores posibles: {list(WEIGHTS_BUILDERS)}")
+
+    if cache_dir is None:
+        return build_weights(shape, strategy, strategy_args, topology=topology)
+
+    cache_path = os.path.join(
+        cache_dir, f"{get_weights_key(shape, strategy, strategy_args)}.npz")
+    if os.path.exists(cache_path):
+        return load_weights(cache_path)
+
+    w = build_weights(shape, strategy, strategy_args, topology=topology)
+    save_weights(w, cache_path)
+    return w
+
+
+def save_weights(w, path):
+    """Guarda los pesos como CSR (data, indices, indptr) + ids en un `.npz`."""
+    matrix = w.sparse.tocsr()
+
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as outfile:
+            numpy.savez_compressed(
+                outfile,
+                version=WEIGHTS_CACHE_VERSION,
+                data=matrix.data,
+                indices=matrix.indices,
+                indptr=matrix.indptr,
+                shape=numpy.array(matrix.shape),
+                ids=numpy.asarray(w.id_order)
+            )
+
+    cache_utils.atomic_write(path, write, suffix='.npz')
+
+
+def load_weights(path):
+    """Carga los pesos guardados con `save_weights`."""
+    with numpy.load(path, allow_pickle=False) as stored:
+        matrix = sparse.csr_matrix(
+            (stored['data'], stored['indices'], stored['indptr']),
+            shape=tuple(stored['shape'])
+        )
+        ids = stored['ids'].tolist()
+    return weights.WSP(matrix, id_order=ids).to_W(silence_warnings=True)
+
+
+def get_weights_grid(shape, weight_grid, cache_dir=None, topology=None):
+    """Pesos para una grilla de estrategias y parámetros sobre la misma capa.
+
+    Los centroides y el KD-tree se calculan una sola vez: todos los `knn` salen de una
+    única consulta con el k máximo y todas las `distance_band` de una única matriz de
+    distancias con el radio máximo. Si se indica `cache_dir` se reutilizan (y guardan)
+    los pesos del cache en disco. Con empates exactos de distancia, el desempate de
+    `knn` puede diferir del de `KNN.from_dataframe`. Con `topology` los centroides y
+    las adyacencias salen de la topología guardada (ver `build_weights`).
+
+    Args:
+        - weight_grid (dict): {estrategia: [parámetros]}, por ejemplo
+            {'rook': [None], 'knn': [4, 6, 8], 'distance_band': [500, 1000]}
+
+    Returns:
+        dict: {(estrategia, parámetro): pysal.lib.weights.W} (pesos sin estandarizar).
+    """
+    grid_weights = {}
+    pending = {}
+    for strategy, strategy_args_list in weight_grid.items():
+        if strategy not in WEIGHTS_BUILDERS:
+            raise ValueError(
+                f"Estrategia desconocida: {strategy}. Valores posibles: {list(WEIGHTS_BUILDERS)}")
+        for strategy_args in strategy_args_list:
+            cache_path = None
+            if cache_dir is not None:
+                cache_path = os.path.join(
+                    cache_dir, f"{get_weights_key(shape, strategy, strategy_args)}.npz")
+                if os.path.exists(cache_path):
+                    grid_weights[(strategy, strategy_args)] = load_weights(cache_path)
+                    continue
+            pending[(strategy, strategy_args)] = cache_path
+
+    distance_configs = [
+        config for config in pending if config[0] in ('knn', 'distance_band')]
+    if distance_configs:
+        if topology is not None:
+            centroids = topology.get_centroids(shape[topology.id_column])
+        else:
+            centroids = shapely.get_coordinates(shapely.centroid(shape.geometry.values))
+        tree = cKDTree(centroids)
+
+        knn_values = [k for strategy, k in distance_configs if strategy == 'knn']
+        if knn_values:
+            _, nearest = tree.query(centroids, k=max(knn_values) + 1)
+            for k in knn_values:
+                grid_weights[('knn', k)] = _knn_from_query(nearest, k)
+
+        thresholds = [t for strategy, t in distance_configs if strategy == 'distance_band']
+        if thresholds:
+            distances = tree.sparse_distance_matrix(
+                tree, max(thresholds), output_type='coo_matrix')
+            for threshold in thresholds:
+                grid_weights[('distance_band', threshold)] = _distance_band_from_matrix(
+                    distances, threshold)
+
+    for (strategy, strategy_args), cache_path in pending.items():
+        if (strategy, strategy_args) not in grid_weights:
+            grid_weights[(strategy, strategy_args)] = build_weights(
+                shape, strategy, strategy_args, topology=topology)
+        if cache_path is not None:
+            save_weights(grid_weights[(strategy, strategy_args)], cache_path)
+
+    return grid_weights
+
+
+def _knn_from_query(nearest, k):
+    """KNN a partir de una consulta al KD-tree con k >= `k` + 1 (descarta la propia observación)."""
+    neighbors = {}
+    for i, row in enumerate(nearest):
+        row = row[row != i]
+        neighbors[i] = row[:k].tolist()
+    return weights.W(neighbors, silence_warnings=True)
+
+
+def _distance_band_from_matrix(distances, threshold):
+    """Banda de distancia binaria a partir de una matriz de distancias con radio >= `threshold`."""
+    mask = (distances.data <= threshold) & (distances.row != distances.col)
+    n = distances.shape[0]
+    matrix = sparse.csr_matrix(
+        (numpy.ones(mask.sum()), (distances.row[mask], distances.col[mask])),
+        shape=(n, n)
+    )
+    return weights.WSP(matrix, id_order=list(range(n))).to_W(silence_warnings=True)
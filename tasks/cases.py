@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 import pandas
 import geopandas
+from bronchiolitis_package import case_cube
+from bronchiolitis_package import spatial_utils
+from bronchiolitis_package import tract_topology
 
 def get_cases_for_each_circuit(upstream, product):
     """
@@ -16,34 +19,27 @@ def get_cases_for_each_circuit(upstream, product):
             1      321999      X         6       X
             2      319126      X         5       X
     """
-    # read bronchiolitis
-    bronchiolitis_gdf = geopandas.read_parquet(upstream['get_bronchiolitis_locations'])
+    # read bronchiolitis (ya en el crs de los radios)
+    bronchiolitis_gdf = geopandas.read_parquet(
+        upstream['get_bronchiolitis_locations']['projected_points'], columns=['geometry'])
 
     # read shape:
     puerto_madryn_shp = geopandas.read_parquet(upstream['get_shape'])
     COL_YOUNG_POPULATION = 'menores_de_un_año'
     COL_TOTAL_POPULATION = 'totalpobl'
-    # use same crs:
-    bronchiolitis_gdf = bronchiolitis_gdf.to_crs(puerto_madryn_shp.crs.to_string())
 
-    # count:
-    cases_per_census_unit = []
-    for _, census_unit in puerto_madryn_shp.iterrows():
-        # count intersections vs all se points
-        intersections = []
-        for _, point in bronchiolitis_gdf.iterrows():
-            intersections.append(census_unit.geometry.intersects(point.geometry))
-
-        cases_per_census_unit.append(
-            {
-                'toponimo_i': census_unit.toponimo_i,
-                'casos': len(list(filter(bool, intersections)))
-            }
-        )
-    # -
+    # count (intersects, mismo criterio que el conteo punto a punto),
+    # con el índice espacial guardado de la capa:
+    topology = tract_topology.TractTopology.load(upstream['get_tract_topology'])
+    cases_per_census_unit = spatial_utils.count_points_in_tracts(
+        bronchiolitis_gdf, puerto_madryn_shp, topology=topology)
+    cases_df = pandas.DataFrame({
+        'toponimo_i': puerto_madryn_shp['toponimo_i'].values,
+        'casos': cases_per_census_unit
+    })
 
     # save:
-    cases_df = pandas.DataFrame(cases_per_census_unit)\
+    cases_df = cases_df\
         .sort_values(by="casos", ascending=False)\
         .reset_index(drop=True)
     
@@ -71,3 +67,26 @@ def get_cases_for_each_circuit(upstream, product):
     
     # save geodataframe
     output_gdf.to_parquet(str(product), index=False)
+
+
+def get_case_cube(upstream, product):
+    """
+    Cubo espacio-temporal de casos: radio x temporada (año de ingreso) x semana
+    epidemiológica x internación/reinternación (ver `case_cube`).
+
+    Permite obtener los casos por radio de cualquier ventana de semanas sin volver a
+    correr el pipeline filtrando los datos:
+
+        cube = case_cube.CaseCube.load(upstream['get-case-cube'])
+        cube.get_window((2018, 20), (2018, 26))
+    """
+    bronchiolitis_gdf = geopandas.read_parquet(
+        upstream['get_bronchiolitis_locations']['projected_points'],
+        columns=['ingreso', 'se', 'es_reinternacion', 'geometry'])
+    puerto_madryn_shp = geopandas.read_parquet(
+        upstream['get_shape'], columns=['toponimo_i', 'geometry'])
+
+    topology = tract_topology.TractTopology.load(upstream['get_tract_topology'])
+    cube = case_cube.CaseCube.build(
+        bronchiolitis_gdf, puerto_madryn_shp, id_column='toponimo_i', topology=topology)
+    cube.save(str(product))
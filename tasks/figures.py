@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from bronchiolitis_package import figure_pool
+from tasks import nbi_map
+from tasks import spatial_vis
+
+
+def render_figures(
+        upstream, product,
+        pMoranAttr,
+        pMoranLagAttr,
+        PUERTO_MADRYN_BASEMAP_TIF_PATH,
+        SOUTH_AMERICA_BASEMAP_TIF_PATH,
+        LABEL_BY_QUADFILTER_DICT,
+        COLOR_BY_LABELNAME_DICT,
+        PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP,
+        DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS,
+        BASEMAP_CACHE_DIR=None,
+        FIGURE_WORKERS=1,
+        FIGURE_MEMORY_BUDGET_MB=figure_pool.DEFAULT_MEMORY_BUDGET_MB
+    ):
+    """ Genera todas las figuras (Moran plots, mapas de clusters y mapa de NBI) en un pool
+    de `FIGURE_WORKERS` procesos (ver `figure_pool`).
+
+    Cada figura es la tarea de `tasks.spatial_vis` / `tasks.nbi_map` que la generaba;
+    los mapas de clusters siguen siendo un solo trabajo (comparten la figura base).
+    """
+    # rutas (str): los trabajos se envían a otros procesos
+    figure_upstream = {
+        'get-moran-and-lisa': {
+            'weights': str(upstream['get-moran-and-lisa']['weights']),
+            'analyses': str(upstream['get-moran-and-lisa']['analyses']),
+        },
+        'cases-for-each-circuit': str(upstream['cases-for-each-circuit']),
+        'get_bronchiolitis_locations': {
+            'projected_points': str(upstream['get_bronchiolitis_locations']['projected_points']),
+        },
+        'get_locator_inset': {
+            'layers': str(upstream['get_locator_inset']['layers']),
+            'background': str(upstream['get_locator_inset']['background']),
+        },
+        'get_shape': str(upstream['get_shape']),
+        'get_nbi_clusters': str(upstream['get_nbi_clusters']),
+    }
+
+    moranplot_args = {
+        'upstream': figure_upstream,
+        'LABEL_BY_QUADFILTER_DICT': LABEL_BY_QUADFILTER_DICT,
+        'COLOR_BY_LABELNAME_DICT': COLOR_BY_LABELNAME_DICT,
+    }
+    jobs = [
+        (spatial_vis.get_moranplot, {
+            **moranplot_args,
+            'product': str(product['moranplot']),
+            'MORAN_ANALYSIS': 'univariate',
+        }),
+        (spatial_vis.get_moranplot_bivariate, {
+            **moranplot_args,
+            'product': str(product['moranplot-bivariate']),
+            'MORAN_ANALYSIS': 'bivariate',
+            'pMoranAttr': pMoranAttr,
+            'pMoranLagAttr': pMoranLagAttr,
+        }),
+        (spatial_vis.get_moranplot_bivariate_reverse, {
+            **moranplot_args,
+            'product': str(product['moranplot-bivariate-reverse']),
+            'MORAN_ANALYSIS': 'bivariate-reverse',
+            'pMoranAttr': pMoranLagAttr,
+            'pMoranLagAttr': pMoranAttr,
+        }),
+        (spatial_vis.create_clustermap_figures, {
+            'upstream': figure_upstream,
+            'product': {
+                'univariate': str(product['cluster-map']),
+                'bivariate': str(product['cluster-map-bivariate']),
+                'bivariate-reverse': str(product['cluster-map-bivariate-reverse']),
+            },
+            'pMoranAttr': pMoranAttr,
+            'pMoranLagAttr': pMoranLagAttr,
+            'PUERTO_MADRYN_BASEMAP_TIF_PATH': PUERTO_MADRYN_BASEMAP_TIF_PATH,
+            'SOUTH_AMERICA_BASEMAP_TIF_PATH': SOUTH_AMERICA_BASEMAP_TIF_PATH,
+            'LABEL_BY_QUADFILTER_DICT': LABEL_BY_QUADFILTER_DICT,
+            'PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP': PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP,
+            'DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS': DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS,
+            'BASEMAP_CACHE_DIR': BASEMAP_CACHE_DIR,
+        }),
+        (nbi_map.get_nbi_map, {
+            'upstream': figure_upstream,
+            'product': str(product['nbi-map']),
+            'BASEMAP_CACHE_DIR': BASEMAP_CACHE_DIR,
+            'PUERTO_MADRYN_BASEMAP_TIF_PATH': PUERTO_MADRYN_BASEMAP_TIF_PATH,
+            'SOUTH_AMERICA_BASEMAP_TIF_PATH': SOUTH_AMERICA_BASEMAP_TIF_PATH,
+        }),
+    ]
+
+    figure_pool.render_figures(
+        jobs,
+        n_workers=FIGURE_WORKERS,
+        memory_budget_mb=FIGURE_MEMORY_BUDGET_MB
+    )
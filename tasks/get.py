@@ -1,12 +1,21 @@
 # -*- coding: utf-8 -*-
 import pandas
 import geopandas
+from bronchiolitis_package import ingest
+from bronchiolitis_package import locator_inset
+from bronchiolitis_package import tracts_cache
+from bronchiolitis_package import tract_topology
+
+CSV_EDADES_CHUBUT = "/home/lmorales/work/pipelines/pi-bronquiolitis/input-data/edades_chubut_censo_2010_INDEC_solo_madryn.csv"
 
 
 def get_bronchiolitis_locations(
-        product,
+        upstream, product,
         ENV_MEDICAL_RECORDS_CSV_PATH,
-        ENV_ADRESSES_AND_LATLONG_CSV_PATH
+        ENV_ADRESSES_AND_LATLONG_CSV_PATH,
+        ADDRESS_CORRECTIONS_CSV_PATH,
+        INGEST_STORE_DIR=None,
+        GEOCODE_CACHE_DIR=None
     ):
     """
     Tarea que combina los datos crudos de casos de bronquiolitis con el dataset de domicilios.
@@ -27,10 +36,28 @@ def get_bronchiolitis_locations(
         1             Mitre 41 -42.765109 -65.037430
         2   Marcos A. Zar 1898 -42.782798 -65.027143
        
+    Antes de combinar, los domicilios se corrigen según la tabla de
+    `ADDRESS_CORRECTIONS_CSV_PATH` (ver `address_corrections`), y se geocodifican con un
+    índice normalizado del dataset de domicilios (ver `geocode_index`), guardado en
+    `GEOCODE_CACHE_DIR`.
+
+    Si se indica `INGEST_STORE_DIR`, la ingesta es incremental: sólo se procesan los
+    registros nuevos o modificados desde el build anterior (ver `ingest.IngestStore`).
     
     Returns:
     
-        geopandas.GeoDataframe:
+        unmatched_addresses: csv con los domicilios sin geocodificar y la cantidad de
+        registros de cada uno.
+
+        corrections_report: csv con las reglas de corrección de domicilios, las filas en
+        las que coincidieron y las que cambiaron.
+
+        projected_points: geopandas.GeoDataframe:
+        Los mismos puntos en el crs de la capa de radios (EPSG:22173), con el radio
+        asignado a cada caso en `toponimo_i` (ver `ingest.project_points`). Es el que
+        leen las tareas siguientes.
+
+        points: geopandas.GeoDataframe:
         Coordenadas de los casos recolectados.
         La columna es_reinternacion se obtiene según el atributo hc se encuentre duplicado o no.
 
@@ -44,96 +71,39 @@ def get_bronchiolitis_locations(
         1             False -42.760486 -65.057645  POINT (-65.05765 -42.76049)  
         2             False -42.786004 -65.071097  POINT (-65.07110 -42.78600) 
     """
-    # A: Historias clínicas
-    df_raw = pandas.read_csv(ENV_MEDICAL_RECORDS_CSV_PATH)
-
-    df_cols = ['HC', 'INGRESO', 'EGRESO', 'SE', 'Edad', 'Domicilio definitivo']
-    df = df_raw[df_cols]
-    
-    ## eliminar aquellos que no tienen numero de historia clinica:
-    df = df.dropna(subset=['HC'])
-    ## primero ordenamos por fecha de ingreso
-    df = df.sort_values(by='INGRESO')
-    ## después de ordenar, si se repite el nro de historia clinica, es reinternación:
-    df['es_reinternacion'] = df['HC'].duplicated()
-    df.columns = df.columns.str.lower().str.replace(' ', '_')
-
-    df = df.reset_index(drop=True)
-
-    #
-    # B: Latlong de los domicilios
-    domicilio_latlong = pandas.read_csv(ENV_ADRESSES_AND_LATLONG_CSV_PATH)
-
-    ## rename columns (lowercase):
-    domicilio_latlong = domicilio_latlong.rename(
-        columns={
-            column: column.lower().replace(' ', '_')
-            for column
-            in domicilio_latlong.columns
-        }
-    )
-
-    ## sort from north to south, east to west:
-    LAT_COLUMN = 'latitud'
-    LNG_COLUMN = 'longitud'
-    sorted_index_values = (domicilio_latlong[LAT_COLUMN] ** 2 + domicilio_latlong[LNG_COLUMN] **2).sort_values().index
-    domicilio_latlong = domicilio_latlong.iloc[sorted_index_values]
-
-    ## delete duplicates:
-    domicilio_latlong = domicilio_latlong.drop_duplicates()
-    domicilio_latlong = domicilio_latlong.reset_index(drop=True)
-
-    # mudanza problems:
-    df.loc[df['domicilio_definitivo'] == "Tecka 2050", "domicilio_definitivo"] = "Simón de Alcazabar 440"
-    df.loc[df['domicilio_definitivo'] == "Gualjaina 1410", "domicilio_definitivo"] = "Río Mayo 1510"
-    df.loc[df['domicilio_definitivo'] == "Lago Puelo 1476", "domicilio_definitivo"] = "Rada Tilly 1280"
-    df.loc[df['domicilio_definitivo'] == "Vittorio Martinelli 1230", "domicilio_definitivo"] = "Manuel Castro 1230"
-    df.loc[df['domicilio_definitivo'] == "Luis María Campos 450", "domicilio_definitivo"] = "Héroes de Malvinas 850"
-    df.loc\
-        [df['domicilio_definitivo'] == "Ruperto Gimenez 720", "domicilio_definitivo"] = \
-            "Esteban Williams 812"
-    df.loc\
-        [df['domicilio_definitivo'] == "Rio Pico 1710", "domicilio_definitivo"] = \
-            "Trevellin 1510"
-
-    # not found problems:
-    df.loc\
-        [df['domicilio_definitivo'] == "M.A. Zar 1431", "domicilio_definitivo"] = \
-            "Marcos A. Zar 1431"
-    df.loc\
-        [df['domicilio_definitivo'] == "Manuel Alzúa 620", "domicilio_definitivo"] = \
-            "Manuel Alsua 620"
-    # hay dos Alzúa...
-    df.loc\
-        [df['domicilio_definitivo'] == "C.T. Alt 213", "domicilio_definitivo"] = \
-            "Alt 213"
-    df.loc\
-        [df['domicilio_definitivo'] == "Italia 125", "domicilio_definitivo"] = \
-            "Italia 1000"
-    df.loc\
-        [df['domicilio_definitivo'] == "E. Williams 995", "domicilio_definitivo"] = \
-            "Esteban Williams 995" 
-
-    # C: Combine
-    output_df = pandas.merge(
-        df,
-        domicilio_latlong,
-        on='domicilio_definitivo',
-    )
-
-    #
-    # D: Create geodataframe:
-    output_gdf = geopandas.GeoDataFrame(
-        output_df,
-        geometry=geopandas.points_from_xy(output_df.longitud, output_df.latitud),
-        crs="EPSG:4326"
-    )
-    
-    output_gdf.to_parquet(product, index=False)
-
-def get_shape(product, PUERTO_MADRYN_SHAPEFILE_PATH):
+    if INGEST_STORE_DIR is None:
+        output_gdf, corrections_report, unmatched = ingest.get_bronchiolitis_points(
+            ENV_MEDICAL_RECORDS_CSV_PATH,
+            ENV_ADRESSES_AND_LATLONG_CSV_PATH,
+            ADDRESS_CORRECTIONS_CSV_PATH,
+            geocode_cache_dir=GEOCODE_CACHE_DIR)
+    else:
+        store = ingest.IngestStore(INGEST_STORE_DIR)
+        store.update(
+            ENV_MEDICAL_RECORDS_CSV_PATH,
+            ENV_ADRESSES_AND_LATLONG_CSV_PATH,
+            ADDRESS_CORRECTIONS_CSV_PATH,
+            geocode_cache_dir=GEOCODE_CACHE_DIR)
+        output_gdf = store.get_points()
+        corrections_report = store.get_corrections_report(ADDRESS_CORRECTIONS_CSV_PATH)
+        unmatched = store.get_unmatched_report()
+
+    corrections_report.to_csv(str(product['corrections_report']), index=False)
+    unmatched.to_csv(str(product['unmatched_addresses']), index=False)
+    output_gdf.to_parquet(str(product['points']), index=False)
+
+    # puntos en el crs de los radios, con el radio asignado
+    tracts_gdf = geopandas.read_parquet(upstream['get_shape'], columns=['toponimo_i', 'geometry'])
+    topology = tract_topology.TractTopology.load(upstream['get_tract_topology'])
+    projected_gdf = ingest.project_points(output_gdf, tracts_gdf, topology=topology)
+    projected_gdf.to_parquet(str(product['projected_points']), index=False)
+
+def get_shape(product, PUERTO_MADRYN_SHAPEFILE_PATH, TRACTS_CACHE_DIR=None, INDEC_AGES_CSV_PATH=CSV_EDADES_CHUBUT):
     """
     Limpia la capa y devuelve un parquet para leer con geopandas.
+    La capa se lee del cache GeoParquet de `TRACTS_CACHE_DIR` (ver `tracts_cache`).
+    La población menor de un año sale del csv de edades del censo (INDEC) de
+    `INDEC_AGES_CSV_PATH` (columnas `area`, `edad`, `casos`, separadas por tabs).
     
     Returns:
         
@@ -148,15 +118,14 @@ def get_shape(product, PUERTO_MADRYN_SHAPEFILE_PATH):
             1  POLYGON ((3578244.850 5265535.078, 3578270.165...  
             2  POLYGON ((3578569.532 5266020.406, 3578696.315...  
     """
-    pm_tracts = geopandas.read_file(PUERTO_MADRYN_SHAPEFILE_PATH)
+    columns = ['link', 'toponimo_i', 'totalpobl', 'geometry']
+    pm_tracts = tracts_cache.read_tracts(
+        PUERTO_MADRYN_SHAPEFILE_PATH, columns=columns, cache_dir=TRACTS_CACHE_DIR)
     pm_tracts['toponimo_i'] = pm_tracts["toponimo_i"].astype('string')
     pm_tracts['link'] = pm_tracts["link"].astype('string')
-    columns = ['link', 'toponimo_i', 'totalpobl', 'geometry']
-    pm_tracts = pm_tracts[columns]
     
-    CSV_EDADES_CHUBUT = "/home/lmorales/work/pipelines/pi-bronquiolitis/input-data/edades_chubut_censo_2010_INDEC_solo_madryn.csv"
     df_indec = pandas.read_csv(
-        CSV_EDADES_CHUBUT,
+        INDEC_AGES_CSV_PATH,
         delimiter='\\t')
     
     df_indec = df_indec[df_indec['edad'] == 0]
@@ -173,12 +142,57 @@ def get_shape(product, PUERTO_MADRYN_SHAPEFILE_PATH):
     pm_tracts.to_parquet(product, index=False)
 
 
-def get_nbi(product, PUERTO_MADRYN_SHAPEFILE_PATH):
+def get_tract_topology(upstream, product, TOPOLOGY_CACHE_DIR=None):
+    """
+    Topología de la capa de radios: índice espacial, centroides, bounding boxes y
+    adyacencias rook/queen (ver `tract_topology`). Las tareas que cuentan puntos por
+    radio o construyen pesos la leen en lugar de recalcularla.
+    Si las geometrías no cambiaron se copia de `TOPOLOGY_CACHE_DIR`.
+
+    Returns:
+
+        npz con los arrays de `tract_topology.TractTopology`.
+    """
+    pm_tracts = geopandas.read_parquet(upstream['get_shape'], columns=['toponimo_i', 'geometry'])
+    tract_topology.save_tract_topology(
+        pm_tracts, str(product), cache_dir=TOPOLOGY_CACHE_DIR, id_column='toponimo_i')
+
+
+def get_locator_inset(
+        product,
+        SOUTH_AMERICA_BASEMAP_TIF_PATH=None,
+        BASEMAP_CACHE_DIR=None,
+        WORLD_COUNTRIES_PATH=None
+    ):
+    """
+    Capa del mapa de ubicación de los mapas (contorno simplificado de América del Sur y
+    punto de Puerto Madryn) y, si se indica `SOUTH_AMERICA_BASEMAP_TIF_PATH`, su fondo
+    raster ya reproyectado (ver `locator_inset`). Las figuras la reutilizan en lugar de
+    leer Natural Earth y unir el continente cada vez.
+
+    Returns:
+
+        layers: GeoParquet con las columnas `layer` y `geometry`.
+
+        background: npz con la imagen del fondo y sus extensiones.
+    """
+    locator_inset.save_locator_inset(
+        product,
+        world_path=WORLD_COUNTRIES_PATH,
+        source=SOUTH_AMERICA_BASEMAP_TIF_PATH,
+        cache_dir=BASEMAP_CACHE_DIR
+    )
+
+
+def get_nbi(product, PUERTO_MADRYN_SHAPEFILE_PATH, TRACTS_CACHE_DIR=None):
     """
     Devuelve el valor de nbi para cada circuito (por toponimo)
-    
+    Sólo lee las dos columnas necesarias del cache de la capa (ver `tracts_cache`).
     """
-    pm_tracts = geopandas.read_file(PUERTO_MADRYN_SHAPEFILE_PATH)
+    pm_tracts = tracts_cache.read_tracts(
+        PUERTO_MADRYN_SHAPEFILE_PATH,
+        columns=['toponimo_i', 'Unidades_7'],
+        cache_dir=TRACTS_CACHE_DIR)
     
     pm_tracts['toponimo_i'] = pm_tracts["toponimo_i"].astype('string')
     pm_tracts = pm_tracts.rename(columns={'Unidades_7': 'nbi'})
@@ -4,9 +4,9 @@ import pandas
 import geopandas
 import matplotlib.pyplot as plt
 from matplotlib.patches import Patch
-import contextily as ctx
 
 from bronchiolitis_package import maps_utils
+from bronchiolitis_package import tract_rendering
 PUERTO_MADRYN_BASEMAP_FILE = "/home/lmorales/work/pipelines/pi-bronquiolitis/input-data/basemaps_images/puerto_madryn.tif"
 SOUTH_AMERICA_BASEMAP_FILE = '/home/lmorales/work/pipelines/pi-bronquiolitis/input-data/basemaps_images/south_america_stamen_terrain_background.tif'
 
@@ -43,7 +43,12 @@ def get_nbi_clusters(upstream, product):
 
 # -
 
-def get_nbi_map(upstream, product):
+def get_nbi_map(
+        upstream, product,
+        BASEMAP_CACHE_DIR=None,
+        PUERTO_MADRYN_BASEMAP_TIF_PATH=PUERTO_MADRYN_BASEMAP_FILE,
+        SOUTH_AMERICA_BASEMAP_TIF_PATH=SOUTH_AMERICA_BASEMAP_FILE
+    ):
     shape = geopandas.read_parquet(upstream["get_shape"])
     nbi_df = pandas.read_parquet(upstream['get_nbi_clusters'])
     
@@ -57,20 +62,13 @@ def get_nbi_map(upstream, product):
     pmarks = []
     data_n = { label: 0 for label in ordered_category_labels }
 
-    for i, (ctype, cluster_slice) in enumerate(nbi_shape.groupby('cluster')):
-
-        color=cluster_palette[ctype]
-
-        # Plot each group using the color defined above
-        cluster_slice.plot(
-            color=color,
-            ax=ax,
-            label=ctype,
-            alpha=.65,
-            #edgecolor=edge_color
-        )
-
-        data_n[ctype] = len(cluster_slice)
+    # todas las categorías en una sola colección (ver tract_rendering)
+    tract_rendering.plot_categories(
+        ax, nbi_shape.geometry, nbi_shape['cluster'],
+        cluster_palette,
+        alpha=.65
+    )
+    data_n.update(nbi_shape['cluster'].value_counts())
 
 
     for ctype in ordered_category_labels:
@@ -81,27 +79,24 @@ def get_nbi_map(upstream, product):
             )
         )
 
-    nbi_shape.plot(
-        color='none',
-        edgecolor='grey',
-        ax=ax
-    )
-
-    ctx.add_basemap(
-        ax,
-        source=PUERTO_MADRYN_BASEMAP_FILE,
-        crs=nbi_shape.crs.to_string()
+    tract_rendering.plot_tracts(
+        ax, nbi_shape.geometry,
+        facecolors='none',
+        edgecolors='grey'
     )
 
+    # capas base (una sola vez: annotate_map dibuja la de Puerto Madryn)
     ax = maps_utils.annotate_map(
-        ax, nbi_shape.crs,
-        PUERTO_MADRYN_BASEMAP_FILE,
-        SOUTH_AMERICA_BASEMAP_FILE
+        ax, nbi_shape.crs.to_string(),
+        PUERTO_MADRYN_BASEMAP_TIF_PATH,
+        SOUTH_AMERICA_BASEMAP_TIF_PATH,
+        BASEMAP_CACHE_DIR=BASEMAP_CACHE_DIR,
+        LOCATOR_INSET=upstream['get_locator_inset']
     )
     
     
-    bronchiolitis_points_gdf = geopandas.read_parquet(upstream['get_bronchiolitis_locations'])
-    bronchiolitis_points_gdf = bronchiolitis_points_gdf.to_crs(shape.crs.to_string())
+    bronchiolitis_points_gdf = geopandas.read_parquet(
+        upstream['get_bronchiolitis_locations']['projected_points'])
     admissions_gdf = bronchiolitis_points_gdf[~bronchiolitis_points_gdf.es_reinternacion]
     readmissions_gdf = bronchiolitis_points_gdf[bronchiolitis_points_gdf.es_reinternacion]
     
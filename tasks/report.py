@@ -1,61 +1,94 @@
 from bronchiolitis_package.report import Report
 
-def create_report(product, upstream, KNN_VALUE):
+# descripción de los pesos de cada estrategia (ver `weights_cache`)
+WEIGHTS_DESCRIPTION_BY_STRATEGY = {
+    'rook': ('Contigüidad', 'contigüidad rook (radios con un lado en común)', 'Rook'),
+    'queen': ('Contigüidad', 'contigüidad queen (radios con un lado o un vértice en común)', 'Queen'),
+    'knn': ('Vecinos cercanos', '{param} vecinos mas cercanos', 'KNN={param}'),
+    'distance_band': ('Banda de distancia', 'vecinos a menos de {param} metros', 'Banda de distancia={param} m'),
+}
 
+
+def get_weights_description(WEIGHT_STRATEGY, WEIGHT_PARAM):
+    """ Título, descripción y rótulo de la estrategia de pesos para el reporte. """
+    title, value, heading = WEIGHTS_DESCRIPTION_BY_STRATEGY[WEIGHT_STRATEGY]
+    return title, value.format(param=WEIGHT_PARAM), heading.format(param=WEIGHT_PARAM)
+
+
+def create_report(product, upstream, KNN_VALUE, REPORT_IMAGE_CACHE_DIR=None, REPORT_IMAGE_JOBS=1):
+    report = get_report(
+        upstream, 'knn', KNN_VALUE,
+        REPORT_IMAGE_CACHE_DIR=REPORT_IMAGE_CACHE_DIR,
+        REPORT_IMAGE_JOBS=REPORT_IMAGE_JOBS
+    )
+
+    # save:
+    report.build(str(product))
+
+
+def get_report(
+        upstream, WEIGHT_STRATEGY, WEIGHT_PARAM,
+        REPORT_IMAGE_CACHE_DIR=None, REPORT_IMAGE_JOBS=1, SUBTITLE="Puerto Madryn"
+    ):
+    """ Reporte (sin generar el PDF) con las figuras de `upstream['render-figures']`,
+    describiendo los pesos `WEIGHT_STRATEGY` / `WEIGHT_PARAM` usados en el análisis. """
+    weights_title, weights_value, weights_heading = get_weights_description(
+        WEIGHT_STRATEGY, WEIGHT_PARAM)
     # instantiate report obj
     report = Report(
         title="Reporte: Bronquiolitis",
-        subtitle="Puerto Madryn",
+        subtitle=SUBTITLE,
         experiment_params=[{
                 'title': 'Tasas',
                 'desc': 'Para este analisis las tasas fueron calculadas sobre la población indicada en el archivo de la capa de mapa',
                 'value': 'radios_censales_puerto_madryn_epsg_22173.shp',
             },
             {
-                'title': 'Vecinos cercanos',
+                'title': weights_title,
                 'desc': 'Para el análisis espacial se utilizaron',
-                'value': f'{KNN_VALUE} vecinos mas cercanos',
+                'value': weights_value,
             },
-        ]
+        ],
+        image_cache_dir=REPORT_IMAGE_CACHE_DIR,
+        n_jobs=REPORT_IMAGE_JOBS
     )
 
     # add section:
     html_section = f'''
         <h2 align="left">Mapa de Necesidades Básicas Insatisfechas</h2>
-        <h3 align="left">Estrategia KNN={KNN_VALUE}</h3>
+        <h3 align="left">Estrategia {weights_heading}</h3>
     '''
     report.add_section(
         html_section,
-        figure=str(upstream['get_nbi_map'])
+        figure=str(upstream['render-figures']['nbi-map'])
     )
 
     # add section:
     html_section = f'''
         <h2 align="left">Tasa de casos sobre cantidad de habitantes</h2>
-        <h3 align="left">Estrategia KNN={KNN_VALUE}</h3>
+        <h3 align="left">Estrategia {weights_heading}</h3>
     '''
     report.add_section(
         html_section,
-        figure=str(upstream['get_moranplot'])
+        figure=str(upstream['render-figures']['moranplot'])
     )
     report.add_section(
         '',
-        figure=str(upstream['clustermap-figure'])
+        figure=str(upstream['render-figures']['cluster-map'])
     )
     
     # add bivariate output
     html_section = f'''
         <h2 align="left">Análisis bi-variado: NBI vs Lag espacial de Tasa Casos</h2>
-        <h3 align="left">Estrategia KNN={KNN_VALUE}</h3>
+        <h3 align="left">Estrategia {weights_heading}</h3>
     '''
     report.add_section(
         html_section,
-        figure=str(upstream['get_moranplot_bv']['moranplot'])
+        figure=str(upstream['render-figures']['moranplot-bivariate'])
     )
     report.add_section(
         '',
-        figure=str(upstream['clustermap-figure-bivariate'])
+        figure=str(upstream['render-figures']['cluster-map-bivariate'])
     )
 
-    # save:
-    report.build(str(product))
+    return report
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+
+import geopandas
+import pandas
+from bronchiolitis_package import case_cube
+from bronchiolitis_package import figure_pool
+from bronchiolitis_package.report import build_reports
+from tasks import cases
+from tasks import spatial
+from tasks import spatial_vis
+from tasks.report import get_report
+
+POOLED_SEASON = 'pooled'
+
+logger = logging.getLogger(__name__)
+
+
+def run_season_analysis(
+        upstream, product,
+        SEASON,
+        MORAN_ANALYSES,
+        WEIGHT_STRATEGY, WEIGHT_PARAM,
+        pMoranAttr,
+        pMoranLagAttr,
+        PUERTO_MADRYN_BASEMAP_TIF_PATH,
+        SOUTH_AMERICA_BASEMAP_TIF_PATH,
+        LABEL_BY_QUADFILTER_DICT,
+        COLOR_BY_LABELNAME_DICT,
+        PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP,
+        DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS,
+        WEIGHTS_CACHE_DIR=None,
+        BASEMAP_CACHE_DIR=None,
+        PERMUTATIONS=999, SEED=None
+    ):
+    """ Análisis completo de una temporada (año de ingreso, como en `case_cube`) en el
+    directorio `product`: casos por radio, Moran/LISA, Moran plots y mapas de clusters.
+
+    Son las mismas tareas del pipeline (`tasks.cases`, `tasks.spatial`,
+    `tasks.spatial_vis`) con los casos de la temporada; la capa, su topología, el nbi,
+    la capa de ubicación y los caches de pesos y capas base son los del pipeline.
+
+    Returns:
+        dict: Figuras de la temporada, con las claves de los productos de render-figures.
+    """
+    os.makedirs(product, exist_ok=True)
+
+    # casos de la temporada
+    points_path = os.path.join(product, 'bronchiolitis_points_projected.parquet')
+    points_gdf = geopandas.read_parquet(upstream['get_bronchiolitis_locations']['projected_points'])
+    season, _ = case_cube.get_seasons_and_weeks(points_gdf)
+    points_gdf = points_gdf[season == int(SEASON)]
+    if len(points_gdf) == 0:
+        raise ValueError(f"Temporada sin casos: {SEASON}")
+    points_gdf.to_parquet(points_path, index=False)
+
+    season_upstream = {
+        **upstream,
+        'get_bronchiolitis_locations': {'projected_points': points_path},
+        'cases-for-each-circuit': os.path.join(product, 'bronchiolitis_and_tracts.parquet'),
+        'get-moran-and-lisa': {
+            'weights': os.path.join(product, 'weights-pm-tracts.npz'),
+            'analyses': os.path.join(product, 'analyses'),
+        },
+    }
+
+    cases.get_cases_for_each_circuit(
+        season_upstream, season_upstream['cases-for-each-circuit'])
+
+    # las permutaciones en este proceso: las temporadas ya corren en paralelo
+    spatial.get_moran_and_lisa(
+        season_upstream, season_upstream['get-moran-and-lisa'],
+        MORAN_ANALYSES,
+        WEIGHT_STRATEGY, WEIGHT_PARAM,
+        WEIGHTS_CACHE_DIR=WEIGHTS_CACHE_DIR,
+        PERMUTATIONS=PERMUTATIONS, N_JOBS=1, SEED=SEED
+    )
+
+    figures = {
+        'moranplot': os.path.join(product, 'moranplot.png'),
+        'moranplot-bivariate': os.path.join(product, 'moranplot-bivariate.png'),
+        'moranplot-bivariate-reverse': os.path.join(product, 'moranplot-bivariate-reverse.png'),
+        'cluster-map': os.path.join(product, 'cluster_map.png'),
+        'cluster-map-bivariate': os.path.join(product, 'cluster_map_bivariate.png'),
+        'cluster-map-bivariate-reverse': os.path.join(product, 'cluster_map_bivariate_reverse.png'),
+    }
+    moranplot_args = {
+        'upstream': season_upstream,
+        'LABEL_BY_QUADFILTER_DICT': LABEL_BY_QUADFILTER_DICT,
+        'COLOR_BY_LABELNAME_DICT': COLOR_BY_LABELNAME_DICT,
+    }
+    spatial_vis.get_moranplot(
+        **moranplot_args,
+        product=figures['moranplot'],
+        MORAN_ANALYSIS='univariate'
+    )
+    spatial_vis.get_moranplot_bivariate(
+        **moranplot_args,
+        product=figures['moranplot-bivariate'],
+        MORAN_ANALYSIS='bivariate',
+        pMoranAttr=pMoranAttr,
+        pMoranLagAttr=pMoranLagAttr
+    )
+    spatial_vis.get_moranplot_bivariate_reverse(
+        **moranplot_args,
+        product=figures['moranplot-bivariate-reverse'],
+        MORAN_ANALYSIS='bivariate-reverse',
+        pMoranAttr=pMoranLagAttr,
+        pMoranLagAttr=pMoranAttr
+    )
+    spatial_vis.create_clustermap_figures(
+        upstream=season_upstream,
+        product={
+            'univariate': figures['cluster-map'],
+            'bivariate': figures['cluster-map-bivariate'],
+            'bivariate-reverse': figures['cluster-map-bivariate-reverse'],
+        },
+        pMoranAttr=pMoranAttr,
+        pMoranLagAttr=pMoranLagAttr,
+        PUERTO_MADRYN_BASEMAP_TIF_PATH=PUERTO_MADRYN_BASEMAP_TIF_PATH,
+        SOUTH_AMERICA_BASEMAP_TIF_PATH=SOUTH_AMERICA_BASEMAP_TIF_PATH,
+        LABEL_BY_QUADFILTER_DICT=LABEL_BY_QUADFILTER_DICT,
+        PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP=PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP,
+        DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS=DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS,
+        BASEMAP_CACHE_DIR=BASEMAP_CACHE_DIR
+    )
+    return figures
+
+
+def get_season_reports(
+        upstream, product,
+        SEASONS,
+        MORAN_ANALYSES,
+        WEIGHT_STRATEGY, WEIGHT_PARAM,
+        pMoranAttr,
+        pMoranLagAttr,
+        PUERTO_MADRYN_BASEMAP_TIF_PATH,
+        SOUTH_AMERICA_BASEMAP_TIF_PATH,
+        LABEL_BY_QUADFILTER_DICT,
+        COLOR_BY_LABELNAME_DICT,
+        PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP,
+        DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS,
+        WEIGHTS_CACHE_DIR=None,
+        BASEMAP_CACHE_DIR=None,
+        PERMUTATIONS=999, SEED=None,
+        SEASON_WORKERS=1,
+        FIGURE_MEMORY_BUDGET_MB=figure_pool.DEFAULT_MEMORY_BUDGET_MB,
+        REPORT_IMAGE_CACHE_DIR=None,
+        REPORT_IMAGE_JOBS=1
+    ):
+    """ Análisis y reporte de cada temporada de `SEASONS` y de los datos agrupados.
+
+    Cada temporada es un trabajo (`run_season_analysis`) del pool de procesos de
+    `figure_pool`, con hasta `SEASON_WORKERS` temporadas a la vez. Lo que no depende de
+    la temporada se calcula una vez en el pipeline y se comparte: la capa de radios y su
+    topología, el nbi y su mapa, la capa de ubicación y, a través de los caches, los
+    pesos (ya calculados por get-moran-and-lisa) y las capas base reproyectadas. Los
+    datos agrupados son los productos del pipeline (get-moran-and-lisa, render-figures).
+
+    Las temporadas de `SEASONS` sin casos se omiten (y se informan en el log): no tienen
+    análisis ni reporte, pero no impiden los de las demás.
+
+    Returns:
+        - directorio con un subdirectorio por temporada (y `pooled`) con sus productos
+            intermedios, figuras y `report.pdf`.
+    """
+    # rutas (str): los trabajos se envían a otros procesos
+    season_upstream = {
+        'get_bronchiolitis_locations': {
+            'projected_points': str(upstream['get_bronchiolitis_locations']['projected_points']),
+        },
+        'get_shape': str(upstream['get_shape']),
+        'get_tract_topology': str(upstream['get_tract_topology']),
+        'get_nbi': str(upstream['get_nbi']),
+        'get_locator_inset': {
+            'layers': str(upstream['get_locator_inset']['layers']),
+            'background': str(upstream['get_locator_inset']['background']),
+        },
+    }
+
+    # temporadas con casos
+    points_df = pandas.read_parquet(
+        season_upstream['get_bronchiolitis_locations']['projected_points'], columns=['ingreso', 'se'])
+    observed_seasons = set(case_cube.get_seasons_and_weeks(points_df)[0].tolist())
+    skipped = [season for season in SEASONS if int(season) not in observed_seasons]
+    if skipped:
+        logger.warning("Temporadas sin casos, se omiten: %s", skipped)
+    seasons = [season for season in SEASONS if int(season) in observed_seasons]
+
+    jobs = [
+        (run_season_analysis, {
+            'upstream': season_upstream,
+            'product': os.path.join(str(product), str(season)),
+            'SEASON': season,
+            'MORAN_ANALYSES': MORAN_ANALYSES,
+            'WEIGHT_STRATEGY': WEIGHT_STRATEGY,
+            'WEIGHT_PARAM': WEIGHT_PARAM,
+            'pMoranAttr': pMoranAttr,
+            'pMoranLagAttr': pMoranLagAttr,
+            'PUERTO_MADRYN_BASEMAP_TIF_PATH': PUERTO_MADRYN_BASEMAP_TIF_PATH,
+            'SOUTH_AMERICA_BASEMAP_TIF_PATH': SOUTH_AMERICA_BASEMAP_TIF_PATH,
+            'LABEL_BY_QUADFILTER_DICT': LABEL_BY_QUADFILTER_DICT,
+            'COLOR_BY_LABELNAME_DICT': COLOR_BY_LABELNAME_DICT,
+            'PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP': PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP,
+            'DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS': DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS,
+            'WEIGHTS_CACHE_DIR': WEIGHTS_CACHE_DIR,
+            'BASEMAP_CACHE_DIR': BASEMAP_CACHE_DIR,
+            'PERMUTATIONS': PERMUTATIONS,
+            'SEED': SEED,
+        })
+        for season in seasons
+    ]
+    season_figures = figure_pool.render_figures(
+        jobs,
+        n_workers=SEASON_WORKERS,
+        memory_budget_mb=FIGURE_MEMORY_BUDGET_MB
+    )
+
+    # el mapa de nbi no depende de la temporada
+    nbi_map_path = str(upstream['render-figures']['nbi-map'])
+    figures_by_season = {
+        str(season): {**figures, 'nbi-map': nbi_map_path}
+        for season, figures in zip(seasons, season_figures)
+    }
+    figures_by_season[POOLED_SEASON] = {
+        name: str(path) for name, path in upstream['render-figures'].items()
+    }
+
+    reports = []
+    for season, figures in figures_by_season.items():
+        season_dir = os.path.join(str(product), season)
+        os.makedirs(season_dir, exist_ok=True)
+        subtitle = "Puerto Madryn" if season == POOLED_SEASON else f"Puerto Madryn - Temporada {season}"
+        report = get_report(
+            {'render-figures': figures}, WEIGHT_STRATEGY, WEIGHT_PARAM,
+            REPORT_IMAGE_CACHE_DIR=REPORT_IMAGE_CACHE_DIR,
+            REPORT_IMAGE_JOBS=REPORT_IMAGE_JOBS,
+            SUBTITLE=subtitle
+        )
+        reports.append((report, os.path.join(season_dir, 'report.pdf')))
+
+    build_reports(reports, n_workers=SEASON_WORKERS)
@@ -1,47 +1,89 @@
 # -*- coding: utf-8 -*-
 # +
+import os
 import pandas
 import geopandas
-import matplotlib.pyplot as plt
-from matplotlib import colors
-from collections import Counter
-import pickle
+from bronchiolitis_package import case_cube
 from bronchiolitis_package import spatial
+from bronchiolitis_package import spatial_products
+from bronchiolitis_package import tract_topology
+from bronchiolitis_package import weights_cache
 
 # -
-def get_moran_and_lisa(upstream, product, MORAN_ATTR, WEIGHT_STRATEGY, WEIGHT_PARAM):
+def get_moran_and_lisa(
+        upstream, product,
+        MORAN_ANALYSES,
+        WEIGHT_STRATEGY, WEIGHT_PARAM,
+        WEIGHTS_CACHE_DIR=None,
+        PERMUTATIONS=999, N_JOBS=1, SEED=None
+    ):
+    """
+    Moran global y local (LISA) para todos los análisis de `MORAN_ANALYSES`.
+
+    Lee los datos y construye los pesos una sola vez. Cada análisis es univariado
+    (`attribute`) o bivariado (`attribute` vs lag espacial de `bivariate_attribute`):
+
+        [
+            {'name': 'univariate', 'attribute': 'casos'},
+            {'name': 'bivariate', 'attribute': 'casos', 'bivariate_attribute': 'nbi'},
+        ]
+
+    Returns:
+        - weights: pesos como matriz dispersa CSR (`.npz`).
+        - analyses: directorio con un subdirectorio por análisis en el formato columnar
+            de `spatial_products` (tabla por radio en parquet + estadísticos globales en json).
+    """
+    # combine bronchiolitis and nbi data
     pm_tracts = geopandas.read_parquet(
         upstream["cases-for-each-circuit"])
-    
-    #spatial_attrs = {
-    #    'attribute': 'tasa_casos',
-    #    'strategy': WEIGHT_STRATEGY,
-    #    'k_neighbours': WEIGHT_PARAM,
-    #    'use_moran_rate': True,
-    #    'moran_rate_column': 'totalpobl'
-    #}
-    # 'tasa_casos'
-    spatial_attrs = {
-        'attribute': MORAN_ATTR,
-        'strategy': WEIGHT_STRATEGY,
-        'strategy_args': WEIGHT_PARAM,
-    }
-    
-    # Pesos y geodataframes de trabajo
-    weights, moran, lisa = spatial.get_spatials(
-        pm_tracts, **spatial_attrs)
+    nbi_df = pandas.read_parquet(upstream["get_nbi"])
+    pm_tracts = pandas.merge(
+        pm_tracts,
+        nbi_df,
+        on='toponimo_i')
+    # adyacencias y centroides guardados de la capa:
+    topology = tract_topology.TractTopology.load(upstream['get_tract_topology'])
+
+    weights, results = spatial.get_spatials_batch(
+        pm_tracts, MORAN_ANALYSES,
+        strategy=WEIGHT_STRATEGY,
+        strategy_args=WEIGHT_PARAM,
+        weights_cache_dir=WEIGHTS_CACHE_DIR,
+        permutations=PERMUTATIONS,
+        n_jobs=N_JOBS,
+        seed=SEED,
+        topology=topology
+    )
 
     # Serialization
-    with open(str(product["weights"]), "wb") as outfile:
-        pickle.dump(weights, outfile)
-    with open(str(product["moran"]), "wb") as outfile:
-        pickle.dump(moran, outfile)
-    with open(str(product["lisa"]), "wb") as outfile:
-        pickle.dump(lisa, outfile)
+    spatial_products.save_weights(weights, str(product["weights"]))
 
+    for name, (moran, lisa) in results.items():
+        spatial_products.save_analysis(
+            os.path.join(str(product["analyses"]), name),
+            moran, lisa,
+            ids=pm_tracts['toponimo_i']
+        )
 
-def get_moran_and_lisa_bivariate(upstream, product, MORAN_ATTR, BIVARIATE_MORAN_ATTR, WEIGHT_STRATEGY, WEIGHT_PARAM):
-    # combine bronchiolitis and nbi data
+
+def get_weights_sweep(
+        upstream, product,
+        MORAN_ANALYSES,
+        WEIGHT_GRID,
+        LABEL_BY_QUADFILTER_DICT,
+        WEIGHTS_CACHE_DIR=None,
+        PERMUTATIONS=999, N_JOBS=1, SEED=None
+    ):
+    """
+    Sensibilidad de los resultados a la estrategia de pesos.
+
+    Evalúa todos los análisis de `MORAN_ANALYSES` para cada estrategia y parámetro de
+    `WEIGHT_GRID` ({estrategia: [parámetros]}) leyendo los datos una sola vez.
+
+    Returns:
+        - parquet con una fila por configuración y análisis: I global, p-valores,
+            cantidad de islas, vecinos promedio y cantidad de radios por cluster.
+    """
     pm_tracts = geopandas.read_parquet(
         upstream["cases-for-each-circuit"])
     nbi_df = pandas.read_parquet(upstream["get_nbi"])
@@ -49,30 +91,47 @@ def get_moran_and_lisa_bivariate(upstream, product, MORAN_ATTR, BIVARIATE_MORAN_
         pm_tracts,
         nbi_df,
         on='toponimo_i')
-    
-    spatial_attrs = {
-        'attribute': MORAN_ATTR,
-        'strategy': WEIGHT_STRATEGY,
-        'strategy_args': WEIGHT_PARAM,
-        'use_moran_bv': True,
-        'moran_bv_column': BIVARIATE_MORAN_ATTR
-    }
-    
-    # Pesos
-    weights, moran, lisa = spatial.get_spatials(
-        pm_tracts, **spatial_attrs)
+    # adyacencias y centroides guardados de la capa:
+    topology = tract_topology.TractTopology.load(upstream['get_tract_topology'])
 
-    # Serialization
-    with open(str(product["weights"]), "wb") as outfile:
-        pickle.dump(weights, outfile)
-    with open(str(product["moran"]), "wb") as outfile:
-        pickle.dump(moran, outfile)
-    with open(str(product["lisa"]), "wb") as outfile:
-        pickle.dump(lisa, outfile)
+    sweep_df = spatial.sweep_weight_strategies(
+        pm_tracts, MORAN_ANALYSES, WEIGHT_GRID,
+        weights_cache_dir=WEIGHTS_CACHE_DIR,
+        permutations=PERMUTATIONS,
+        n_jobs=N_JOBS,
+        seed=SEED,
+        label_by_quadfilter=LABEL_BY_QUADFILTER_DICT,
+        topology=topology
+    )
+    sweep_df.to_parquet(str(product))
 
 
-def get_moran_and_lisa_bivariate_reverse(upstream, product, MORAN_ATTR, BIVARIATE_MORAN_ATTR, WEIGHT_STRATEGY, WEIGHT_PARAM):
-    # combine bronchiolitis and nbi data
+def get_sliding_window_lisa(
+        upstream, product,
+        SLIDING_WINDOW_ANALYSES,
+        WINDOW_WEEKS,
+        WEIGHT_STRATEGY, WEIGHT_PARAM,
+        WEIGHTS_CACHE_DIR=None,
+        SLIDING_WINDOW_CACHE_DIR=None,
+        PERMUTATIONS=999, N_JOBS=1, SEED=None
+    ):
+    """
+    Moran local en ventanas deslizantes de `WINDOW_WEEKS` semanas epidemiológicas,
+    para seguir la evolución de los hotspots durante cada temporada
+    (ver `spatial.sliding_window_lisa`).
+
+    Los casos de cada ventana salen del cubo espacio-temporal; la población y el nbi de
+    la capa. Con `SLIDING_WINDOW_CACHE_DIR` sólo se recalculan las ventanas que cambiaron
+    desde el build anterior.
+
+    Returns:
+        - parquet con una fila por análisis, ventana y radio:
+
+              analysis  season  start_week  end_week toponimo_i    Is  q  p_sim
+            0  univariate    2017           1         4     321973  0.12  1  0.031
+    """
+    cube = case_cube.CaseCube.load(upstream['get-case-cube'])
+
     pm_tracts = geopandas.read_parquet(
         upstream["cases-for-each-circuit"])
     nbi_df = pandas.read_parquet(upstream["get_nbi"])
@@ -80,23 +139,19 @@ def get_moran_and_lisa_bivariate_reverse(upstream, product, MORAN_ATTR, BIVARIAT
         pm_tracts,
         nbi_df,
         on='toponimo_i')
-    
-    spatial_attrs = {
-        'attribute': MORAN_ATTR,
-        'strategy': WEIGHT_STRATEGY,
-        'strategy_args': WEIGHT_PARAM,
-        'use_moran_bv': True,
-        'moran_bv_column': BIVARIATE_MORAN_ATTR
-    }
-    
-    # Pesos
-    weights, moran, lisa = spatial.get_spatials(
-        pm_tracts, **spatial_attrs)
+    # mismo orden de radios que el cubo:
+    pm_tracts = pm_tracts.set_index('toponimo_i').loc[cube.ids].reset_index()
+    topology = tract_topology.TractTopology.load(upstream['get_tract_topology'])
 
-    # Serialization
-    with open(str(product["weights"]), "wb") as outfile:
-        pickle.dump(weights, outfile)
-    with open(str(product["moran"]), "wb") as outfile:
-        pickle.dump(moran, outfile)
-    with open(str(product["lisa"]), "wb") as outfile:
-        pickle.dump(lisa, outfile)
+    w = weights_cache.get_weights(
+        pm_tracts, WEIGHT_STRATEGY, WEIGHT_PARAM,
+        cache_dir=WEIGHTS_CACHE_DIR, topology=topology)
+
+    sliding_df = spatial.sliding_window_lisa(
+        cube, pm_tracts, SLIDING_WINDOW_ANALYSES, w, WINDOW_WEEKS,
+        permutations=PERMUTATIONS,
+        n_jobs=N_JOBS,
+        seed=SEED,
+        cache_dir=SLIDING_WINDOW_CACHE_DIR
+    )
+    sliding_df.to_parquet(str(product), index=False)
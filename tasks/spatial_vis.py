@@ -2,10 +2,26 @@
 # +
 import geopandas
 import matplotlib.pyplot as plt
-import pickle
 from surnames_package import spatial_vis
 from bronchiolitis_package import maps_utils
 from bronchiolitis_package import spatial_utils
+from bronchiolitis_package import spatial_products
+import os
+
+
+def __load_analysis(spatial_product, analysis_name):
+    """ Reconstruye el Moran global y local de un análisis de la tarea get-moran-and-lisa """
+    w = spatial_products.load_weights(str(spatial_product['weights']))
+    return spatial_products.load_analysis(
+        os.path.join(str(spatial_product['analyses']), analysis_name), w)
+
+
+def __load_cluster_columns(spatial_product, analysis_name):
+    """ Lee sólo las columnas necesarias para los mapas de clusters (p_sim y q) """
+    return spatial_products.load_tract_results(
+        os.path.join(str(spatial_product['analyses']), analysis_name),
+        columns=['p_sim', 'q'])
+
 
 def __launch_moranplot_creation_task(
         aMoran, aLisa,
@@ -46,18 +62,15 @@ def __launch_moranplot_creation_task(
 
 def get_moranplot(
         upstream, product,
-        LABEL_BY_QUADFILTER_DICT, COLOR_BY_LABELNAME_DICT
+        LABEL_BY_QUADFILTER_DICT, COLOR_BY_LABELNAME_DICT,
+        MORAN_ANALYSIS
     ):
     """ 
     Returns:
         - png: Moran Plot
     """
-    moran_pickle_path = str(upstream['get-moran-and-lisa']['moran'])
-    lisa_pickle_path = str(upstream['get-moran-and-lisa']['lisa'])
-    with open(moran_pickle_path, "rb") as infile:
-        moran = pickle.load(infile)
-    with open(lisa_pickle_path, "rb") as infile:
-        lisa = pickle.load(infile)
+    moran, lisa = __load_analysis(
+        upstream['get-moran-and-lisa'], MORAN_ANALYSIS)
         
     __launch_moranplot_creation_task(
         aMoran=moran,
@@ -75,18 +88,15 @@ def get_moranplot_bivariate(
         upstream, product,
         pMoranAttr,
         pMoranLagAttr,
-        LABEL_BY_QUADFILTER_DICT, COLOR_BY_LABELNAME_DICT
+        LABEL_BY_QUADFILTER_DICT, COLOR_BY_LABELNAME_DICT,
+        MORAN_ANALYSIS
     ):
     """ 
     Returns:
         - png: Moran Plot
     """
-    moran_pickle_path = str(upstream['get-moran-and-lisa-bivariate']['moran'])
-    lisa_pickle_path = str(upstream['get-moran-and-lisa-bivariate']['lisa'])
-    with open(moran_pickle_path, "rb") as infile:
-        moran = pickle.load(infile)
-    with open(lisa_pickle_path, "rb") as infile:
-        lisa = pickle.load(infile)
+    moran, lisa = __load_analysis(
+        upstream['get-moran-and-lisa'], MORAN_ANALYSIS)
         
     __launch_moranplot_creation_task(
         aMoran=moran,
@@ -104,17 +114,14 @@ def get_moranplot_bivariate_reverse(
         pMoranAttr,
         pMoranLagAttr,
         LABEL_BY_QUADFILTER_DICT, COLOR_BY_LABELNAME_DICT,
+        MORAN_ANALYSIS
     ):
     """ 
     Returns:
         - png: Moran Plot
     """
-    moran_pickle_path = str(upstream["get-moran-and-lisa-bivariate-reverse"]['moran'])
-    lisa_pickle_path = str(upstream["get-moran-and-lisa-bivariate-reverse"]['lisa'])
-    with open(moran_pickle_path, "rb") as infile:
-        moran = pickle.load(infile)
-    with open(lisa_pickle_path, "rb") as infile:
-        lisa = pickle.load(infile)
+    moran, lisa = __load_analysis(
+        upstream['get-moran-and-lisa'], MORAN_ANALYSIS)
         
     __launch_moranplot_creation_task(
         aMoran=moran,
@@ -127,41 +134,30 @@ def get_moranplot_bivariate_reverse(
         yLabel=f'Spatial lag of: {pMoranLagAttr}',
     )
 
-def __create_base_clustermap(
-        aLisa,
-        pm_tracts_shape,
-        LABEL_BY_QUADFILTER_DICT,
-        figure_title="Moran Statistics: Cases of bronchiolitis\nPuerto Madryn, Chubut, Argentina"
-    ):
-    ''' Genera la figura de HS, CS, y outliers + puntos de domicilios de las internaciones.
-    
-    upstream = ['get_bronchiolitis', 'shape']
-    '''
+CLUSTERMAP_TITLE = "Moran Statistics: Cases of bronchiolitis\nPuerto Madryn, Chubut, Argentina"
+
+# la capa de clusters va debajo de la flecha y de los puntos (zorder 1) y sobre la capa
+# base (zorder 0), el mismo orden en que se dibuja en un mapa por figura
+CLUSTER_LAYER_ZORDER = .5
+
+
+def __get_cluster_layer(aLisa, pm_tracts_shape, LABEL_BY_QUADFILTER_DICT):
+    ''' Radios con la etiqueta de cluster (columna `label`) y las paletas para pintarlos '''
     # contar las cantidades por cada cluster
     MIN_SIGNIFICANCE_LEVEL = .05
-    quadfilter = (aLisa.p_sim <= (MIN_SIGNIFICANCE_LEVEL)) * (aLisa.q)
+    quadfilter = (aLisa['p_sim'] <= (MIN_SIGNIFICANCE_LEVEL)) * (aLisa['q'])
     labels = [LABEL_BY_QUADFILTER_DICT[str(i)] for i in quadfilter]
 
     # add label column
-    pm_tracts_shape['label'] = labels
     ordered_cols = ['toponimo_i', 'label', 'geometry']
-    pm_tracts_shape = pm_tracts_shape[ordered_cols]
+    pm_tracts_shape = pm_tracts_shape.assign(label=labels)[ordered_cols]
 
     # Figura
     tracts_palette, edge_palette = spatial_vis.get_palettes(
         pm_tracts_shape['label'],
         LABEL_BY_QUADFILTER_DICT
     )
-
-    # paint a map:
-    ax, pmarks_map = maps_utils.plot_puerto_madryn_tract_map(
-        shape=pm_tracts_shape,
-        paint_by_column="label",
-        tracts_palette=tracts_palette,
-        edge_palette=edge_palette,
-        figure_title=figure_title
-    )
-    return ax, pmarks_map
+    return pm_tracts_shape, tracts_palette, edge_palette
 
 def __add_cases_points(point_gdf, DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS, mapAx):
     # admission and readmissions points
@@ -234,33 +230,52 @@ def __add_cases_points(point_gdf, DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS, map
 
     return ax, pmarks_admission_points
 
-def __launch_clustermap_creation_task(
-        lisa, pm_tracts_shape, bronchiolitis_points_gdf,
+def __render_clustermaps(
+        clustermaps, pm_tracts_shape, bronchiolitis_points_gdf,
         PUERTO_MADRYN_BASEMAP_TIF_PATH,
         SOUTH_AMERICA_BASEMAP_TIF_PATH,
         LABEL_BY_QUADFILTER_DICT,
         PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP,
         DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS,
-        figure_title="Moran Statistics: Cases of bronchiolitis\nPuerto Madryn, Chubut, Argentina"
+        BASEMAP_CACHE_DIR=None,
+        LOCATOR_INSET=None
     ):
-    ''' Genera la figura de HS, CS, y outliers + puntos de domicilios de las internaciones.
-    
-    upstream = ['get_bronchiolitis', 'shape']
+    ''' Genera los mapas de HS, CS, y outliers + puntos de domicilios de las internaciones
+    de varios análisis en una sola figura.
+
+    La parte común (capa base, inset, norte y puntos) se dibuja una vez; para cada mapa
+    sólo cambia la capa de radios pintada por cluster que está visible, el título y la
+    leyenda.
+
+    Args:
+        - clustermaps (list): Tuplas (lisa, título, archivo de salida).
     '''
-    # 1. clustermap
-    ax, pmarks_map = __create_base_clustermap(
-        lisa,
-        pm_tracts_shape,
-        LABEL_BY_QUADFILTER_DICT,
-        figure_title=figure_title
-    )
-        
+    figure, ax = plt.subplots(figsize=(12, 12))
+    # tight_layout parte siempre de los márgenes de una figura nueva
+    subplotpars = {
+        name: getattr(figure.subplotpars, name)
+        for name in ('left', 'right', 'bottom', 'top', 'wspace', 'hspace')
+    }
+
+    # 1. clustermaps: todas las capas (comparten los paths de los radios), visibles de a una
+    cluster_layers = []
+    for lisa, _, _ in clustermaps:
+        cluster_shape, tracts_palette, edge_palette = __get_cluster_layer(
+            lisa, pm_tracts_shape, LABEL_BY_QUADFILTER_DICT)
+        cluster_collection, handles, pmarks_map = maps_utils.plot_tract_clusters(
+            ax, cluster_shape, "label", tracts_palette, edge_palette)
+        cluster_collection.set_zorder(CLUSTER_LAYER_ZORDER)
+        cluster_collection.set_visible(False)
+        cluster_layers.append((cluster_collection, handles, pmarks_map))
+
     # 2. contextualize clustermap
     ax = maps_utils.annotate_map(
         ax,
         shape_crs_string=pm_tracts_shape.crs.to_string(),
         PUERTO_MADRYN_BASEMAP_TIF_PATH=PUERTO_MADRYN_BASEMAP_TIF_PATH,
-        SOUTH_AMERICA_BASEMAP_TIF_PATH=SOUTH_AMERICA_BASEMAP_TIF_PATH       
+        SOUTH_AMERICA_BASEMAP_TIF_PATH=SOUTH_AMERICA_BASEMAP_TIF_PATH,
+        BASEMAP_CACHE_DIR=BASEMAP_CACHE_DIR,
+        LOCATOR_INSET=LOCATOR_INSET
     )
 
     # 3. add cases points?
@@ -271,65 +286,36 @@ def __launch_clustermap_creation_task(
             DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS,
             ax
         )
- 
-    # legend
-    pmarks = [*pmarks_map, *pmarks_admission_points]
-    handles, _ = ax.get_legend_handles_labels()
-    ax.legend(
-        title='References:',
-        handles=[*handles,*pmarks],
-        loc='upper right',
-        prop={'size': 12}
-    )
 
     # last tweaks
     ax.ticklabel_format(style='plain')
     ax.axis('off')
 
-    return ax
-
-def create_clustermap_figure(
-        product, upstream,
-        PUERTO_MADRYN_BASEMAP_TIF_PATH,
-        SOUTH_AMERICA_BASEMAP_TIF_PATH,
-        LABEL_BY_QUADFILTER_DICT,
-        PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP,
-        DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS
-    ):
-    ''' Genera la figura de HS, CS, y outliers + puntos de domicilios de las internaciones.
-    
-    upstream = ['get_bronchiolitis', 'shape']
-    '''
-    lisa_pickle_path = str(upstream['get-moran-and-lisa']['lisa'])
-    with open(lisa_pickle_path, "rb") as infile:
-        lisa = pickle.load(infile)
-        
-    # Casos (puntos)
-    pm_tracts_shape = geopandas.read_parquet(
-        upstream["cases-for-each-circuit"])
-    bronchiolitis_points_gdf = geopandas.read_parquet(
-        upstream['get_bronchiolitis_locations'])
-    bronchiolitis_points_gdf = bronchiolitis_points_gdf.to_crs(
-        pm_tracts_shape.crs.to_string())
+    for (_, figure_title, output_path), (cluster_collection, handles, pmarks_map) in zip(clustermaps, cluster_layers):
+        for other_collection, _, _ in cluster_layers:
+            other_collection.set_visible(other_collection is cluster_collection)
+        ax.set(title=figure_title)
+
+        # legend (las capas ocultas también tienen etiqueta: se pasan las de este mapa)
+        pmarks = [*pmarks_map, *pmarks_admission_points]
+        ax.legend(
+            title='References:',
+            handles=[*handles,*pmarks],
+            loc='upper right',
+            prop={'size': 12}
+        )
 
-    mainAx = __launch_clustermap_creation_task(
-        lisa, pm_tracts_shape, bronchiolitis_points_gdf,
-        PUERTO_MADRYN_BASEMAP_TIF_PATH,
-        SOUTH_AMERICA_BASEMAP_TIF_PATH,
-        LABEL_BY_QUADFILTER_DICT,
-        PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP,
-        DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS
-    )
+        figure.subplots_adjust(**subplotpars)
+        figure.tight_layout()
+        figure.savefig(
+            str(output_path),
+            dpi=300
+        )
 
-    plt.tight_layout()
-    plt.savefig(
-        str(product),
-        dpi=300
-    )
-    plt.close()
+    plt.close(figure)
 
 
-def create_clustermap_figure_bivariate(
+def create_clustermap_figures(
         product, upstream,
         pMoranAttr,
         pMoranLagAttr,
@@ -337,74 +323,39 @@ def create_clustermap_figure_bivariate(
         SOUTH_AMERICA_BASEMAP_TIF_PATH,
         LABEL_BY_QUADFILTER_DICT,
         PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP,
-        DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS
-    ):
-    '''
-    '''
-    lisa_pickle_path = str(upstream['get-moran-and-lisa-bivariate']['lisa'])
-    with open(lisa_pickle_path, "rb") as infile:
-        lisa = pickle.load(infile)
-
-     # Casos (puntos)
-    pm_tracts_shape = geopandas.read_parquet(
-        upstream["cases-for-each-circuit"])
-    bronchiolitis_points_gdf = geopandas.read_parquet(
-        upstream['get_bronchiolitis_locations'])
-    bronchiolitis_points_gdf = bronchiolitis_points_gdf.to_crs(
-        pm_tracts_shape.crs.to_string())
-
-    mainAx = __launch_clustermap_creation_task(
-        lisa, pm_tracts_shape, bronchiolitis_points_gdf,
-        PUERTO_MADRYN_BASEMAP_TIF_PATH,
-        SOUTH_AMERICA_BASEMAP_TIF_PATH,
-        LABEL_BY_QUADFILTER_DICT,
-        PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP,
         DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS,
-        figure_title=f"Bi-variate Moran Statistics: {pMoranAttr} and {pMoranLagAttr}\nPuerto Madryn, Chubut, Argentina"
-    )
-
-    plt.tight_layout()
-    plt.savefig(
-        str(product),
-        dpi=300
-    )
-    plt.close()
-
-
-def create_clustermap_figure_bivariate_reverse(
-        product, upstream,
-        PUERTO_MADRYN_BASEMAP_TIF_PATH,
-        SOUTH_AMERICA_BASEMAP_TIF_PATH,
-        LABEL_BY_QUADFILTER_DICT,
-        PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP,
-        DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS
+        BASEMAP_CACHE_DIR=None
     ):
+    ''' Genera los mapas de clusters de todos los análisis: una clave de `product` por
+    análisis de get-moran-and-lisa (univariate, bivariate, bivariate-reverse).
+
+    Los radios y los puntos (ya proyectados en la ingesta) se leen una sola vez.
     '''
-    '''
-    lisa_pickle_path = str(upstream['get-moran-and-lisa-bivariate-reverse']['lisa'])
-    with open(lisa_pickle_path, "rb") as infile:
-        lisa = pickle.load(infile)
+    titles = {
+        'bivariate': f"Bi-variate Moran Statistics: {pMoranAttr} and {pMoranLagAttr}\nPuerto Madryn, Chubut, Argentina",
+    }
+    clustermaps = [
+        (
+            __load_cluster_columns(upstream['get-moran-and-lisa'], analysis_name),
+            titles.get(analysis_name, CLUSTERMAP_TITLE),
+            output_path
+        )
+        for analysis_name, output_path in product.items()
+    ]
 
-     # Casos (puntos)
+    # Casos (puntos, ya en el crs de los radios)
     pm_tracts_shape = geopandas.read_parquet(
         upstream["cases-for-each-circuit"])
     bronchiolitis_points_gdf = geopandas.read_parquet(
-        upstream['get_bronchiolitis_locations'])
-    bronchiolitis_points_gdf = bronchiolitis_points_gdf.to_crs(
-        pm_tracts_shape.crs.to_string())
+        upstream['get_bronchiolitis_locations']['projected_points'])
 
-    mainAx = __launch_clustermap_creation_task(
-        lisa, pm_tracts_shape, bronchiolitis_points_gdf,
+    __render_clustermaps(
+        clustermaps, pm_tracts_shape, bronchiolitis_points_gdf,
         PUERTO_MADRYN_BASEMAP_TIF_PATH,
         SOUTH_AMERICA_BASEMAP_TIF_PATH,
         LABEL_BY_QUADFILTER_DICT,
         PAINT_BRONCHIOLITIS_LOCATIONS_IN_MAP,
-        DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS
-    )
-
-    plt.tight_layout()
-    plt.savefig(
-        str(product),
-        dpi=300
+        DIFFERENTIATE_ADMISSIONS_AND_READMISSIONS,
+        BASEMAP_CACHE_DIR=BASEMAP_CACHE_DIR,
+        LOCATOR_INSET=upstream['get_locator_inset']
     )
-    plt.close()
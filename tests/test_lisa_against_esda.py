@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+I de Moran locales de `spatial.local_moran_batch` contra `esda.Moran_Local`.
+
+Usa una variable entera (conteos de Poisson sobre una grilla), donde muchos I simulados
+empatan con el observado, y una semilla fija.
+"""
+import esda
+import libpysal
+import numpy
+import pytest
+from esda.crand import vec_permutations
+
+from bronchiolitis_package import permutations as lisa_permutations
+from bronchiolitis_package import spatial
+
+PERMUTATIONS = 999
+SEED = 12345
+
+# desvíos estándar de Monte Carlo tolerados
+MC_TOLERANCE = 5
+
+
+@pytest.fixture(params=[(20, True), (20, False)], ids=['rook', 'queen'])
+def case(request):
+    side, rook = request.param
+    w = libpysal.weights.lat2W(side, side, rook=rook)
+    w.transform = 'R'
+    x = numpy.random.default_rng(SEED).poisson(1.0, size=w.n).astype(float)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        reference = esda.Moran_Local(x, w, permutations=PERMUTATIONS, seed=SEED)
+    return x, w, reference
+
+
+def test_same_permutations_as_esda(case):
+    """ Con las permutaciones de esda, simulados y p_sim iguales a los de esda. """
+    x, w, reference = case
+    n = len(x)
+    z = reference.z[:, numpy.newaxis]
+    scaling = (n - 1) / (z * z).sum(axis=0)
+    neighbor_weights, self_weights = lisa_permutations.get_neighbor_weights(w)
+    permuted_ids = vec_permutations(neighbor_weights.shape[1], n, PERMUTATIONS, SEED)
+
+    sim = lisa_permutations.simulate_local_moran(
+        z, z, neighbor_weights, self_weights, scaling, permuted_ids)[:, :, 0]
+    Is = reference.Is[:, numpy.newaxis]
+    # el caso tiene empates: es lo que distingue la regla de esda
+    assert (sim == Is).sum() > 0
+
+    numpy.testing.assert_array_equal(sim, reference.sim.T)
+    above = (sim >= Is).sum(axis=1)
+    numpy.testing.assert_array_equal(
+        lisa_permutations.get_p_sim(above, PERMUTATIONS), reference.p_sim)
+    numpy.testing.assert_allclose(sim.mean(axis=1), reference.EI_sim, rtol=1e-12, atol=1e-12)
+
+
+def test_batch_against_esda(case):
+    """ `local_moran_batch` (con sus propias permutaciones) contra esda. """
+    x, w, reference = case
+    lisa, = spatial.local_moran_batch(x, w, permutations=PERMUTATIONS, seed=SEED)
+
+    numpy.testing.assert_array_equal(lisa.Is, reference.Is)
+    numpy.testing.assert_array_equal(lisa.q, reference.q)
+
+    ei_error = MC_TOLERANCE * reference.seI_sim / numpy.sqrt(PERMUTATIONS) + 1e-12
+    assert (numpy.abs(lisa.EI_sim - reference.EI_sim) <= ei_error).all()
+
+    p = reference.p_sim
+    p_error = MC_TOLERANCE * numpy.sqrt(p * (1 - p) / PERMUTATIONS) + 2 / (PERMUTATIONS + 1)
+    assert (numpy.abs(lisa.p_sim - reference.p_sim) <= p_error).all()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Motor de permutaciones (`permutations.local_moran_inference`): resultados
+independientes de los procesos, los bloques y los chunks, y regla de p_sim de esda.
+"""
+import libpysal
+import numpy
+import pytest
+
+from bronchiolitis_package import permutations as lisa_permutations
+
+PERMUTATIONS = 99
+SEED = 2024
+
+
+@pytest.fixture
+def lattice():
+    """ Grilla queen con dos atributos enteros (con empates) estandarizados. """
+    w = libpysal.weights.lat2W(8, 8, rook=False)
+    w.transform = 'R'
+    x = numpy.random.default_rng(SEED).poisson(1.5, size=(w.n, 2)).astype(float)
+    z = (x - x.mean(axis=0)) / x.std(axis=0)
+    Is = (w.n - 1) * z * (w.sparse @ z) / (z * z).sum(axis=0)
+    return z, Is, w
+
+
+def single_pass(z, Is, w, chunk_size):
+    """ Inferencia sobre todas las simulaciones juntas, sorteadas como el motor. """
+    n = len(z)
+    scaling = (n - 1) / (z * z).sum(axis=0)
+    neighbor_weights, self_weights = lisa_permutations.get_neighbor_weights(w)
+    chunk_sizes = lisa_permutations.get_chunk_sizes(PERMUTATIONS, chunk_size)
+    seed_sequences = numpy.random.SeedSequence(SEED).spawn(len(chunk_sizes))
+    sims = []
+    for size, seed_sequence in zip(chunk_sizes, seed_sequences):
+        rng = numpy.random.default_rng(seed_sequence)
+        permuted_ids = lisa_permutations.draw_permuted_ids(
+            rng, size, n - 1, neighbor_weights.shape[1])
+        sims.append(lisa_permutations.simulate_local_moran(
+            z, z, neighbor_weights, self_weights, scaling, permuted_ids))
+    sim = numpy.concatenate(sims, axis=1)
+
+    # regla de esda (esda.Moran_Local)
+    larger = (sim >= Is[:, numpy.newaxis, :]).sum(axis=1)
+    low_extreme = (PERMUTATIONS - larger) < larger
+    larger[low_extreme] = PERMUTATIONS - larger[low_extreme]
+    return {
+        'p_sim': (larger + 1.0) / (PERMUTATIONS + 1.0),
+        'EI_sim': sim.mean(axis=1),
+        'seI_sim': sim.std(axis=1),
+    }
+
+
+def inference(z, Is, w, **kwargs):
+    return lisa_permutations.local_moran_inference(
+        z, z, Is, w, permutations=PERMUTATIONS, seed=SEED, **kwargs)
+
+
+@pytest.mark.parametrize('chunk_size', [7, 1000])
+def test_chunks_match_single_pass(lattice, chunk_size):
+    z, Is, w = lattice
+    expected = single_pass(z, Is, w, chunk_size)
+    result = inference(z, Is, w, chunk_size=chunk_size)
+    numpy.testing.assert_array_equal(result['p_sim'], expected['p_sim'])
+    numpy.testing.assert_allclose(result['EI_sim'], expected['EI_sim'], rtol=1e-10, atol=1e-12)
+    numpy.testing.assert_allclose(result['seI_sim'], expected['seI_sim'], rtol=1e-10, atol=1e-12)
+
+
+def test_independent_of_n_jobs(lattice):
+    z, Is, w = lattice
+    serial = inference(z, Is, w, chunk_size=7, n_jobs=1)
+    parallel = inference(z, Is, w, chunk_size=7, n_jobs=2)
+    for name, values in serial.items():
+        numpy.testing.assert_array_equal(parallel[name], values)
+
+
+def test_independent_of_blocks(lattice, monkeypatch):
+    z, Is, w = lattice
+    expected = inference(z, Is, w)
+    # bloques de pocas permutaciones y pocas observaciones
+    monkeypatch.setattr(lisa_permutations, 'MAX_BLOCK_ELEMENTS', 500)
+    result = inference(z, Is, w)
+    numpy.testing.assert_array_equal(result['p_sim'], expected['p_sim'])
+    for name in ('EI_sim', 'seI_sim'):
+        numpy.testing.assert_allclose(result[name], expected[name], rtol=1e-10, atol=1e-12)
+
+
+def test_merge_moments_matches_single_pass():
+    values = numpy.random.default_rng(SEED).normal(3, 2, size=(5, 101))
+    moments = 0, numpy.zeros(5), numpy.zeros(5)
+    for part in numpy.array_split(values, [1, 8, 50, 51], axis=1):
+        mean = part.mean(axis=1)
+        m2 = ((part - mean[:, numpy.newaxis]) ** 2).sum(axis=1)
+        moments = lisa_permutations.merge_moments(moments, (part.shape[1], mean, m2))
+    count, mean, m2 = moments
+    assert count == values.shape[1]
+    numpy.testing.assert_allclose(mean, values.mean(axis=1), rtol=1e-12)
+    numpy.testing.assert_allclose(numpy.sqrt(m2 / count), values.std(axis=1), rtol=1e-12)
+
+
+def test_p_sim_is_esda_fold():
+    above = numpy.arange(PERMUTATIONS + 1)
+    larger = above.copy()
+    low_extreme = (PERMUTATIONS - larger) < larger
+    larger[low_extreme] = PERMUTATIONS - larger[low_extreme]
+    numpy.testing.assert_array_equal(
+        lisa_permutations.get_p_sim(above, PERMUTATIONS),
+        (larger + 1.0) / (PERMUTATIONS + 1.0))
+
+
+def test_tie_tolerance_counts_ties_in_both_tails(lattice):
+    z, Is, w = lattice
+    default = inference(z, Is, w)
+    tied = inference(z, Is, w, tie_tolerance=lisa_permutations.TIE_TOLERANCE)
+    # con empates en las dos colas el p-valor nunca es menor que el de esda
+    assert (tied['p_sim'] >= default['p_sim']).all()
+    assert (tied['p_sim'] > default['p_sim']).any()